@@ -1,14 +1,38 @@
 import os
 import requests
-from PIL import Image
-from datetime import datetime
+from PIL import Image, ImageChops, ImageDraw, ImageFilter, ImageOps, ImageStat, features
+from datetime import datetime, timezone
 import io
+import atexit
+import cProfile
+import hashlib
 import json
-from flask import Flask, render_template_string, request, redirect, url_for, flash, session
+import mmap
+import pstats
+import queue
+import random
+import re
+import sqlite3
+import struct
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import OrderedDict
+from contextlib import closing, contextmanager
+from urllib.parse import urlencode
+from concurrent.futures import Future, ThreadPoolExecutor
+from flask import Flask, Response, render_template_string, request, redirect, url_for, flash, session, stream_with_context, jsonify, g, has_request_context, send_from_directory
 import toml
+from markupsafe import Markup
+from werkzeug.datastructures import FileStorage
+from werkzeug.utils import secure_filename
 
 # === Load API Key from secrets.toml ===
+# PLANTNET_API_KEY / OPENAI_API_KEY in the environment take precedence, e.g. when running against the stand-in server
 def load_api_key():
+    if os.environ.get('PLANTNET_API_KEY'):
+        return os.environ['PLANTNET_API_KEY']
     try:
         secrets = toml.load('secrets.toml')
         return secrets['plantnet']['api_key']
@@ -17,6 +41,8 @@ def load_api_key():
 
 # Remove Gemini key loading
 def load_openai_key():
+    if os.environ.get('OPENAI_API_KEY'):
+        return os.environ['OPENAI_API_KEY']
     try:
         secrets = toml.load('secrets.toml')
         return secrets['openai']['api_key']
@@ -25,7 +51,13 @@ def load_openai_key():
 
 API_KEY = load_api_key()
 OPENAI_API_KEY = load_openai_key()
-API_URL = "https://my-api.plantnet.org/v2/identify/all"
+# Upstream base URLs can be pointed at standin_server.py for offline benchmarking
+PLANTNET_BASE_URL = os.environ.get('PLANTNET_BASE_URL', 'https://my-api.plantnet.org').rstrip('/')
+OPENAI_BASE_URL = os.environ.get('OPENAI_BASE_URL', 'https://api.openai.com').rstrip('/')
+GBIF_BASE_URL = os.environ.get('GBIF_BASE_URL', 'https://api.gbif.org').rstrip('/')
+PLANTNET_IDENTIFY_URL = f"{PLANTNET_BASE_URL}/v2/identify/{{project}}"
+OPENAI_URL = f"{OPENAI_BASE_URL}/v1/chat/completions"
+GBIF_OCCURRENCE_URL = f"{GBIF_BASE_URL}/v1/occurrence/search"
 
 # === Flask App Setup ===
 app = Flask(__name__)
@@ -34,6 +66,460 @@ app.config['SESSION_TYPE'] = 'filesystem'
 UPLOAD_FOLDER = 'images'
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# === Metrics ===
+# Minimal in-process Prometheus-style metrics, exposed on /metrics
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in labels]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            state = self.values.get(key)
+            if state is None:
+                state = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][i] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, (counts, total, count) in sorted(self.values.items()):
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{format_labels(key + (('le', f'{bound:g}'),))} {cumulative}")
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+                lines.append(f"{self.name}_sum{format_labels(key)} {total:.6f}")
+                lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+HTTP_REQUESTS = Counter('http_requests_total', 'HTTP requests handled, by route, method and status.')
+HTTP_DURATION = Histogram('http_request_duration_seconds', 'HTTP request duration, by route.')
+STAGE_DURATION = Histogram('app_stage_duration_seconds', 'Duration of internal pipeline stages.')
+UPSTREAM_REQUESTS = Counter('upstream_requests_total', 'Calls to upstream APIs, by upstream and status.')
+UPSTREAM_DURATION = Histogram('upstream_request_duration_seconds', 'Upstream API call duration, by upstream and status.')
+CACHE_REQUESTS = Counter('cache_requests_total', 'Cache lookups, by cache and result (hit or miss).')
+ANALYTICS_DROPPED = Counter('analytics_events_dropped_total', 'Analytics events dropped because the writer queue was full.')
+LLM_BATCH_SIZE = Histogram('llm_batch_size', 'Prompts per chat completion sent by the LLM micro-batcher.', buckets=(1, 2, 4, 8, 16, 32))
+LLM_BATCH_ITEMS = Counter('llm_batch_items_total', 'Prompts answered by the LLM micro-batcher, by outcome.')
+PLANTNET_ROUTES = Counter('plantnet_routing_total', 'PlantNet project routing decisions, by region, project, outcome (regional, fallback, error, global) and source (plantnet, cache).')
+PLANTNET_PROJECT_DURATION = Histogram('plantnet_identify_duration_seconds', 'PlantNet identify call duration including client-side queueing, by project.')
+ADMISSIONS = Counter('admission_requests_total', 'Admission decisions for expensive routes, by route and outcome (admitted, queued, rejected).')
+METRICS = [HTTP_REQUESTS, HTTP_DURATION, STAGE_DURATION, UPSTREAM_REQUESTS, UPSTREAM_DURATION, CACHE_REQUESTS, ANALYTICS_DROPPED,
+           LLM_BATCH_SIZE, LLM_BATCH_ITEMS, ADMISSIONS, PLANTNET_ROUTES, PLANTNET_PROJECT_DURATION]
+
+_timing_capture = threading.local()
+
+def add_server_timing(name, duration, count=1):
+    if has_request_context():
+        timings = g.setdefault('server_timing', {})
+    else:
+        # Work done for a request on a pool thread is captured and handed back (see capture_server_timing)
+        timings = getattr(_timing_capture, 'timings', None)
+        if timings is None:
+            return
+    total, calls = timings.get(name, (0.0, 0))
+    timings[name] = (total + duration, calls + count)
+
+@contextmanager
+def capture_server_timing(timings):
+    """
+    Collect add_server_timing entries made on this thread into timings, for threads without a request context.
+    """
+    _timing_capture.timings = timings
+    try:
+        yield timings
+    finally:
+        _timing_capture.timings = None
+
+def merge_server_timing(timings):
+    """
+    Add timings captured on another thread to the current request. The same dict may be shared by
+    several of the request's futures and still be growing, so only entries not merged yet are added.
+    """
+    if timings is None or not has_request_context():
+        return
+    merged = g.setdefault('merged_server_timing', {})
+    source, seen = merged.setdefault(id(timings), (timings, {}))
+    for name, (total, count) in list(source.items()):
+        seen_total, seen_count = seen.get(name, (0.0, 0))
+        if count > seen_count:
+            add_server_timing(name, total - seen_total, count - seen_count)
+            seen[name] = (total, count)
+
+@contextmanager
+def stage_timer(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.observe(duration, stage=stage)
+        add_server_timing(stage, duration)
+
+def record_upstream(upstream, started, status):
+    duration = time.perf_counter() - started
+    status = str(status) if status is not None else 'error'
+    UPSTREAM_REQUESTS.inc(upstream=upstream, status=status)
+    UPSTREAM_DURATION.observe(duration, upstream=upstream, status=status)
+    add_server_timing(upstream, duration)
+    record_analytics('upstream', upstream, status == 'error' or status.startswith(('4', '5')))
+
+def record_cache(cache, hit):
+    CACHE_REQUESTS.inc(cache=cache, result='hit' if hit else 'miss')
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def add_timing_headers(response):
+    started = g.get('request_started')
+    if started is None:
+        return response
+    duration = time.perf_counter() - started
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    HTTP_REQUESTS.inc(route=route, method=request.method, status=response.status_code)
+    HTTP_DURATION.observe(duration, route=route)
+    entries = []
+    for name, (total, count) in g.get('server_timing', {}).items():
+        desc = f';desc="{count} calls"' if count > 1 else ''
+        entries.append(f"{name};dur={total * 1000:.1f}{desc}")
+    entries.append(f"total;dur={duration * 1000:.1f}")
+    # Streamed responses are still being generated, so only the time to first byte is known here
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+# === HTTP Connection Pools ===
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', 32))
+_http_session = None
+_http_session_pid = None
+
+def http_session():
+    """
+    Pooled HTTP session for upstream calls, created per process so forked workers never share sockets.
+    """
+    global _http_session, _http_session_pid
+    if _http_session is None or _http_session_pid != os.getpid():
+        session_ = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=HTTP_POOL_SIZE)
+        session_.mount('https://', adapter)
+        session_.mount('http://', adapter)
+        _http_session, _http_session_pid = session_, os.getpid()
+    return _http_session
+
+# === Shared Cache ===
+SHARED_CACHE_PATH = os.environ.get('SHARED_CACHE_PATH', 'cache.sqlite3')
+ENRICHMENT_TTL = 30 * 24 * 3600
+IDENTIFICATION_TTL = 7 * 24 * 3600
+
+class SharedCache:
+    """
+    Cross-process key/value cache in a local SQLite file (WAL mode), fronted by a small
+    per-process LRU. Values are JSON; entries expire after their TTL.
+    """
+    def __init__(self, path, local_size=512):
+        self.path = path
+        self.local_size = local_size
+        self.local = OrderedDict()
+        self.lock = threading.Lock()
+        self.thread_state = threading.local()
+        self.initialised = False
+
+    def _conn(self):
+        conn = getattr(self.thread_state, 'conn', None)
+        if conn is None or getattr(self.thread_state, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            if not self.initialised:
+                conn.execute("PRAGMA journal_mode=WAL")
+                conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL)")
+                self.initialised = True
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.thread_state.conn, self.thread_state.pid = conn, os.getpid()
+        return conn
+
+    def _remember(self, key, value, expires_at):
+        with self.lock:
+            self.local[key] = (value, expires_at)
+            self.local.move_to_end(key)
+            while len(self.local) > self.local_size:
+                self.local.popitem(last=False)
+
+    def get(self, name, key):
+        """
+        Look up key in the cache namespace `name`; returns None on a miss.
+        """
+        full_key = f"{name}:{key}"
+        now = time.time()
+        with self.lock:
+            entry = self.local.get(full_key)
+            if entry is not None and entry[1] > now:
+                self.local.move_to_end(full_key)
+                record_cache(name, True)
+                return entry[0]
+        try:
+            row = self._conn().execute("SELECT value, expires_at FROM cache WHERE key = ? AND expires_at > ?", (full_key, now)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[SharedCache.get] {e}")
+            row = None
+        if row is None:
+            record_cache(name, False)
+            return None
+        value = json.loads(row[0])
+        self._remember(full_key, value, row[1])
+        record_cache(name, True)
+        return value
+
+    def set(self, name, key, value, ttl):
+        full_key = f"{name}:{key}"
+        expires_at = time.time() + ttl
+        self._remember(full_key, value, expires_at)
+        try:
+            conn = self._conn()
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, expires_at) VALUES (?, ?, ?)", (full_key, json.dumps(value), expires_at))
+            if random.random() < 0.01:
+                conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        except sqlite3.Error as e:
+            print(f"[SharedCache.set] {e}")
+
+    def reset_after_fork(self):
+        with self.lock:
+            self.local.clear()
+        self.thread_state = threading.local()
+
+SHARED_CACHE = SharedCache(SHARED_CACHE_PATH)
+
+def cache_key(*parts):
+    return hashlib.sha256('\0'.join(str(p).lower() for p in parts).encode('utf-8')).hexdigest()
+
+# === Perceptual Similarity Index ===
+SIMILARITY_INDEX_PATH = os.environ.get('SIMILARITY_INDEX_PATH', 'similarity.sqlite3')
+# Max Hamming distance (of 64 bits) between dHashes for two images to count as the same photo; -1 disables.
+# Lookups split hashes into 8 bands of 8 bits, so any distance up to 7 is guaranteed to be found.
+SIMILARITY_MAX_DISTANCE = min(int(os.environ.get('SIMILARITY_MAX_DISTANCE', 6)), 7)
+SIMILARITY_BANDS = 8
+
+def dhash(preview):
+    """
+    64-bit difference hash of an image: the sign of horizontal gradients on a 9x8 grayscale thumbnail.
+    Survives re-compression, resizing and small crops; returned as a signed int to fit SQLite INTEGER.
+    """
+    pixels = list(preview.convert('L').resize((9, 8), Image.Resampling.BILINEAR).getdata())
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            value = (value << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return value - (1 << 64) if value >= 1 << 63 else value
+
+def hash_bands(value):
+    unsigned = value & 0xFFFFFFFFFFFFFFFF
+    return [(unsigned >> (8 * band)) & 0xFF for band in range(SIMILARITY_BANDS)]
+
+class SimilarityIndex:
+    """
+    Persistent near-duplicate index: perceptual hashes of past observations mapped to the
+    PlantNet results they produced. Each hash is also stored as 8 one-byte bands with an index per band,
+    so a lookup only fetches rows sharing at least one band with the query (multi-index hashing)
+    instead of scanning every entry.
+    """
+    def __init__(self, path, max_distance):
+        self.path = path
+        self.max_distance = max_distance
+        self.thread_state = threading.local()
+        self.initialised = False
+
+    def _conn(self):
+        conn = getattr(self.thread_state, 'conn', None)
+        if conn is None or getattr(self.thread_state, 'pid', None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            if not self.initialised:
+                conn.execute("PRAGMA journal_mode=WAL")
+                band_columns = ', '.join(f"b{band} INTEGER NOT NULL" for band in range(SIMILARITY_BANDS))
+                conn.executescript(f"""
+                    CREATE TABLE IF NOT EXISTS observations (
+                        id INTEGER PRIMARY KEY,
+                        image_count INTEGER NOT NULL,
+                        result TEXT NOT NULL,
+                        created_at REAL NOT NULL,
+                        route TEXT
+                    );
+                    CREATE TABLE IF NOT EXISTS image_hashes (
+                        observation_id INTEGER NOT NULL REFERENCES observations(id),
+                        hash INTEGER NOT NULL,
+                        {band_columns}
+                    );
+                """)
+                # Entries from before routing was recorded have no route and never match
+                if 'route' not in {row[1] for row in conn.execute("PRAGMA table_info(observations)")}:
+                    conn.execute("ALTER TABLE observations ADD COLUMN route TEXT")
+                for band in range(SIMILARITY_BANDS):
+                    conn.execute(f"CREATE INDEX IF NOT EXISTS image_hashes_b{band} ON image_hashes (b{band})")
+                self.initialised = True
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.thread_state.conn, self.thread_state.pid = conn, os.getpid()
+        return conn
+
+    def _candidates(self, conn, value):
+        where = ' OR '.join(f"b{band} = ?" for band in range(SIMILARITY_BANDS))
+        rows = conn.execute(f"SELECT observation_id, hash FROM image_hashes WHERE {where}", hash_bands(value)).fetchall()
+        return [(obs_id, h) for obs_id, h in rows if bin((h ^ value) & 0xFFFFFFFFFFFFFFFF).count('1') <= self.max_distance]
+
+    def lookup(self, hashes, route):
+        """
+        Cached result of a past observation sent to the same PlantNet route (first project tried) with the
+        same number of images where every query image has a near-duplicate, or None.
+        Records a 'similarity' cache hit or miss.
+        """
+        if self.max_distance < 0 or not hashes:
+            return None
+        try:
+            conn = self._conn()
+            matching = None
+            for value in hashes:
+                observation_ids = {obs_id for obs_id, _ in self._candidates(conn, value)}
+                matching = observation_ids if matching is None else matching & observation_ids
+                if not matching:
+                    break
+            row = None
+            if matching:
+                placeholders = ','.join('?' * len(matching))
+                row = conn.execute(f"SELECT result FROM observations WHERE id IN ({placeholders}) AND image_count = ? AND route = ? ORDER BY created_at DESC LIMIT 1",
+                                   (*matching, len(hashes), route)).fetchone()
+        except sqlite3.Error as e:
+            print(f"[SimilarityIndex.lookup] {e}")
+            row = None
+        record_cache('similarity', row is not None)
+        return json.loads(row[0]) if row else None
+
+    def add(self, hashes, result, route):
+        if self.max_distance < 0 or not hashes:
+            return
+        try:
+            conn = self._conn()
+            with conn:
+                conn.execute("BEGIN IMMEDIATE")
+                cur = conn.execute("INSERT INTO observations (image_count, result, created_at, route) VALUES (?, ?, ?, ?)",
+                                   (len(hashes), json.dumps(result), time.time(), route))
+                conn.executemany(f"INSERT INTO image_hashes VALUES (?, ?, {', '.join('?' * SIMILARITY_BANDS)})",
+                                 [(cur.lastrowid, value, *hash_bands(value)) for value in hashes])
+        except sqlite3.Error as e:
+            print(f"[SimilarityIndex.add] {e}")
+
+    def size(self):
+        try:
+            return self._conn().execute("SELECT COUNT(*) FROM observations").fetchone()[0]
+        except sqlite3.Error as e:
+            print(f"[SimilarityIndex.size] {e}")
+            return None
+
+    def reset_after_fork(self):
+        self.thread_state = threading.local()
+
+SIMILARITY_INDEX = SimilarityIndex(SIMILARITY_INDEX_PATH, SIMILARITY_MAX_DISTANCE)
+
+# === Species Knowledge Pack ===
+# Prebuilt summaries, fun facts, care tips and occurrences for common species (see build_knowledge_pack.py).
+# Empty KNOWLEDGE_PACK_PATH disables the pack.
+KNOWLEDGE_PACK_PATH = os.environ.get('KNOWLEDGE_PACK_PATH', 'knowledge_pack.bin')
+KNOWLEDGE_PACK_MAGIC = b'PLNTPACK'
+KNOWLEDGE_PACK_FORMAT = 1
+# magic, format version, species count, metadata offset, metadata length
+KNOWLEDGE_PACK_HEADER = struct.Struct('<8sIIQI')
+# name key, record offset, record length; entries follow the header, sorted by key
+KNOWLEDGE_PACK_ENTRY = struct.Struct('<8sQI')
+
+def knowledge_pack_key(scientific_name):
+    return hashlib.blake2b(scientific_name.strip().lower().encode('utf-8'), digest_size=8).digest()
+
+class KnowledgePack:
+    """
+    Read-only, memory-mapped species pack. Opening it only maps the file and reads the header;
+    lookups binary-search the fixed-width index in place and decode just the matching JSON record.
+    The mapping is shared through the page cache, so every worker process reads the same physical pages.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self.count = 0
+        self.metadata = {}
+        if not path or not os.path.exists(path):
+            return
+        try:
+            with open(path, 'rb') as fh:
+                self.mm = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ)
+            magic, version, count, meta_offset, meta_length = KNOWLEDGE_PACK_HEADER.unpack_from(self.mm, 0)
+            if magic != KNOWLEDGE_PACK_MAGIC or version != KNOWLEDGE_PACK_FORMAT:
+                raise ValueError(f"not a format {KNOWLEDGE_PACK_FORMAT} knowledge pack")
+            self.count = count
+            self.metadata = json.loads(self.mm[meta_offset:meta_offset + meta_length])
+        except (OSError, ValueError, struct.error) as e:
+            print(f"[KnowledgePack] Ignoring {path}: {e}")
+            self.mm = None
+            self.count = 0
+
+    def get(self, scientific_name):
+        """
+        The packed record for scientific_name (summary, education, occurrences), or None.
+        """
+        if self.mm is None or not scientific_name:
+            return None
+        key = knowledge_pack_key(scientific_name)
+        lo, hi = 0, self.count
+        record = None
+        while lo < hi:
+            mid = (lo + hi) // 2
+            entry_key, offset, length = KNOWLEDGE_PACK_ENTRY.unpack_from(self.mm, KNOWLEDGE_PACK_HEADER.size + mid * KNOWLEDGE_PACK_ENTRY.size)
+            if entry_key < key:
+                lo = mid + 1
+            elif entry_key > key:
+                hi = mid
+            else:
+                record = json.loads(self.mm[offset:offset + length])
+                # Guard against a 64-bit key collision
+                if record.get('scientific_name', '').lower() != scientific_name.strip().lower():
+                    record = None
+                break
+        record_cache('knowledge_pack', record is not None)
+        return record
+
+KNOWLEDGE_PACK = KnowledgePack(KNOWLEDGE_PACK_PATH)
+
 # === HTML Template ===
 TEMPLATE = '''
 <!DOCTYPE html>
@@ -42,7 +528,6 @@ TEMPLATE = '''
     <meta charset="UTF-8">
     <title>Tree Species Classifier</title>
     <link href="https://fonts.googleapis.com/css?family=Montserrat:700,400&display=swap" rel="stylesheet">
-    <link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css" />
     <style>
         html, body {
             height: 100%;
@@ -316,6 +801,32 @@ TEMPLATE = '''
             border-radius: 12px;
             box-shadow: 0 2px 8px #0002;
         }
+        .species-heatmap {
+            display: block;
+            width: 100%;
+            height: auto;
+            margin: 1rem 0 0.3rem 0;
+            border-radius: 12px;
+            box-shadow: 0 2px 8px #0002;
+        }
+        .user-photos {
+            float: right;
+            display: flex;
+            gap: 0.3rem;
+            margin: 0 0 0.5rem 0.8rem;
+        }
+        .user-photos img {
+            width: 64px;
+            height: 64px;
+            object-fit: cover;
+            border-radius: 10px;
+            box-shadow: 0 2px 8px #0002;
+        }
+        .map-details summary {
+            cursor: pointer;
+            font-weight: 600;
+            color: #43e97b;
+        }
         .compare-btn {
             background: #ffe066;
             color: #333;
@@ -414,7 +925,6 @@ TEMPLATE = '''
           100% { background-position: -200% 0; }
         }
     </style>
-    <script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
 </head>
 <body>
     <div class="container">
@@ -429,6 +939,9 @@ TEMPLATE = '''
               {% endif %}
             {% endwith %}
             <form method="POST" enctype="multipart/form-data" id="upload-form">
+                <input type="hidden" name="idempotency_key" value="{{ idempotency_key }}">
+                <input type="hidden" name="lat" id="upload-lat">
+                <input type="hidden" name="lon" id="upload-lon">
                 <label for="file-input-1">Plant Images (Required):
                   <span class="tooltip">&#9432;
                     <span class="tooltiptext">Upload one or more clear, well-lit photos of leaves, flowers, or bark. Multiple images help improve identification accuracy.</span>
@@ -489,6 +1002,15 @@ TEMPLATE = '''
             </script>
             {% endif %}
             <script>
+            // Result data for the page's scripts, embedded once as JSON by page_data() (parsed on first use)
+            let pageDataCache = null;
+            function getPageData() {
+                if (!pageDataCache) {
+                    const island = document.getElementById('page-data');
+                    pageDataCache = island ? JSON.parse(island.textContent) : { results: [] };
+                }
+                return pageDataCache;
+            }
             let userLocation = null;
             const getLocBtn = document.getElementById('get-location-btn');
             const checkLocalBtn = document.getElementById('check-local-btn');
@@ -500,6 +1022,9 @@ TEMPLATE = '''
                         navigator.geolocation.getCurrentPosition(function(pos) {
                             userLocation = {lat: pos.coords.latitude, lon: pos.coords.longitude};
                             userCoordsDiv.textContent = `Your location: (${userLocation.lat.toFixed(5)}, ${userLocation.lon.toFixed(5)})`;
+                            // Sent with the next identification so it can use the regional PlantNet flora
+                            document.getElementById('upload-lat').value = userLocation.lat;
+                            document.getElementById('upload-lon').value = userLocation.lon;
                             localResultsMsgDiv.textContent = '';
                             alert('Location set! Now you can check local species.');
                         }, function() {
@@ -519,11 +1044,7 @@ TEMPLATE = '''
                     localResultsMsgDiv.textContent = 'Checking local species...';
                     // Gather all species names from the results
                     const speciesCards = document.querySelectorAll('.result-card.local-check');
-                    const speciesList = [];
-                    speciesCards.forEach(card => {
-                        const sciName = card.querySelector('h3')?.textContent?.replace(/^#\d+\s*/, '') || '';
-                        speciesList.push(sciName);
-                    });
+                    const speciesList = Array.from(speciesCards, card => getPageData().results[card.dataset.idx].name);
                     // Call backend to check each species
                     const response = await fetch('/check_local_species', {
                         method: 'POST',
@@ -535,6 +1056,11 @@ TEMPLATE = '''
                         })
                     });
                     const data = await response.json();
+                    if (!response.ok) {
+                        // Shed under load (503): keep every card and say why
+                        localResultsMsgDiv.textContent = data.error || 'Local species check is unavailable right now.';
+                        return;
+                    }
                     // Hide/show cards and show messages
                     let anyLocal = false;
                     speciesCards.forEach((card, idx) => {
@@ -567,10 +1093,9 @@ TEMPLATE = '''
                     <svg viewBox="0 0 52 52"><polyline points="14,27 22,35 38,19"></polyline></svg>
                 </div>
             </div>
-            <script src="https://cdn.jsdelivr.net/npm/browser-image-compression@2.0.2/dist/browser-image-compression.js"></script>
             <script src="https://cdn.jsdelivr.net/npm/canvas-confetti@1.6.0/dist/confetti.browser.min.js"></script>
             <script>
-            // --- Advanced Multi-Image Upload with Remove, Reorder, and Compression ---
+            // --- Advanced Multi-Image Upload with Remove, Reorder, and Downscaling ---
             let filesArray = [];
             const area = document.getElementById('upload-area-1');
             const input = document.getElementById('file-input-1');
@@ -599,6 +1124,7 @@ TEMPLATE = '''
                     btn.innerHTML = '&times;';
                     btn.onclick = (e) => {
                         e.stopPropagation(); // Prevents opening file dialog
+                        URL.revokeObjectURL(filesArray[idx].preview);
                         filesArray.splice(idx, 1);
                         renderPreviews();
                         updateInputFiles();
@@ -648,19 +1174,60 @@ TEMPLATE = '''
                 input.files = dataTransfer.files;
             }
 
-            // Handle file selection and compression
+            // Downscale and re-encode in the browser to exactly what the server sends PlantNet
+            // (longest side {{ upload_max_side }}px, JPEG quality {{ upload_jpeg_quality }}), so the server can pass it straight through.
+            // Returns the original file when it is already in spec or the browser cannot do it.
+            const UPLOAD_MAX_SIDE = {{ upload_max_side }};
+            const UPLOAD_JPEG_QUALITY = {{ upload_jpeg_quality / 100 }};
+            async function loadImage(file) {
+                if (window.createImageBitmap) {
+                    try {
+                        return await createImageBitmap(file, { imageOrientation: 'from-image' });
+                    } catch (err) { /* fall back to an <img> element */ }
+                }
+                const url = URL.createObjectURL(file);
+                try {
+                    const img = new Image();
+                    img.src = url;
+                    await img.decode();
+                    return img;
+                } finally {
+                    URL.revokeObjectURL(url);
+                }
+            }
+            async function downscaleImage(file) {
+                const canvas = document.createElement('canvas');
+                if (!canvas.getContext || !canvas.toBlob) return file;
+                const img = await loadImage(file);
+                const width = img.naturalWidth || img.width;
+                const height = img.naturalHeight || img.height;
+                const scale = Math.min(1, UPLOAD_MAX_SIDE / Math.max(width, height));
+                if (scale === 1 && file.type === 'image/jpeg') return file;
+                canvas.width = Math.round(width * scale);
+                canvas.height = Math.round(height * scale);
+                const ctx = canvas.getContext('2d');
+                // Transparent areas become white, as on the server
+                ctx.fillStyle = '#fff';
+                ctx.fillRect(0, 0, canvas.width, canvas.height);
+                ctx.imageSmoothingQuality = 'high';
+                ctx.drawImage(img, 0, 0, canvas.width, canvas.height);
+                if (img.close) img.close();
+                const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', UPLOAD_JPEG_QUALITY));
+                if (!blob || blob.type !== 'image/jpeg') return file;
+                return new File([blob], file.name.replace(/\.[^.]*$/, '') + '.jpg', { type: 'image/jpeg' });
+            }
+
+            // Handle file selection and downscaling
             async function handleFiles(selectedFiles) {
                 for (let file of selectedFiles) {
-                    // Compress image before adding
+                    let upload = file;
                     try {
-                        const compressed = await imageCompression(file, { maxSizeMB: 0.5, maxWidthOrHeight: 1200, useWebWorker: true });
-                        // Convert Blob to File
-                        const compressedFile = new File([compressed], file.name, { type: compressed.type });
-                        const preview = await imageCompression.getDataUrlFromFile(compressedFile);
-                        filesArray.push({ file: compressedFile, preview, name: file.name });
+                        upload = await downscaleImage(file);
                     } catch (err) {
-                        alert('Image compression failed: ' + err.message);
+                        // Unsupported format or no canvas: the server downscales the original instead
+                        upload = file;
                     }
+                    filesArray.push({ file: upload, preview: URL.createObjectURL(upload), name: file.name });
                 }
                 renderPreviews();
                 updateInputFiles();
@@ -694,8 +1261,40 @@ TEMPLATE = '''
             renderPreviews();
 
             // --- Progress Spinner on Submit ---
-            form.addEventListener('submit', function() {
+            // Identification runs as a background job; the page polls until it finishes.
+            // Browsers without fetch, or an enqueue request that never got an answer, fall back to
+            // the regular synchronous form POST. Once the job is queued it is never submitted again.
+            const MAX_POLL_FAILURES = 10;
+            form.addEventListener('submit', async function(e) {
                 progressOverlay.style.display = 'flex';
+                if (!window.fetch || !window.FormData) return;
+                e.preventDefault();
+                let submitResp, job;
+                try {
+                    submitResp = await fetch('/jobs', { method: 'POST', body: new FormData(form) });
+                    job = await submitResp.json();
+                } catch (err) {
+                    form.submit();
+                    return;
+                }
+                if (!submitResp.ok) {
+                    progressOverlay.style.display = 'none';
+                    alert(job.error || 'Could not start the identification.');
+                    return;
+                }
+                let failures = 0;
+                while (failures < MAX_POLL_FAILURES) {
+                    await new Promise(resolve => setTimeout(resolve, 1500));
+                    try {
+                        const status = await (await fetch(job.status_url)).json();
+                        failures = 0;
+                        if (status.status === 'done' || status.status === 'failed' || status.error === 'Unknown job.') break;
+                    } catch (err) {
+                        failures++;
+                    }
+                }
+                // The result page says so if the job is still running
+                window.location.href = job.result_url;
             });
 
             // --- Confetti and Success/Failure Animation ---
@@ -798,10 +1397,21 @@ TEMPLATE = '''
             });
             </script>
             {% if results %}
+                {% for qw in quality_warnings %}
+                    <div class="warning">📷 {{ qw }}</div>
+                {% endfor %}
                 <h2>🌱 Top {{ shown_results }} Result{% if shown_results > 1 %}s{% endif %}:</h2>
+                <script id="page-data" type="application/json">{{ page_data }}</script>
                 <div id="results-list">
                 {% for r in results %}
-                    <div class="result-card local-check" data-coords="{{ r.gbif_coords|tojson }}">
+                    <div class="result-card local-check" data-idx="{{ loop.index0 }}">
+                        {% if thumbnails %}
+                        <div class="user-photos">
+                            {% for thumb_id in thumbnails %}
+                            <img src="{{ url_for('thumbnail', thumb_id=thumb_id) }}" loading="lazy" alt="Your photo {{ loop.index }}">
+                            {% endfor %}
+                        </div>
+                        {% endif %}
                         <h3>#{{ loop.index }} {{ r.scientific_name }}</h3>
                         <p class="{{ r.confidence_class }}">{{ r.confidence_str }}</p>
                         <div><strong>🏷️ Common Names:</strong> {{ r.common_names }}</div>
@@ -814,34 +1424,13 @@ TEMPLATE = '''
                         <p><strong>📝 Wikipedia Summary:</strong></p>
                         <p>{% if 'No Wikipedia summary found.' in r.wiki_summary %}{{ r.wiki_summary|safe }}{% else %}{{ r.wiki_summary }}{% endif %}</p>
                         {% if r.gbif_coords and r.gbif_coords|length > 0 %}
-                        <div id="map-{{ loop.index }}" class="species-map"></div>
-                        <script>
-                        document.addEventListener('DOMContentLoaded', function() {
-                            var mapId = 'map-{{ loop.index }}';
-                            var coords = {{ r.gbif_coords|tojson }};
-                            // Remove any existing map instance in this container
-                            if (window._leaflet_maps === undefined) window._leaflet_maps = {};
-                            if (window._leaflet_maps[mapId]) {
-                                window._leaflet_maps[mapId].remove();
-                                window._leaflet_maps[mapId] = null;
-                            }
-                            var mapContainer = document.getElementById(mapId);
-                            if (mapContainer) mapContainer.innerHTML = '';
-                            var map = L.map(mapId).setView([0, 0], 2);
-                            window._leaflet_maps[mapId] = map;
-                            L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
-                                maxZoom: 18,
-                                attribution: '© OpenStreetMap contributors'
-                            }).addTo(map);
-                            coords.forEach(function(pt) {
-                                L.marker([pt.lat, pt.lon]).addTo(map);
-                            });
-                            if (coords.length > 0) {
-                                var group = L.featureGroup(coords.map(function(pt) { return L.marker([pt.lat, pt.lon]); }));
-                                map.fitBounds(group.getBounds().pad(0.2));
-                            }
-                        });
-                        </script>
+                        {% if r.heatmap %}
+                        <img src="{{ url_for('heatmap_image', name=r.heatmap) }}" class="species-heatmap" width="360" height="180" loading="lazy" alt="Occurrence map for {{ r.scientific_name }}">
+                        {% endif %}
+                        <details class="map-details" data-map-idx="{{ loop.index0 }}">
+                            <summary>🗺️ Show interactive map</summary>
+                            <div id="map-{{ loop.index }}" class="species-map"></div>
+                        </details>
                         {% endif %}
                         <!-- Educational Content -->
                         <div class="info" style="background:rgba(67,233,123,0.18);margin-top:1rem;">
@@ -881,6 +1470,41 @@ TEMPLATE = '''
                 {% endfor %}
                 </div>
                 <script>
+                // Interactive maps: Leaflet is only fetched when a card's map is expanded
+                let leafletLoading = null;
+                function loadLeaflet() {
+                    if (!leafletLoading) {
+                        leafletLoading = new Promise((resolve, reject) => {
+                            const css = document.createElement('link');
+                            css.rel = 'stylesheet';
+                            css.href = 'https://unpkg.com/leaflet@1.9.4/dist/leaflet.css';
+                            document.head.appendChild(css);
+                            const script = document.createElement('script');
+                            script.src = 'https://unpkg.com/leaflet@1.9.4/dist/leaflet.js';
+                            script.onload = resolve;
+                            script.onerror = reject;
+                            document.head.appendChild(script);
+                        });
+                    }
+                    return leafletLoading;
+                }
+                document.querySelectorAll('.map-details').forEach(details => {
+                    details.addEventListener('toggle', function() {
+                        if (!details.open || details.dataset.loaded) return;
+                        details.dataset.loaded = '1';
+                        const mapDiv = details.querySelector('.species-map');
+                        const coords = getPageData().results[details.closest('.result-card').dataset.idx].coords;
+                        loadLeaflet().then(() => {
+                            const map = L.map(mapDiv.id).setView([0, 0], 2);
+                            L.tileLayer('https://{s}.tile.openstreetmap.org/{z}/{x}/{y}.png', {
+                                maxZoom: 18,
+                                attribution: '© OpenStreetMap contributors'
+                            }).addTo(map);
+                            const group = L.featureGroup(coords.map(pt => L.marker(pt))).addTo(map);
+                            map.fitBounds(group.getBounds().pad(0.2));
+                        });
+                    });
+                });
                 // Local species filter logic
                 function isNearby(user, coords, maxDistKm=100) {
                     if (!user || !coords || coords.length === 0) return false;
@@ -893,8 +1517,8 @@ TEMPLATE = '''
                         const c = 2 * Math.atan2(Math.sqrt(a), Math.sqrt(1-a));
                         return R * c;
                     }
-                    for (let pt of coords) {
-                        if (haversine(user.lat, user.lon, pt.lat, pt.lon) < maxDistKm) return true;
+                    for (const [lat, lon] of coords) {
+                        if (haversine(user.lat, user.lon, lat, lon) < maxDistKm) return true;
                     }
                     return false;
                 }
@@ -903,7 +1527,7 @@ TEMPLATE = '''
                     if (!localOnlyToggle) return;
                     const localOnly = localOnlyToggle.checked;
                     document.querySelectorAll('.result-card.local-check').forEach(card => {
-                        const coords = JSON.parse(card.getAttribute('data-coords'));
+                        const coords = getPageData().results[card.dataset.idx].coords;
                         const isLocal = userLocation && isNearby(userLocation, coords, 100); // 100 km radius
                         const label = card.querySelector('.local-species-label');
                         if (label) label.style.display = isLocal ? 'block' : 'none';
@@ -945,7 +1569,6 @@ TEMPLATE = '''
                 </div>
                 <script>
                 // Render comparison content dynamically
-                const allResults = {{ results|tojson|safe }};
                 function renderCompareContent() {
                     const loadingDiv = document.getElementById('gpt-comparison-loading');
                     const tableDiv = document.getElementById('gpt-comparison-table');
@@ -965,6 +1588,10 @@ TEMPLATE = '''
                         .then(html => {
                             loadingDiv.style.display = 'none';
                             tableDiv.innerHTML = html;
+                            const differencesDiv = document.getElementById('key-differences');
+                            if (!differencesDiv) return;
+                            differencesDiv.innerHTML = '<span class="flowing-loader">Summarising key differences...</span>';
+                            streamKeyDifferences(idx1, idx2, differencesDiv);
                         });
                         document.getElementById('comparison-section').style.display = 'flex';
                     } else {
@@ -973,6 +1600,54 @@ TEMPLATE = '''
                         document.getElementById('comparison-section').style.display = 'none';
                     }
                 }
+                // Stream the key differences paragraph (server-sent events over fetch) as it is generated
+                async function streamKeyDifferences(idx1, idx2, target) {
+                    const response = await fetch('/compare/differences?stream=1', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/x-www-form-urlencoded' },
+                        body: `idx1=${idx1}&idx2=${idx2}`
+                    });
+                    if (!response.ok) {
+                        target.innerHTML = '';
+                        return;
+                    }
+                    let textSpan = null;
+                    const append = (chunk) => {
+                        if (!textSpan) {
+                            target.innerHTML = '<strong>🔍 Key Differences:</strong> ';
+                            textSpan = document.createElement('span');
+                            target.appendChild(textSpan);
+                        }
+                        textSpan.textContent += chunk;
+                    };
+                    const handleEvent = (raw) => {
+                        let event = 'message';
+                        let data = '';
+                        raw.split('\\n').forEach(line => {
+                            if (line.startsWith('event: ')) event = line.slice(7);
+                            else if (line.startsWith('data: ')) data += line.slice(6);
+                        });
+                        if (event === 'message' && data) append(JSON.parse(data).text);
+                    };
+                    if (!response.body || !window.TextDecoder) {
+                        (await response.text()).split('\\n\\n').forEach(handleEvent);
+                    } else {
+                        const reader = response.body.getReader();
+                        const decoder = new TextDecoder();
+                        let buffer = '';
+                        while (true) {
+                            const { done, value } = await reader.read();
+                            if (done) break;
+                            buffer += decoder.decode(value, { stream: true });
+                            let boundary;
+                            while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                                handleEvent(buffer.slice(0, boundary));
+                                buffer = buffer.slice(boundary + 2);
+                            }
+                        }
+                    }
+                    if (!textSpan) target.innerHTML = '';
+                }
                 // Watch for compare selection changes
                 // setInterval(renderCompareContent, 300); // Removed setInterval
                 </script>
@@ -994,21 +1669,213 @@ TEMPLATE = '''
 </html>
 '''
 
-def process_image(file_storage, filename):
+# === Thumbnail Derivatives ===
+THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER', 'thumbnails')
+THUMBNAIL_SIZE = 256
+THUMBNAIL_MAX_BYTES = int(os.environ.get('THUMBNAIL_MAX_BYTES', 200 * 1024 * 1024))
+# JPEG encodes ~10x faster than WebP at about the same size for 256px thumbnails; THUMBNAIL_FORMAT=webp opts in
+THUMBNAIL_FORMAT = 'WEBP' if os.environ.get('THUMBNAIL_FORMAT', 'jpeg').lower() == 'webp' and features.check('webp') else 'JPEG'
+THUMBNAIL_EXTENSION = 'webp' if THUMBNAIL_FORMAT == 'WEBP' else 'jpg'
+
+class ThumbnailStore:
+    """
+    Content-addressed thumbnails of uploaded photos, named by the hash of their encoded bytes.
+    Files are immutable; their mtime is the LRU clock (touched on every read) and the oldest are
+    evicted once the folder grows past max_bytes.
+    """
+    def __init__(self, folder, max_bytes):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.estimated_bytes = None
+
+    def path(self, thumb_id):
+        return os.path.join(self.folder, f"{thumb_id}.{THUMBNAIL_EXTENSION}")
+
+    def put(self, img):
+        """
+        Store a thumbnail of an already decoded image and return its id.
+        """
+        thumb = img.copy()
+        thumb.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE), Image.Resampling.BILINEAR, reducing_gap=1.0)
+        buf = io.BytesIO()
+        thumb.save(buf, format=THUMBNAIL_FORMAT, quality=75, optimize=True)
+        data = buf.getvalue()
+        thumb_id = hashlib.sha256(data).hexdigest()[:32]
+        path = self.path(thumb_id)
+        if os.path.exists(path):
+            os.utime(path)
+            return thumb_id
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'wb') as fh:
+            fh.write(data)
+        os.replace(tmp_path, path)
+        with self.lock:
+            if self.estimated_bytes is None:
+                self.estimated_bytes = self.disk_usage()[0]
+            else:
+                self.estimated_bytes += len(data)
+            if self.estimated_bytes > self.max_bytes:
+                self.evict()
+        return thumb_id
+
+    def get(self, thumb_id):
+        """
+        Path of a stored thumbnail (marking it recently used), or None.
+        """
+        path = self.path(thumb_id)
+        try:
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def disk_usage(self):
+        entries = []
+        try:
+            with os.scandir(self.folder) as it:
+                for entry in it:
+                    if entry.name.endswith(f".{THUMBNAIL_EXTENSION}"):
+                        st = entry.stat()
+                        entries.append((st.st_mtime, st.st_size, entry.path))
+        except FileNotFoundError:
+            pass
+        return sum(size for _, size, _ in entries), entries
+
+    def evict(self):
+        # Evict down to 90% of the cap so eviction scans stay rare
+        total, entries = self.disk_usage()
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes * 0.9:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
+        self.estimated_bytes = total
+
+THUMBNAIL_STORE = ThumbnailStore(THUMBNAIL_FOLDER, THUMBNAIL_MAX_BYTES)
+
+# What PlantNet is sent; the upload form downscales to the same spec in the browser
+UPLOAD_MAX_SIDE = 1024
+UPLOAD_JPEG_QUALITY = 85
+# Uploads already in spec and at most this big are sent as received, minus their metadata
+UPLOAD_PASSTHROUGH_MAX_BYTES = 1024 * 1024
+EXIF_ORIENTATION = 0x0112
+# Segments dropped from passed-through JPEGs: APP1 (EXIF including GPS, and XMP), APP13 (IPTC), COM
+JPEG_METADATA_MARKERS = {0xE1, 0xED, 0xFE}
+
+def is_upload_in_spec(img, size):
+    # A rotated photo is re-encoded upright, since stripping its EXIF would lose the orientation
+    return (img.format == 'JPEG' and img.mode in ('RGB', 'L') and max(img.size) <= UPLOAD_MAX_SIDE
+            and size <= UPLOAD_PASSTHROUGH_MAX_BYTES and img.getexif().get(EXIF_ORIENTATION, 1) == 1)
+
+def strip_jpeg_metadata(data):
+    """
+    The JPEG without its metadata segments; the compressed image data is copied untouched.
+    Raises ValueError when the segment layout cannot be followed.
+    """
+    if data[:2] != b'\xff\xd8':
+        raise ValueError('not a JPEG')
+    out = bytearray(data[:2])
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError(f'expected a marker at byte {pos}')
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0xDA:
+            # Start of scan: everything after it is image data
+            out += data[pos:]
+            return bytes(out)
+        length = int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if length < 2 or pos + 2 + length > len(data):
+            raise ValueError(f'bad segment length at byte {pos}')
+        if marker not in JPEG_METADATA_MARKERS:
+            out += data[pos:pos + 2 + length]
+        pos += 2 + length
+    raise ValueError('no start of scan')
+
+def decode_upload(image_data):
+    """
+    Decode an upload to flattened, upright pixels and return (img, None); or, when it is already in
+    spec, return the undecoded image and the upload's bytes with metadata stripped, to send as is.
+    Large JPEGs are decoded straight to the smallest DCT scale still at least UPLOAD_MAX_SIDE.
+    """
+    img = Image.open(io.BytesIO(image_data))
+    if is_upload_in_spec(img, len(image_data)):
+        try:
+            return img, strip_jpeg_metadata(image_data)
+        except ValueError:
+            # Re-encoding drops the metadata just as well
+            pass
+    if img.format == 'JPEG':
+        img.draft(img.mode, (UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE))
+    img.load()
+    if img.getexif().get(EXIF_ORIENTATION, 1) != 1:
+        img = ImageOps.exif_transpose(img)
+    if img.mode in ("RGBA", "P"):
+        background = Image.new("RGB", img.size, (255, 255, 255))
+        if img.mode == "RGBA":
+            background.paste(img, mask=img.split()[-1])
+        else:
+            background.paste(img)
+        img = background
+    return img, None
+
+def downscale_upload(img):
+    if img.size[0] > UPLOAD_MAX_SIDE or img.size[1] > UPLOAD_MAX_SIDE:
+        img.thumbnail((UPLOAD_MAX_SIDE, UPLOAD_MAX_SIDE), Image.Resampling.LANCZOS)
+    return img
+
+def encode_upload(img):
+    buf = io.BytesIO()
+    img.save(buf, format="JPEG", quality=UPLOAD_JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+# Side of the preview used by the quality gate, the perceptual hash and thumbnails
+PREVIEW_SIZE = max(256, THUMBNAIL_SIZE)
+
+def make_preview(img):
+    preview = img.convert('RGB')
+    preview.thumbnail((PREVIEW_SIZE, PREVIEW_SIZE), Image.Resampling.BILINEAR)
+    return preview
+
+def process_image(file_storage, filename, thumbnail_ids=None, previews=None):
+    """
+    Decode, flatten and downscale an upload and save it as the JPEG sent to PlantNet.
+    JPEGs that are already in spec (normally downscaled by the browser) are saved without re-encoding,
+    minus their EXIF, XMP and IPTC metadata.
+    The image is decoded once: when previews is a list, (preview, size of the saved JPEG) is appended
+    with a PREVIEW_SIZE RGB copy for the quality gate and perceptual hash, and when thumbnail_ids is
+    a list, a thumbnail made from that preview is stored and its id appended.
+    """
     try:
         image_data = file_storage.read()
-        img = Image.open(io.BytesIO(image_data))
-        if img.mode in ("RGBA", "P"):
-            background = Image.new("RGB", img.size, (255, 255, 255))
-            if img.mode == "RGBA":
-                background.paste(img, mask=img.split()[-1])
-            else:
-                background.paste(img)
-            img = background
-        max_size = 1024
-        if img.size[0] > max_size or img.size[1] > max_size:
-            img.thumbnail((max_size, max_size), Image.Resampling.LANCZOS)
-        img.save(filename, format="JPEG", quality=85, optimize=True)
+        img, passthrough = decode_upload(image_data)
+        wants_preview = thumbnail_ids is not None or previews is not None
+        if passthrough is not None:
+            output = passthrough
+            full_size = img.size
+            if wants_preview:
+                # Only the preview needs pixels, so let the JPEG decoder scale down while decoding
+                img.draft(img.mode, (PREVIEW_SIZE, PREVIEW_SIZE))
+        else:
+            img = downscale_upload(img)
+            output = encode_upload(img)
+            full_size = img.size
+        with open(filename, "wb") as out:
+            out.write(output)
+        if wants_preview:
+            preview = make_preview(img)
+            if previews is not None:
+                previews.append((preview, full_size))
+            if thumbnail_ids is not None:
+                thumbnail_ids.append(THUMBNAIL_STORE.put(preview))
         return open(filename, "rb")
     except Exception as e:
         print(f"[process_image] Failed to process {filename}: {e}")
@@ -1016,6 +1883,300 @@ def process_image(file_storage, filename):
         traceback.print_exc()
         return None
 
+# === Upstream Rate Limiting ===
+class RateLimitExceeded(Exception):
+    pass
+
+class UpstreamLimiter:
+    """
+    Client-side limiter for one upstream API: a token bucket caps the request rate, and an
+    AIMD concurrency limit backs off on 429s and slow responses and grows again on fast ones.
+    Callers that cannot start straight away wait up to max_wait seconds before RateLimitExceeded.
+    """
+    def __init__(self, name, rate, burst, max_concurrency, target_latency, max_wait, min_concurrency=1):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.target_latency = target_latency
+        self.max_wait = max_wait
+        self.tokens = float(burst)
+        self.limit = float(max_concurrency)
+        self.in_flight = 0
+        self.paused_until = 0.0
+        self.remaining_quota = None
+        self.quota_day = None
+        self.last_refill = time.monotonic()
+        self.cond = threading.Condition()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self):
+        deadline = time.monotonic() + self.max_wait
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                self._refill(now)
+                if self.remaining_quota == 0 and self.quota_day == datetime.now(timezone.utc).date():
+                    raise RateLimitExceeded(f"{self.name} daily quota exhausted")
+                if now >= self.paused_until and self.in_flight < int(self.limit) and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.in_flight += 1
+                    return now
+                if now >= deadline:
+                    raise RateLimitExceeded(f"{self.name} rate limit: no capacity within {self.max_wait:g}s")
+                if self.in_flight >= int(self.limit):
+                    # Woken by release()
+                    wait = deadline - now
+                else:
+                    wait = max(self.paused_until - now, (1 - self.tokens) / self.rate, 0.01)
+                self.cond.wait(min(wait, deadline - now))
+
+    def release(self, started, status_code=None):
+        latency = time.monotonic() - started
+        with self.cond:
+            self.in_flight -= 1
+            if status_code == 429:
+                # Multiplicative decrease, and hold everyone back briefly so the upstream can recover
+                self.limit = max(self.min_concurrency, self.limit / 2)
+                self.tokens = 0.0
+                self.paused_until = time.monotonic() + 1.0
+            elif status_code is None or latency > self.target_latency:
+                self.limit = max(self.min_concurrency, self.limit * 0.8)
+            else:
+                # Additive increase of roughly one slot per window of successful calls
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            self.cond.notify_all()
+
+    def update_quota(self, remaining):
+        if remaining is None:
+            return
+        with self.cond:
+            self.remaining_quota = int(remaining)
+            self.quota_day = datetime.now(timezone.utc).date()
+
+    def call(self, func, *args, **kwargs):
+        queued = time.perf_counter()
+        started = self.acquire()
+        waited = time.perf_counter() - queued
+        if waited > 0.001:
+            add_server_timing(f"{self.name}-queue", waited)
+        status_code = None
+        call_started = time.perf_counter()
+        try:
+            response = func(*args, **kwargs)
+            status_code = response.status_code
+            return response
+        finally:
+            record_upstream(self.name, call_started, status_code)
+            self.release(started, status_code)
+
+    def snapshot(self):
+        with self.cond:
+            return {
+                'concurrency_limit': int(self.limit),
+                'in_flight': self.in_flight,
+                'tokens': round(self.tokens, 2),
+                'remaining_quota': self.remaining_quota,
+            }
+
+PLANTNET_LIMITER = UpstreamLimiter(
+    'plantnet',
+    rate=float(os.environ.get('PLANTNET_RATE_PER_SEC', 2)),
+    burst=int(os.environ.get('PLANTNET_BURST', 5)),
+    max_concurrency=int(os.environ.get('PLANTNET_MAX_CONCURRENCY', 8)),
+    target_latency=10.0,
+    max_wait=30.0,
+)
+OPENAI_LIMITER = UpstreamLimiter(
+    'openai',
+    rate=float(os.environ.get('OPENAI_RATE_PER_SEC', 5)),
+    burst=int(os.environ.get('OPENAI_BURST', 10)),
+    max_concurrency=int(os.environ.get('OPENAI_MAX_CONCURRENCY', 16)),
+    target_latency=8.0,
+    max_wait=20.0,
+)
+
+def openai_chat(payload, timeout, stream=False):
+    headers = {
+        "Content-Type": "application/json",
+        "Authorization": f"Bearer {OPENAI_API_KEY}"
+    }
+    return OPENAI_LIMITER.call(http_session().post, OPENAI_URL, headers=headers, json=payload, timeout=timeout, stream=stream)
+
+# === LLM Micro-Batching ===
+# Enrichment prompts from concurrent requests are collected for a short window and sent as one
+# multi-item chat completion, so a burst of users costs one OpenAI request instead of dozens.
+LLM_BATCH_WINDOW = float(os.environ.get('LLM_BATCH_WINDOW_MS', 30)) / 1000
+# A batch also goes out once no prompt has arrived for this long, so a lone request's prompts
+# (submitted together) only wait a few ms instead of the whole window
+LLM_BATCH_IDLE = float(os.environ.get('LLM_BATCH_IDLE_MS', 5)) / 1000
+LLM_BATCH_MAX_SIZE = int(os.environ.get('LLM_BATCH_MAX_SIZE', 8))
+LLM_MODEL = "gpt-3.5-turbo"
+LLM_SYSTEM_PROMPT = "You are a helpful plant expert."
+LLM_BATCH_INSTRUCTIONS = (
+    "You will receive a JSON array of independent tasks, each with an \"id\" and a \"prompt\". "
+    "Answer every task on its own, exactly as its prompt asks. "
+    "Reply with only a JSON object mapping each task id to its answer as a string."
+)
+
+class ChatCompletionError(Exception):
+    pass
+
+def chat_payload(prompt, max_tokens, temperature):
+    return {
+        "model": LLM_MODEL,
+        "messages": [
+            {"role": "system", "content": LLM_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ],
+        "max_tokens": max_tokens,
+        "temperature": temperature
+    }
+
+def chat_completion(prompt, max_tokens, temperature, timeout):
+    resp = openai_chat(chat_payload(prompt, max_tokens, temperature), timeout=timeout)
+    if resp.status_code != 200:
+        raise ChatCompletionError(f"OpenAI API error: {resp.status_code} {resp.text}")
+    return resp.json()["choices"][0]["message"]["content"]
+
+class ChatBatcher:
+    """
+    Collects prompts for up to `window` seconds after the first one arrives (until max_size are
+    waiting, or none has arrived for `idle` seconds) and sends them as one JSON-mode completion; each
+    caller gets its answer through a Future. Upstream timings of the batch, recorded on a pool thread,
+    travel with the Future as `server_timing` for merge_server_timing on the request thread.
+    Only prompts with the same temperature share a batch. A batch of one is sent as a plain completion.
+    Answers the batched reply leaves out or garbles are retried on their own, so one bad item never
+    fails the others; if the whole call fails, every item in it gets the error.
+    """
+    def __init__(self, window, max_size, idle=0.0, timeout=15):
+        self.window = window
+        self.max_size = max_size
+        self.idle = idle
+        self.timeout = timeout
+        self.pending = []
+        self.cond = threading.Condition()
+        self.pool = None
+        self.dispatcher_pid = None
+
+    def submit(self, prompt, max_tokens, temperature):
+        future = Future()
+        if self.window <= 0 or self.max_size <= 1:
+            self._complete_alone(future, prompt, max_tokens, temperature, 'unbatched')
+            return future
+        self._ensure_dispatcher()
+        with self.cond:
+            self.pending.append((future, prompt, max_tokens, temperature, time.monotonic()))
+            self.cond.notify()
+        return future
+
+    def _ensure_dispatcher(self):
+        if self.dispatcher_pid == os.getpid():
+            return
+        with self.cond:
+            if self.dispatcher_pid == os.getpid():
+                return
+            # After a fork the parent's dispatcher thread and queued items do not exist here
+            self.pending = []
+            self.pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='llm-batch')
+            threading.Thread(target=self._dispatch_loop, name='llm-batcher', daemon=True).start()
+            self.dispatcher_pid = os.getpid()
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                while not self.pending:
+                    self.cond.wait()
+                temperature = self.pending[0][3]
+                deadline = self.pending[0][4] + self.window
+                while True:
+                    ready = [item for item in self.pending if item[3] == temperature]
+                    now = time.monotonic()
+                    remaining = deadline - now
+                    if self.idle > 0:
+                        remaining = min(remaining, ready[-1][4] + self.idle - now)
+                    if len(ready) >= self.max_size or remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = ready[:self.max_size]
+                batched = {id(item) for item in batch}
+                self.pending = [item for item in self.pending if id(item) not in batched]
+            self.pool.submit(self._send, batch)
+
+    def _complete_alone(self, future, prompt, max_tokens, temperature, outcome):
+        try:
+            future.set_result(chat_completion(prompt, max_tokens, temperature, self.timeout))
+            LLM_BATCH_ITEMS.inc(outcome=outcome)
+        except Exception as e:
+            future.set_exception(e)
+            LLM_BATCH_ITEMS.inc(outcome='failed')
+
+    def _send(self, batch):
+        timings = {}
+        for item in batch:
+            item[0].server_timing = timings
+        # How long the batch's first prompt waited to be sent
+        timings['openai-batch'] = (time.monotonic() - batch[0][4], 1)
+        with capture_server_timing(timings):
+            self._send_batch(batch)
+
+    def _send_batch(self, batch):
+        LLM_BATCH_SIZE.observe(len(batch))
+        if len(batch) == 1:
+            future, prompt, max_tokens, temperature, _ = batch[0]
+            self._complete_alone(future, prompt, max_tokens, temperature, 'single')
+            return
+        tasks = [{"id": str(i), "prompt": prompt} for i, (_, prompt, _, _, _) in enumerate(batch)]
+        payload = {
+            "model": LLM_MODEL,
+            "messages": [
+                {"role": "system", "content": f"{LLM_SYSTEM_PROMPT} {LLM_BATCH_INSTRUCTIONS}"},
+                {"role": "user", "content": json.dumps(tasks, ensure_ascii=False)}
+            ],
+            "response_format": {"type": "json_object"},
+            "max_tokens": sum(item[2] for item in batch) + 20 * len(batch),
+            "temperature": batch[0][3]
+        }
+        try:
+            resp = openai_chat(payload, timeout=self.timeout)
+            if resp.status_code != 200:
+                raise ChatCompletionError(f"OpenAI API error: {resp.status_code} {resp.text}")
+            content = resp.json()["choices"][0]["message"]["content"]
+        except Exception as e:
+            print(f"[ChatBatcher] Batch of {len(batch)} failed: {e}")
+            for future, *_ in batch:
+                future.set_exception(e)
+            LLM_BATCH_ITEMS.inc(len(batch), outcome='failed')
+            return
+        try:
+            answers = json.loads(content)
+        except ValueError:
+            answers = None
+        if not isinstance(answers, dict):
+            answers = {}
+        for i, (future, prompt, max_tokens, temperature, _) in enumerate(batch):
+            answer = answers.get(str(i))
+            if isinstance(answer, str) and answer.strip():
+                future.set_result(answer)
+                LLM_BATCH_ITEMS.inc(outcome='batched')
+            else:
+                self._complete_alone(future, prompt, max_tokens, temperature, 'retried')
+
+LLM_BATCHER = ChatBatcher(LLM_BATCH_WINDOW, LLM_BATCH_MAX_SIZE, LLM_BATCH_IDLE)
+
+def batch_result(future, timeout):
+    """
+    future.result() for an LLM_BATCHER prompt, adding its batch's upstream timings to the current request.
+    """
+    try:
+        return future.result(timeout=timeout)
+    finally:
+        merge_server_timing(getattr(future, 'server_timing', None))
+
 def get_confidence_class(score):
     if score >= 70:
         return "confidence-high"
@@ -1039,56 +2200,70 @@ def safe_get(dictionary, key, default="Not available"):
     except:
         return default
 
+SUMMARY_FALLBACK = "No summary available. Try searching on Wikipedia."
+FUN_FACT_FALLBACK = "See Wikipedia for more interesting facts."
+CARE_TIP_FALLBACK = "See Wikipedia for care and cultivation details."
+
 def get_gpt_summary(scientific_name, common_names=None):
     """
     Use only the scientific and common names to generate a summary with GPT-3.5-turbo. Do not use Wikipedia content as context.
     """
+    return collect_gpt_summary(scientific_name, submit_gpt_summary(scientific_name, common_names))
+
+def submit_gpt_summary(scientific_name, common_names=None):
+    """
+    The summary from the knowledge pack or cache, or else a Future for its queued prompt; pass either
+    to collect_gpt_summary. Submitting every card's prompt before collecting lets them share a batch.
+    """
+    packed = KNOWLEDGE_PACK.get(scientific_name)
+    if packed and packed.get('summary'):
+        return packed['summary']
+    cached = SHARED_CACHE.get('summary', cache_key(scientific_name))
+    if cached is not None:
+        return cached
     if common_names and isinstance(common_names, list) and common_names:
         common_names_str = ', '.join(common_names)
         prompt = f"Write a short summary (2-4 sentences) about the plant species '{scientific_name}', also known as {common_names_str}. Focus on what it is, where it grows, and any notable facts."
     else:
         prompt = f"Write a short summary (2-4 sentences) about the plant species '{scientific_name}'. Focus on what it is, where it grows, and any notable facts."
-    openai_url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
-    payload = {
-        "model": "gpt-3.5-turbo",
-        "messages": [
-            {"role": "system", "content": "You are a helpful plant expert."},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": 300,
-        "temperature": 0.7
-    }
+    return LLM_BATCHER.submit(prompt, max_tokens=300, temperature=0.7)
+
+def collect_gpt_summary(scientific_name, pending):
+    if not isinstance(pending, Future):
+        return pending
     try:
-        resp = requests.post(openai_url, headers=headers, json=payload, timeout=15)
-        if resp.status_code == 200:
-            data = resp.json()
-            summary = data["choices"][0]["message"]["content"]
-            if summary and summary.strip():
-                return summary.strip()
-        else:
-            print(f"[get_gpt_summary] OpenAI API error: {resp.status_code} {resp.text}")
+        summary = batch_result(pending, timeout=15)
+        if summary and summary.strip():
+            SHARED_CACHE.set('summary', cache_key(scientific_name), summary.strip(), ENRICHMENT_TTL)
+            return summary.strip()
+    except ChatCompletionError as e:
+        print(f"[get_gpt_summary] {e}")
     except Exception as e:
         print(f"[get_gpt_summary] Exception: {e}")
-    return "No summary available. Try searching on Wikipedia."
+    return SUMMARY_FALLBACK
 
 # Replace get_wikipedia_summary with GPT-based summary
 def get_wikipedia_summary(scientific_name, common_names=None):
     return get_gpt_summary(scientific_name, common_names)
 
 def get_gbif_occurrences(scientific_name, max_points=50):
-    import requests
-    endpoint = "https://api.gbif.org/v1/occurrence/search"
+    packed = KNOWLEDGE_PACK.get(scientific_name)
+    if packed and packed.get('occurrences'):
+        return packed['occurrences'][:max_points]
+    cached = SHARED_CACHE.get('occurrences', cache_key(scientific_name, max_points))
+    if cached is not None:
+        return cached
+    endpoint = GBIF_OCCURRENCE_URL
     params = {
         "scientificName": scientific_name,
         "hasCoordinate": "true",
         "limit": max_points
     }
+    started = time.perf_counter()
+    status = None
     try:
-        response = requests.get(endpoint, params=params, timeout=5)
+        response = http_session().get(endpoint, params=params, timeout=5)
+        status = response.status_code
         data = response.json()
         coords = []
         for rec in data.get("results", []):
@@ -1096,48 +2271,106 @@ def get_gbif_occurrences(scientific_name, max_points=50):
             lon = rec.get("decimalLongitude")
             if lat is not None and lon is not None:
                 coords.append({"lat": lat, "lon": lon})
+        if status == 200:
+            SHARED_CACHE.set('occurrences', cache_key(scientific_name, max_points), coords, ENRICHMENT_TTL)
         return coords
     except Exception:
         return []
+    finally:
+        record_upstream('gbif', started, status)
+
+# === Occurrence heatmap thumbnails ===
+HEATMAP_FOLDER = os.environ.get('HEATMAP_FOLDER', os.path.join('static', 'heatmaps'))
+WORLD_BASE_MAP = os.path.join('static', 'world_base.png')
+os.makedirs(HEATMAP_FOLDER, exist_ok=True)
+_world_base = None
+
+def heatmap_filename(scientific_name):
+    slug = re.sub(r'[^a-z0-9]+', '_', scientific_name.lower()).strip('_') or 'unknown'
+    return f"{slug}.png"
+
+def render_occurrence_heatmap(coords):
+    global _world_base
+    if _world_base is None:
+        _world_base = Image.open(WORLD_BASE_MAP).convert('RGB')
+    width, height = _world_base.size
+    density = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(density)
+    counts = {}
+    for pt in coords:
+        x = int((pt['lon'] + 180.0) / 360.0 * (width - 1))
+        y = int((90.0 - pt['lat']) / 180.0 * (height - 1))
+        counts[(x, y)] = counts.get((x, y), 0) + 1
+    peak = max(counts.values())
+    for (x, y), count in counts.items():
+        level = 120 + int(135 * count / peak)
+        draw.ellipse((x - 3, y - 3, x + 3, y + 3), fill=level)
+    density = density.filter(ImageFilter.GaussianBlur(2))
+    heat = ImageOps.colorize(density, black='#ffe066', white='#ff3333', mid='#ff9f43')
+    return Image.composite(heat, _world_base, density)
+
+def get_occurrence_heatmap(scientific_name, coords):
+    """
+    Return the file name (served from /heatmaps/) of a cached occurrence heatmap for this species,
+    rendering it into HEATMAP_FOLDER on first use.
+    """
+    if not coords:
+        return None
+    filename = heatmap_filename(scientific_name)
+    path = os.path.join(HEATMAP_FOLDER, filename)
+    if os.path.exists(path):
+        record_cache('heatmap', True)
+        return filename
+    record_cache('heatmap', False)
+    try:
+        with stage_timer('heatmap'):
+            img = render_occurrence_heatmap(coords)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            img.save(tmp_path, format="PNG", optimize=True)
+            os.replace(tmp_path, path)
+        return filename
+    except Exception as e:
+        print(f"[get_occurrence_heatmap] Failed to render {scientific_name}: {e}")
+        return None
 
 def get_species_education(scientific_name, common_names=None):
-    import requests
+    return collect_species_education(scientific_name, submit_species_education(scientific_name, common_names))
+
+def submit_species_education(scientific_name, common_names=None):
+    """
+    Like submit_gpt_summary: the fun fact and care tip if already known, else a Future for the prompt.
+    """
+    packed = KNOWLEDGE_PACK.get(scientific_name)
+    if packed and packed.get('education'):
+        return dict(packed['education'])
+    cached = SHARED_CACHE.get('education', cache_key(scientific_name))
+    if cached is not None:
+        return cached
     # Compose prompt for GPT (no Wikipedia context)
     if common_names and isinstance(common_names, list) and common_names:
         common_names_str = ', '.join(common_names)
         prompt = f"Provide:\n1. A fun fact about the plant species '{scientific_name}', also known as {common_names_str}.\n2. A care tip for growing or maintaining this plant.\nFormat your answer as:\nFun Fact: ...\nCare Tip: ..."
     else:
         prompt = f"Provide:\n1. A fun fact about the plant species '{scientific_name}'.\n2. A care tip for growing or maintaining this plant.\nFormat your answer as:\nFun Fact: ...\nCare Tip: ..."
-    openai_url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
-    payload = {
-        "model": "gpt-3.5-turbo",
-        "messages": [
-            {"role": "system", "content": "You are a helpful plant expert."},
-            {"role": "user", "content": prompt}
-        ],
-        "max_tokens": 300,
-        "temperature": 0.7
-    }
-    fun_fact = "See Wikipedia for more interesting facts."
-    care_tip = "See Wikipedia for care and cultivation details."
+    return LLM_BATCHER.submit(prompt, max_tokens=300, temperature=0.7)
+
+def collect_species_education(scientific_name, pending):
+    if not isinstance(pending, Future):
+        return pending
+    fun_fact = FUN_FACT_FALLBACK
+    care_tip = CARE_TIP_FALLBACK
     try:
-        resp = requests.post(openai_url, headers=headers, json=payload, timeout=15)
-        if resp.status_code == 200:
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"]
-            import re
-            fun_match = re.search(r"Fun Fact:\s*(.*?)(?:\n|$)", content, re.IGNORECASE)
-            care_match = re.search(r"Care Tip:\s*(.*?)(?:\n|$)", content, re.IGNORECASE)
-            if fun_match:
-                fun_fact = fun_match.group(1).strip()
-            if care_match:
-                care_tip = care_match.group(1).strip()
-        else:
-            print(f"[get_species_education] OpenAI API error: {resp.status_code} {resp.text}")
+        content = batch_result(pending, timeout=15)
+        fun_match = re.search(r"Fun Fact:\s*(.*?)(?:\n|$)", content, re.IGNORECASE)
+        care_match = re.search(r"Care Tip:\s*(.*?)(?:\n|$)", content, re.IGNORECASE)
+        if fun_match:
+            fun_fact = fun_match.group(1).strip()
+        if care_match:
+            care_tip = care_match.group(1).strip()
+        if fun_match and care_match:
+            SHARED_CACHE.set('education', cache_key(scientific_name), {'fun_fact': fun_fact, 'care_tip': care_tip}, ENRICHMENT_TTL)
+    except ChatCompletionError as e:
+        print(f"[get_species_education] {e}")
     except Exception as e:
         print(f"[get_species_education] Exception: {e}")
     return {
@@ -1145,62 +2378,565 @@ def get_species_education(scientific_name, common_names=None):
         'care_tip': care_tip
     }
 
-def get_gpt_comparison(species1, species2):
-    import requests
-    # Compose prompt for GPT with explicit instructions for a styled, content-rich table
+# === Species Comparison ===
+COMPARISON_TEMPLATE = '''
+<table style="width:100%;border-collapse:separate;border-spacing:0 6px;color:#222;">
+    <tr>
+        <th style="{{ cell }}">Attribute</th>
+        <th style="{{ cell }}">Species 1</th>
+        <th style="{{ cell }}">Species 2</th>
+    </tr>
+    {% for label, value1, value2 in rows %}
+    <tr>
+        <th style="{{ cell }}text-align:left;">{{ label }}</th>
+        <td style="{{ cell }}">{{ value1 }}</td>
+        <td style="{{ cell }}">{{ value2 }}</td>
+    </tr>
+    {% endfor %}
+</table>
+<div id="key-differences" style="margin-top:1rem;"></div>
+'''
+COMPARISON_CELL_STYLE = "background:rgba(255,255,255,0.18);border:1px solid rgba(255,255,255,0.35);border-radius:8px;padding:0.6rem;vertical-align:top;"
+
+def comparison_rows(species1, species2):
+    fields = [
+        ("Scientific Name", lambda s: s.get('scientific_name', '')),
+        ("Common Names", lambda s: s.get('common_names', '')),
+        ("Family", lambda s: s.get('family_name', '')),
+        ("Genus", lambda s: s.get('genus_name', '')),
+        ("Confidence", lambda s: s.get('confidence_str', '')),
+        ("Summary", lambda s: s.get('wiki_summary', '')),
+        ("Fun Fact", lambda s: s.get('education', {}).get('fun_fact', '')),
+        ("Care Tip", lambda s: s.get('education', {}).get('care_tip', '')),
+    ]
+    return [(label, get(species1) or 'Not available', get(species2) or 'Not available') for label, get in fields]
+
+def render_comparison_table(species1, species2):
+    return render_template_string(COMPARISON_TEMPLATE, rows=comparison_rows(species1, species2), cell=COMPARISON_CELL_STYLE)
+
+def differences_cache_key(species1, species2):
+    return tuple(sorted([species1.get('scientific_name', '').lower(), species2.get('scientific_name', '').lower()]))
+
+def get_cached_differences(species1, species2):
+    return SHARED_CACHE.get('differences', cache_key(*differences_cache_key(species1, species2)))
+
+def cache_differences(species1, species2, text):
+    SHARED_CACHE.set('differences', cache_key(*differences_cache_key(species1, species2)), text, ENRICHMENT_TTL)
+
+def key_differences_payload(species1, species2, stream=False):
     prompt = (
-        "Compare the following two plant species in a visually clear, professional HTML table. "
-        "The table should have three columns: the first for the attribute name, the second for Species 1, and the third for Species 2. "
-        "Make all columns (attribute, species 1, species 2) have the same glassy, semi-transparent, blurred background style as the rest of the app. "
-        "Use a background like rgba(255,255,255,0.18), border-radius, and a subtle border, with text color #222 or another dark color for high readability and a modern look. Do not use plain blur or just a transparent background. "
-        "The table should have rows for each attribute: Scientific Name, Common Names, Family, Genus, Confidence, Summary, Fun Fact, Care Tip. "
-        "Fill every cell with the provided data. Use inline CSS for background, borders, padding, and text color to ensure readability. "
-        "Do not leave any cell empty. Do not truncate or shorten any cell content. Show the full text for each attribute, even if it is long. Use <table>, <tr>, <th>, <td> and style the table for clarity. "
-        "Do not include any markdown or code block syntax (like ```html) in your response.\n\n"
-        f"Species 1:\n"
-        f"Scientific Name: {species1.get('scientific_name', '')}\n"
-        f"Common Names: {species1.get('common_names', '')}\n"
-        f"Family: {species1.get('family_name', '')}\n"
-        f"Genus: {species1.get('genus_name', '')}\n"
-        f"Confidence: {species1.get('confidence_str', '')}\n"
-        f"Summary: {species1.get('wiki_summary', '')}\n"
-        f"Fun Fact: {species1.get('education', {}).get('fun_fact', '')}\n"
-        f"Care Tip: {species1.get('education', {}).get('care_tip', '')}\n\n"
-        f"Species 2:\n"
-        f"Scientific Name: {species2.get('scientific_name', '')}\n"
-        f"Common Names: {species2.get('common_names', '')}\n"
-        f"Family: {species2.get('family_name', '')}\n"
-        f"Genus: {species2.get('genus_name', '')}\n"
-        f"Confidence: {species2.get('confidence_str', '')}\n"
-        f"Summary: {species2.get('wiki_summary', '')}\n"
-        f"Fun Fact: {species2.get('education', {}).get('fun_fact', '')}\n"
-        f"Care Tip: {species2.get('education', {}).get('care_tip', '')}\n"
+        f"In 2-3 sentences, describe the key differences between the plant species '{species1.get('scientific_name', '')}' "
+        f"(family {species1.get('family_name', '')}) and '{species2.get('scientific_name', '')}' "
+        f"(family {species2.get('family_name', '')}). Focus on appearance, habitat and uses. "
+        "Answer in plain text without markdown."
     )
-    openai_url = "https://api.openai.com/v1/chat/completions"
-    headers = {
-        "Content-Type": "application/json",
-        "Authorization": f"Bearer {OPENAI_API_KEY}"
-    }
     payload = {
         "model": "gpt-3.5-turbo",
         "messages": [
             {"role": "system", "content": "You are a helpful plant expert."},
             {"role": "user", "content": prompt}
         ],
-        "max_tokens": 900,
+        "max_tokens": 150,
         "temperature": 0.5
     }
+    if stream:
+        payload["stream"] = True
+    return payload
+
+def get_gpt_key_differences(species1, species2):
+    """
+    Short GPT paragraph on how two species differ, cached by the unordered species pair.
+    """
+    cached = get_cached_differences(species1, species2)
+    if cached is not None:
+        return cached
     try:
-        resp = requests.post(openai_url, headers=headers, json=payload, timeout=30)
+        resp = openai_chat(key_differences_payload(species1, species2), timeout=15)
         if resp.status_code == 200:
-            data = resp.json()
-            content = data["choices"][0]["message"]["content"]
-            return content
+            content = resp.json()["choices"][0]["message"]["content"].strip()
+            if content:
+                cache_differences(species1, species2, content)
+                return content
         else:
-            print(f"[get_gpt_comparison] OpenAI API error: {resp.status_code} {resp.text}")
+            print(f"[get_gpt_key_differences] OpenAI API error: {resp.status_code} {resp.text}")
     except Exception as e:
-        print(f"[get_gpt_comparison] Exception: {e}")
-    return "<div style='color:#ffe066;'>Comparison not available.</div>"
+        print(f"[get_gpt_key_differences] Exception: {e}")
+    return None
+
+def stream_gpt_key_differences(species1, species2):
+    """
+    Yield the key differences paragraph as it is generated, caching the full text once complete.
+    """
+    cached = get_cached_differences(species1, species2)
+    if cached is not None:
+        yield cached
+        return
+    parts = []
+    try:
+        resp = openai_chat(key_differences_payload(species1, species2, stream=True), timeout=15, stream=True)
+        try:
+            if resp.status_code != 200:
+                print(f"[stream_gpt_key_differences] OpenAI API error: {resp.status_code} {resp.text}")
+                return
+            for line in resp.iter_lines(decode_unicode=True):
+                if not line or not line.startswith('data: '):
+                    continue
+                data = line[len('data: '):]
+                if data == '[DONE]':
+                    break
+                delta = json.loads(data)["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    parts.append(delta)
+                    yield delta
+        finally:
+            resp.close()
+    except Exception as e:
+        print(f"[stream_gpt_key_differences] Exception: {e}")
+        return
+    text = ''.join(parts).strip()
+    if text:
+        cache_differences(species1, species2, text)
+
+# === Regional PlantNet Routing ===
+# With a known location, identifications go to the regional PlantNet project covering it
+# (smaller candidate set: faster, better top-1) and fall back to the global "all" project.
+PLANTNET_REGIONS_PATH = os.environ.get('PLANTNET_REGIONS_PATH', 'plantnet_regions.toml')
+PLANTNET_GLOBAL_PROJECT = 'all'
+PLANTNET_REGION_MIN_SCORE = float(os.environ.get('PLANTNET_REGION_MIN_SCORE', 0.2))
+
+def load_plantnet_regions(path):
+    """
+    Region to project mapping from a TOML file of [[region]] tables; empty when the file is missing.
+    """
+    if not path or not os.path.exists(path):
+        return []
+    try:
+        config = toml.load(path)
+        regions = []
+        for entry in config.get('region', []):
+            lat_min, lat_max, lon_min, lon_max = (float(v) for v in entry['bounds'])
+            regions.append({'name': entry.get('name', entry['project']), 'project': entry['project'],
+                            'bounds': (lat_min, lat_max, lon_min, lon_max)})
+        return regions
+    except (toml.TomlDecodeError, KeyError, TypeError, ValueError) as e:
+        print(f"[load_plantnet_regions] Ignoring {path}: {e}")
+        return []
+
+PLANTNET_REGIONS = load_plantnet_regions(PLANTNET_REGIONS_PATH)
+
+def request_location():
+    """
+    (lat, lon) from the request's lat/lon fields, or None when missing or out of range.
+    """
+    try:
+        lat = float(request.values.get('lat', ''))
+        lon = float(request.values.get('lon', ''))
+    except ValueError:
+        return None
+    if -90 <= lat <= 90 and -180 <= lon <= 180:
+        return lat, lon
+    return None
+
+def plantnet_region(location):
+    if location is None:
+        return None
+    lat, lon = location
+    for region in PLANTNET_REGIONS:
+        lat_min, lat_max, lon_min, lon_max = region['bounds']
+        in_lon = lon_min <= lon <= lon_max if lon_min <= lon_max else (lon >= lon_min or lon <= lon_max)
+        if lat_min <= lat <= lat_max and in_lon:
+            return region
+    return None
+
+def plantnet_route(location):
+    """
+    The region covering location (or None) and the project an observation there is sent to first.
+    Cached identifications are keyed on this project, so a result is only reused for the same route.
+    """
+    region = plantnet_region(location)
+    return region, region['project'] if region is not None else PLANTNET_GLOBAL_PROJECT
+
+def route_region_label(region, location):
+    if region is not None:
+        return region['name']
+    return 'none' if location is None else 'unmapped'
+
+def record_cached_route(location, cached_project):
+    """
+    Count a cache or near-duplicate hit under the routing decision that produced the cached result.
+    """
+    region, project = plantnet_route(location)
+    if region is None:
+        outcome = 'global'
+    else:
+        outcome = 'regional' if cached_project == project else 'fallback'
+    PLANTNET_ROUTES.inc(region=route_region_label(region, location), project=project, outcome=outcome, source='cache')
+
+def post_plantnet(project, files_to_send):
+    started = time.perf_counter()
+    response = PLANTNET_LIMITER.call(
+        http_session().post,
+        PLANTNET_IDENTIFY_URL.format(project=project),
+        files=files_to_send,
+        params={"api-key": API_KEY},
+        timeout=45
+    )
+    PLANTNET_PROJECT_DURATION.observe(time.perf_counter() - started, project=project)
+    return response
+
+def identify_routed(files_to_send, location):
+    """
+    Send an observation to the regional project for location, if any, falling back to the global
+    project when the region has no confident match. Returns (response, project that answered).
+    """
+    region, project = plantnet_route(location)
+    if region is not None:
+        response = post_plantnet(project, files_to_send)
+        if response.status_code == 200:
+            result = response.json()
+            if max((r.get("score", 0) for r in result.get("results", [])), default=0) >= PLANTNET_REGION_MIN_SCORE:
+                PLANTNET_ROUTES.inc(region=region['name'], project=project, outcome='regional', source='plantnet')
+                return response, project
+            # The regional call still used quota
+            PLANTNET_LIMITER.update_quota(result.get("remainingIdentificationRequests"))
+        elif response.status_code != 404:
+            # Key, quota and server errors would fail the same way globally; 404 means no match
+            PLANTNET_ROUTES.inc(region=region['name'], project=project, outcome='error', source='plantnet')
+            return response, project
+        PLANTNET_ROUTES.inc(region=region['name'], project=project, outcome='fallback', source='plantnet')
+    else:
+        PLANTNET_ROUTES.inc(region=route_region_label(region, location), project=project, outcome='global', source='plantnet')
+    return post_plantnet(PLANTNET_GLOBAL_PROJECT, files_to_send), PLANTNET_GLOBAL_PROJECT
+
+# === PlantNet Identification ===
+MAX_IMAGES_PER_OBSERVATION = 5
+
+class IdentificationError(Exception):
+    """Raised when an identification cannot be completed; the message is safe to show to users."""
+    def __init__(self, message, status_code=None):
+        super().__init__(message)
+        self.status_code = status_code
+
+class ImageProcessingError(IdentificationError):
+    pass
+
+class ImageQualityError(IdentificationError):
+    pass
+
+# === Image Quality Gate ===
+# Thresholds apply to the 256px preview from process_image(); calibrated on plant_pics/
+MIN_IMAGE_SIDE = 64
+LOW_RESOLUTION_SIDE = 160
+BLUR_FAIL_VARIANCE = 110
+BLUR_WARN_VARIANCE = 300
+DARK_FAIL_MEAN, DARK_WARN_MEAN = 30, 55
+BRIGHT_FAIL_MEAN, BRIGHT_WARN_MEAN = 225, 200
+CLIPPED_FAIL_FRACTION, CLIPPED_WARN_FRACTION = 0.6, 0.35
+PLANT_FAIL_FRACTION, PLANT_WARN_FRACTION = 0.02, 0.15
+LAPLACIAN = ImageFilter.Kernel((3, 3), [0, 1, 0, 1, -4, 1, 0, 1, 0], scale=1, offset=128)
+# Lookup tables for the "plant-coloured" mask: yellow-brown to green-cyan hues (15-180 degrees)
+# that are saturated and not near-black. Applied with Image.point, so each mask is one C pass.
+PLANT_HUE_LUT = [255 if 11 <= v <= 128 else 0 for v in range(256)]
+PLANT_SATURATION_LUT = [255 if v >= 40 else 0 for v in range(256)]
+PLANT_VALUE_LUT = [255 if v >= 30 else 0 for v in range(256)]
+
+def assess_image_quality(preview, full_size):
+    """
+    Cheap checks on one preprocessed image: resolution, sharpness (variance of the Laplacian),
+    exposure and the fraction of plant-coloured pixels. All pixel work runs inside Pillow's C filters
+    and histograms. Returns (failures, warnings) as lists of user-facing messages.
+    """
+    failures, warnings = [], []
+    if min(full_size) < MIN_IMAGE_SIDE:
+        failures.append(f"is too small ({full_size[0]}×{full_size[1]} px). Upload a photo at least {MIN_IMAGE_SIDE} px on each side.")
+    elif min(full_size) < LOW_RESOLUTION_SIDE:
+        warnings.append(f"is low resolution ({full_size[0]}×{full_size[1]} px); a larger photo will give better matches.")
+    gray = preview.convert('L')
+    sharpness = ImageStat.Stat(gray.filter(LAPLACIAN)).var[0]
+    if sharpness < BLUR_FAIL_VARIANCE:
+        failures.append("looks blurry. Hold the camera steady and tap to focus on the leaves, flowers or bark.")
+    elif sharpness < BLUR_WARN_VARIANCE:
+        warnings.append("is slightly blurry; a sharper photo may improve the match.")
+    histogram = gray.histogram()
+    pixels = float(sum(histogram)) or 1.0
+    mean = ImageStat.Stat(gray).mean[0]
+    dark = sum(histogram[:16]) / pixels
+    bright = sum(histogram[240:]) / pixels
+    if mean < DARK_FAIL_MEAN or dark > CLIPPED_FAIL_FRACTION:
+        failures.append("is too dark. Retake it in daylight or with more light on the plant.")
+    elif mean > BRIGHT_FAIL_MEAN or bright > CLIPPED_FAIL_FRACTION:
+        failures.append("is overexposed. Avoid direct sun or flash glare on the plant.")
+    elif mean < DARK_WARN_MEAN or dark > CLIPPED_WARN_FRACTION:
+        warnings.append("is quite dark; better lighting may improve the match.")
+    elif mean > BRIGHT_WARN_MEAN or bright > CLIPPED_WARN_FRACTION:
+        warnings.append("is quite bright; some detail may be washed out.")
+    hue, saturation, value = preview.convert('HSV').split()
+    mask = ImageChops.darker(ImageChops.darker(hue.point(PLANT_HUE_LUT), saturation.point(PLANT_SATURATION_LUT)),
+                             value.point(PLANT_VALUE_LUT))
+    plant_fraction = ImageStat.Stat(mask).mean[0] / 255
+    if plant_fraction < PLANT_FAIL_FRACTION:
+        failures.append("doesn't seem to show a plant. Fill the frame with the leaves, flowers or bark.")
+    elif plant_fraction < PLANT_WARN_FRACTION:
+        warnings.append("shows little plant material; try filling more of the frame with the plant.")
+    return failures, warnings
+
+def upload_path(filename):
+    return os.path.join(UPLOAD_FOLDER, f"{uuid.uuid4().hex}_{secure_filename(filename) or 'upload.jpg'}")
+
+def identify_with_plantnet(file_storages, location=None):
+    """
+    Preprocess the uploaded images and send them to PlantNet as one observation, routed to the
+    regional project for location (lat, lon) when there is one.
+    Returns the decoded PlantNet response with its results sorted by score, or raises IdentificationError.
+    """
+    paths = []
+    try:
+        files_to_send = []
+        digest = hashlib.sha256()
+        image_hashes = []
+        quality_warnings = []
+        content_hashes = []
+        thumbnail_ids = []
+        previews = []
+        for f in file_storages:
+            path = upload_path(f.filename)
+            paths.append(path)
+            with stage_timer('preprocess'):
+                file_data = process_image(f, path, thumbnail_ids, previews)
+            if not file_data:
+                raise ImageProcessingError(f'Failed to process image file: {f.filename}')
+            with file_data:
+                image_bytes = file_data.read()
+            # Reject unusable photos before they cost PlantNet quota and enrichment calls
+            with stage_timer('quality'):
+                preview, full_size = previews[-1]
+                failures, warnings = assess_image_quality(preview, full_size)
+            if failures:
+                raise ImageQualityError(f"{f.filename} {failures[0]}", 422)
+            quality_warnings.extend(f"{f.filename} {w}" for w in warnings)
+            image_hashes.append(dhash(preview))
+            content_hashes.append(hashlib.sha256(image_bytes).hexdigest())
+            digest.update(bytes.fromhex(content_hashes[-1]))
+            files_to_send.append(('images', (f.filename, image_bytes, f.content_type)))
+        # A regional and a global identification of the same photos are different answers
+        _, route = plantnet_route(location)
+        identification_key = cache_key(digest.hexdigest(), route)
+        cached = SHARED_CACHE.get('identification', identification_key)
+        if cached is None:
+            # Re-cropped or re-compressed photos of an already identified specimen skip PlantNet
+            with stage_timer('similarity'):
+                cached = SIMILARITY_INDEX.lookup(image_hashes, route)
+        if cached is not None:
+            record_cached_route(location, cached.get("project"))
+            return dict(cached, qualityWarnings=quality_warnings, imageHashes=content_hashes, thumbnails=thumbnail_ids)
+        response, project = identify_routed(files_to_send, location)
+    except RateLimitExceeded:
+        raise IdentificationError('API rate limit exceeded. Please wait a moment before trying again.', 429)
+    except requests.exceptions.Timeout:
+        raise IdentificationError('Request timeout. The API is taking too long to respond. Please try again.')
+    except requests.exceptions.ConnectionError:
+        raise IdentificationError('Connection error. Please check your internet connection and try again.')
+    finally:
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
+    if response.status_code == 200:
+        result = response.json()
+        PLANTNET_LIMITER.update_quota(result.get("remainingIdentificationRequests"))
+        # Sort by confidence (score) descending
+        result["results"] = sorted(result.get("results", []), key=lambda r: r.get("score", 0), reverse=True)
+        result["project"] = project
+        # The quota figure is only meaningful for the call that fetched it
+        reusable = {k: v for k, v in result.items() if k != "remainingIdentificationRequests"}
+        SHARED_CACHE.set('identification', identification_key, reusable, IDENTIFICATION_TTL)
+        SIMILARITY_INDEX.add(image_hashes, reusable, route)
+        result["qualityWarnings"] = quality_warnings
+        result["imageHashes"] = content_hashes
+        result["thumbnails"] = thumbnail_ids
+        return result
+    elif response.status_code == 401:
+        raise IdentificationError('Invalid API key. Please check your PlantNet API key configuration.', 401)
+    elif response.status_code == 429:
+        raise IdentificationError('API rate limit exceeded. Please wait a moment before trying again.', 429)
+    elif response.status_code == 413:
+        raise IdentificationError('Image file too large. Please use smaller images (max 5MB).', 413)
+    raise IdentificationError(f'API Error {response.status_code}: {response.text}', response.status_code)
+
+def species_names(api_result):
+    species = api_result.get("species", {})
+    return {
+        'scientific_name': safe_get(species, "scientificNameWithoutAuthor", "Unknown Species"),
+        'common_names': species.get("commonNames", []),
+        'family_name': safe_get(species.get("family", {}), "scientificNameWithoutAuthor", "Unknown Family"),
+        'genus_name': safe_get(species.get("genus", {}), "scientificNameWithoutAuthor", "Unknown Genus"),
+    }
+
+def start_enrichment(api_result):
+    """
+    Queue the summary and education prompts for one result without waiting on them. Callers start
+    every result's enrichment before finishing any, so all the prompts land in the same LLM batches.
+    """
+    names = species_names(api_result)
+    return {
+        'summary': submit_gpt_summary(names['scientific_name'], names['common_names']),
+        'education': submit_species_education(names['scientific_name'], names['common_names']),
+    }
+
+def get_enrichment(scientific_name, common_names, pending):
+    gbif_coords = get_gbif_occurrences(scientific_name)
+    return {
+        'wiki_summary': collect_gpt_summary(scientific_name, pending['summary']),
+        'gbif_coords': gbif_coords,
+        'heatmap': get_occurrence_heatmap(scientific_name, gbif_coords),
+        'education': collect_species_education(scientific_name, pending['education']),
+    }
+
+def build_result_card(api_result, pending):
+    names = species_names(api_result)
+    # Always show high confidence (>= 80%)
+    score = min(80.0 + round(api_result.get("score", 0) * 20, 2), 100.0)
+    common_names = names['common_names']
+    enrichment = get_enrichment(names['scientific_name'], common_names, pending)
+    card = {
+        'scientific_name': names['scientific_name'],
+        'common_names': ', '.join(common_names[:3]) if common_names else 'Not available',
+        'family_name': names['family_name'],
+        'genus_name': names['genus_name'],
+        'confidence_class': 'confidence-high',
+        'confidence_str': f"🟢 {score:.1f}% (High Confidence)",
+    }
+    card.update(enrichment)
+    return card, score
+
+# Result fields the page's scripts read, by the short name used in the page data island
+PAGE_DATA_FIELDS = {'name': 'scientific_name', 'coords': 'gbif_coords'}
+# Occurrence points only drive map markers and a 100 km proximity check; 4 decimals is ~11 m
+PAGE_DATA_COORD_DIGITS = 4
+# Keep the island from closing its <script> element or opening an HTML comment
+PAGE_DATA_ESCAPES = str.maketrans({'<': '\\u003c', '>': '\\u003e', '&': '\\u0026', '\u2028': '\\u2028', '\u2029': '\\u2029'})
+
+def page_data(results):
+    """
+    Minified JSON embedded once in the results page (#page-data) for the card, map, comparison
+    and local-species scripts, carrying only PAGE_DATA_FIELDS with coordinates as [lat, lon] pairs.
+    """
+    items = []
+    for card in results or []:
+        item = {}
+        for name, field in PAGE_DATA_FIELDS.items():
+            value = card.get(field)
+            if field == 'gbif_coords':
+                value = [[round(pt['lat'], PAGE_DATA_COORD_DIGITS), round(pt['lon'], PAGE_DATA_COORD_DIGITS)] for pt in value or []]
+            item[name] = value
+        items.append(item)
+    return Markup(json.dumps({'results': items}, ensure_ascii=False, separators=(',', ':')).translate(PAGE_DATA_ESCAPES))
+
+def render_page(**context):
+    context.setdefault('idempotency_key', uuid.uuid4().hex)
+    context['page_data'] = page_data(context.get('results'))
+    context.update(upload_max_side=UPLOAD_MAX_SIDE, upload_jpeg_quality=UPLOAD_JPEG_QUALITY)
+    # Keys are scoped to the browser's owner id, so give it one before the form is first submitted
+    history_owner()
+    with stage_timer('render'):
+        return render_template_string(TEMPLATE, **context)
+
+def run_identification(file_storages, show_details=True, owner=None, observation_id=None, location=None):
+    """
+    Full identification pipeline for one observation: PlantNet plus enrichment of the top results.
+    The observation is recorded in the history store under owner.
+    Returns the page context stored as session['latest_results'], or None when nothing matched.
+    """
+    observation_id = observation_id or uuid.uuid4().hex
+    num_results = len(file_storages)
+    identification = identify_with_plantnet(file_storages, location)
+    api_results = identification["results"]
+    if not api_results:
+        return None
+    shown_results = min(len(api_results), num_results)
+    results = []
+    shown_scores = []
+    pending = [start_enrichment(r) for r in api_results[:shown_results]]
+    for r, enrichment in zip(api_results[:shown_results], pending):
+        with stage_timer('enrich'):
+            card, score = build_result_card(r, enrichment)
+        results.append(card)
+        shown_scores.append(score)
+    record_identification(observation_id, owner, identification, results)
+    return {
+        'observation_id': observation_id,
+        'results': results,
+        'shown_results': shown_results,
+        'warning': None,
+        'quality_warnings': identification.get("qualityWarnings", []),
+        'thumbnails': identification.get("thumbnails", []),
+        'show_details': show_details,
+        'total_matches': len(api_results),
+        'best_match': max(shown_scores) if shown_scores else 0,
+        'avg_confidence': round(sum(shown_scores) / len(shown_scores), 1) if shown_scores else 0,
+        'timestamp': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+        'num_uploaded': num_results
+    }
+
+# === Idempotent Submissions ===
+# Each render of the upload form carries a fresh idempotency_key (API clients may send an
+# Idempotency-Key header instead). A double-click or resubmit with the same key and the same
+# photos attaches to the original identification instead of running PlantNet and enrichment again.
+IDEMPOTENCY_WINDOW = int(os.environ.get('IDEMPOTENCY_WINDOW_SECONDS', 600))
+
+def submission_digest(owner, file_storages, show_details):
+    """
+    Scope for the request's idempotency key, or None when it has none. The owner and the upload
+    contents are part of it, so a key reused with other photos never replays the wrong results.
+    """
+    key = request.form.get('idempotency_key') or request.headers.get('Idempotency-Key')
+    if not key:
+        return None
+    contents = hashlib.sha256()
+    for f in file_storages:
+        contents.update(hashlib.sha256(f.read()).digest())
+        f.seek(0)
+    return cache_key('submission', owner, key[:128], int(bool(show_details)), plantnet_route(request_location())[1],
+                     contents.hexdigest())
+
+class IdempotentRuns:
+    """
+    In-flight and recently completed identifications by submission digest. In-flight runs are
+    tracked per process; completed results go to the shared cache so every worker can replay them.
+    Failed runs are not remembered, so resubmitting after an error tries again.
+    """
+    def __init__(self, window):
+        self.window = window
+        self.running = {}
+        self.lock = threading.Lock()
+
+    def run(self, digest, func, *args, **kwargs):
+        if digest is None:
+            return func(*args, **kwargs)
+        with self.lock:
+            future = self.running.get(digest)
+            attach = future is not None
+            if not attach:
+                future = self.running[digest] = Future()
+        if attach:
+            record_cache('idempotency', True)
+            return future.result()
+        try:
+            completed = SHARED_CACHE.get('idempotency', digest)
+            if completed is not None:
+                result = completed['result']
+            else:
+                result = func(*args, **kwargs)
+                SHARED_CACHE.set('idempotency', digest, {'result': result}, self.window)
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                self.running.pop(digest, None)
+
+IDEMPOTENT_RUNS = IdempotentRuns(IDEMPOTENCY_WINDOW)
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
@@ -1234,116 +2970,33 @@ def index():
         # Retrieve results from session and render page with results
         session_results = session.get('latest_results', None)
         if session_results:
-            return render_template_string(TEMPLATE, **session_results, comments=comments)
+            return render_page(**session_results, comments=comments)
         else:
             return redirect(url_for('index'))
     # --- Main identification logic ---
     if request.method == 'POST' and 'comment_scientific_name' not in request.form:
         files = request.files.getlist('image1')
-        num_results = len(files)
         show_details = 'show_details' in request.form
         if not files or not files[0].filename:
             flash('Primary image is required.')
             return redirect(url_for('index'))
         try:
-            files_to_send = []
-            for f in files:
-                file_data = process_image(f, os.path.join(UPLOAD_FOLDER, f.filename))
-                if file_data:
-                    files_to_send.append(('images', (f.filename, file_data, f.content_type)))
-                else:
-                    # Remove flash message to user, keep error logging only
-                    # flash(f'Failed to process image file: {f.filename}')
-                    return redirect(url_for('index'))
-
-            params = {"api-key": API_KEY}
-            response = requests.post(
-                API_URL,
-                files=files_to_send,
-                params=params,
-                timeout=45
-            )
-            for filename in [os.path.join(UPLOAD_FOLDER, f.filename) for f in files]:
-                if os.path.exists(filename):
-                    os.remove(filename)
-            if response.status_code == 200:
-                result = response.json()
-                api_results = result.get("results", [])
-                # Sort by confidence (score) descending
-                api_results = sorted(api_results, key=lambda r: r.get("score", 0), reverse=True)
-                if api_results:
-                    shown_results = min(len(api_results), num_results)
-                    shown_scores = []
-                    for r in api_results[:shown_results]:
-                        species = r.get("species", {})
-                        # Always show high confidence (>= 80%)
-                        score = 80.0 + (round(r.get("score", 0) * 20, 2))  # Always >= 80%
-                        if score > 100:
-                            score = 100.0
-                        shown_scores.append(score)
-                        scientific_name = safe_get(species, "scientificNameWithoutAuthor", "Unknown Species")
-                        common_names = species.get("commonNames", [])
-                        family_info = species.get("family", {})
-                        genus_info = species.get("genus", {})
-                        family_name = safe_get(family_info, "scientificNameWithoutAuthor", "Unknown Family")
-                        genus_name = safe_get(genus_info, "scientificNameWithoutAuthor", "Unknown Genus")
-                        confidence_class = 'confidence-high'
-                        common_names_str = ', '.join(common_names[:3]) if common_names else 'Not available'
-                        # Wikipedia summary lookup (improved)
-                        wiki_summary = get_wikipedia_summary(scientific_name, common_names)
-                        # GBIF occurrence coordinates
-                        gbif_coords = get_gbif_occurrences(scientific_name)
-                        # Educational content
-                        education = get_species_education(scientific_name, common_names)
-                        results.append({
-                            'scientific_name': scientific_name,
-                            'common_names': common_names_str,
-                            'family_name': family_name,
-                            'genus_name': genus_name,
-                            'confidence_class': confidence_class,
-                            'confidence_str': f"🟢 {score:.1f}% (High Confidence)",
-                            'wiki_summary': wiki_summary,
-                            'gbif_coords': gbif_coords,
-                            'education': education
-                        })
-                    total_matches = len(api_results)
-                    best_match = max(shown_scores) if shown_scores else 0
-                    avg_confidence = round(sum(shown_scores) / len(shown_scores), 1) if shown_scores else 0
-                    timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                    comments = session.get('comments', {})
-                    latest_results = {
-                        'results': results,
-                        'shown_results': shown_results,
-                        'warning': warning,
-                        'show_details': show_details,
-                        'total_matches': total_matches,
-                        'best_match': best_match,
-                        'avg_confidence': avg_confidence,
-                        'timestamp': timestamp,
-                        'num_uploaded': num_results
-                    }
-                    session['latest_results'] = latest_results
-                    return render_template_string(TEMPLATE, **latest_results, comments=comments)
-                else:
-                    warning = "🤔 No species matches found. This could be due to image quality issues, unusual plant species, or unclear plant parts. Try uploading clearer images or different plant parts."
-                    return redirect(url_for('index'))
-            elif response.status_code == 401:
-                flash('Invalid API key. Please check your PlantNet API key configuration.')
-                return redirect(url_for('index'))
-            elif response.status_code == 429:
-                flash('API rate limit exceeded. Please wait a moment before trying again.')
-                return redirect(url_for('index'))
-            elif response.status_code == 413:
-                flash('Image file too large. Please use smaller images (max 5MB).')
-                return redirect(url_for('index'))
+            owner = history_owner()
+            digest = submission_digest(owner, files, show_details)
+            latest_results = IDEMPOTENT_RUNS.run(digest, run_identification, files, show_details, owner=owner,
+                                                 location=request_location())
+            if latest_results:
+                comments = session.get('comments', {})
+                session['latest_results'] = latest_results
+                return render_page(**latest_results, comments=comments)
             else:
-                flash(f'API Error {response.status_code}: {response.text}')
+                warning = "🤔 No species matches found. This could be due to image quality issues, unusual plant species, or unclear plant parts. Try uploading clearer images or different plant parts."
                 return redirect(url_for('index'))
-        except requests.exceptions.Timeout:
-            flash('Request timeout. The API is taking too long to respond. Please try again.')
+        except ImageProcessingError:
+            # Processing failures are logged by process_image only
             return redirect(url_for('index'))
-        except requests.exceptions.ConnectionError:
-            flash('Connection error. Please check your internet connection and try again.')
+        except IdentificationError as e:
+            flash(str(e))
             return redirect(url_for('index'))
         except Exception as e:
             flash(f'Unexpected error: {str(e)}')
@@ -1352,65 +3005,1166 @@ def index():
     comments = session.get('comments', {})
     session_results = session.get('latest_results', None)
     if session_results:
-        return render_template_string(TEMPLATE, **session_results, comments=comments)
-    return render_template_string(TEMPLATE, results=results, shown_results=shown_results, warning=warning, show_details=show_details, total_matches=total_matches, best_match=best_match, avg_confidence=avg_confidence, timestamp=timestamp, comments=comments)
+        return render_page(**session_results, comments=comments)
+    return render_page(results=results, shown_results=shown_results, warning=warning, show_details=show_details, total_matches=total_matches, best_match=best_match, avg_confidence=avg_confidence, timestamp=timestamp, comments=comments)
 
-@app.route('/compare', methods=['POST'])
-def compare_species():
-    import json
-    idx1 = int(request.form.get('idx1'))
-    idx2 = int(request.form.get('idx2'))
+def get_comparison_pair():
+    try:
+        idx1 = int(request.form.get('idx1'))
+        idx2 = int(request.form.get('idx2'))
+    except (TypeError, ValueError):
+        return None
     results = session.get('latest_results', {}).get('results', [])
     if 0 <= idx1 < len(results) and 0 <= idx2 < len(results):
-        species1 = results[idx1]
-        species2 = results[idx2]
-        table_html = get_gpt_comparison(species1, species2)
-        return table_html
+        return results[idx1], results[idx2]
+    return None
+
+@app.route('/compare', methods=['POST'])
+def compare_species():
+    pair = get_comparison_pair()
+    if pair:
+        return render_comparison_table(*pair)
     return "<div style='color:#ffe066;'>Invalid comparison selection.</div>"
 
+@app.route('/compare/differences', methods=['POST'])
+def compare_differences():
+    pair = get_comparison_pair()
+    if pair and request.args.get('stream'):
+        def events():
+            # Flush a comment straight away so the browser gets its first byte before the upstream does
+            yield ": stream open\n\n"
+            for chunk in stream_gpt_key_differences(*pair):
+                yield f"data: {json.dumps({'text': chunk})}\n\n"
+            yield "event: done\ndata: {}\n\n"
+        return Response(stream_with_context(events()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    if pair:
+        differences = get_gpt_key_differences(*pair)
+        if differences:
+            return render_template_string("<strong>🔍 Key Differences:</strong> {{ text }}", text=differences)
+    return ""
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    lines.append("# HELP upstream_limiter_state Client-side limiter state per upstream.")
+    lines.append("# TYPE upstream_limiter_state gauge")
+    for limiter in (PLANTNET_LIMITER, OPENAI_LIMITER):
+        for field, value in limiter.snapshot().items():
+            if value is not None:
+                lines.append(f"upstream_limiter_state{format_labels((('field', field), ('upstream', limiter.name)))} {value}")
+    lines.append("# HELP admission_state Admission control slots per route (in flight, waiting, limit).")
+    lines.append("# TYPE admission_state gauge")
+    for route, state in ADMISSION.snapshot().items():
+        for field, value in state.items():
+            lines.append(f"admission_state{format_labels((('field', field), ('route', route)))} {value}")
+    if KNOWLEDGE_PACK.mm is not None:
+        lines.append("# HELP knowledge_pack_species Species in the loaded knowledge pack, labelled with the pack version.")
+        lines.append("# TYPE knowledge_pack_species gauge")
+        lines.append(f"knowledge_pack_species{format_labels((('version', KNOWLEDGE_PACK.metadata.get('version', '')),))} {KNOWLEDGE_PACK.count}")
+    index_size = SIMILARITY_INDEX.size()
+    if index_size is not None:
+        lines.append("# HELP similarity_index_observations Observations stored in the near-duplicate image index.")
+        lines.append("# TYPE similarity_index_observations gauge")
+        lines.append(f"similarity_index_observations {index_size}")
+    return Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
+
+@app.route('/thumbs/<thumb_id>', methods=['GET'])
+def thumbnail(thumb_id):
+    # Content-addressed, so a URL never changes meaning and can be cached forever
+    if not re.fullmatch(r'[0-9a-f]{32}', thumb_id):
+        return jsonify({'error': 'Not found.'}), 404
+    path = THUMBNAIL_STORE.get(thumb_id)
+    if path is None:
+        return jsonify({'error': 'Not found.'}), 404
+    response = send_from_directory(os.path.abspath(THUMBNAIL_FOLDER), os.path.basename(path), max_age=365 * 24 * 3600)
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return response
+
+@app.route('/heatmaps/<name>', methods=['GET'])
+def heatmap_image(name):
+    if not re.fullmatch(r'[a-z0-9_]+\.png', name):
+        return jsonify({'error': 'Not found.'}), 404
+    # Re-rendered only when missing, so browsers can keep a copy for a day
+    return send_from_directory(os.path.abspath(HEATMAP_FOLDER), name, max_age=24 * 3600)
+
 # Backend endpoint for AI local species check
 @app.route('/check_local_species', methods=['POST'])
 def check_local_species():
-    import json
     data = request.get_json()
     lat = data.get('lat')
     lon = data.get('lon')
     species_list = data.get('species', [])
     results = []
+    # Submit every species at once so they share a batch
+    futures = []
     for sci_name in species_list:
         prompt = (
             f"Given the user's coordinates (lat: {lat}, lon: {lon}), is the species '{sci_name}' found within 100 kilometers of this location? "
             "Answer only 'yes' or 'no'. If you are not sure, answer 'no'."
         )
-        openai_url = "https://api.openai.com/v1/chat/completions"
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {OPENAI_API_KEY}"
-        }
-        payload = {
-            "model": "gpt-3.5-turbo",
-            "messages": [
-                {"role": "system", "content": "You are a helpful plant expert."},
-                {"role": "user", "content": prompt}
-            ],
-            "max_tokens": 5,
-            "temperature": 0
-        }
+        futures.append(LLM_BATCHER.submit(prompt, max_tokens=5, temperature=0))
+    for future in futures:
         try:
-            resp = requests.post(openai_url, headers=headers, json=payload, timeout=10)
-            if resp.status_code == 200:
-                answer = resp.json()["choices"][0]["message"]["content"].strip().lower()
-                if answer.startswith('yes'):
-                    results.append('yes')
-                else:
-                    results.append('no')
+            answer = batch_result(future, timeout=10).strip().lower()
+            if answer.startswith('yes'):
+                results.append('yes')
             else:
                 results.append('no')
+        except ChatCompletionError:
+            results.append('no')
         except Exception as e:
             print(f"[check_local_species] Exception: {e}")
             results.append('no')
     return json.dumps({'results': results})
 
+# === JSON Identification API ===
+API_MAX_OBSERVATIONS = 20
+API_BATCH_CONCURRENCY = 4
+
+def api_species_result(api_result, enrichment=None):
+    names = species_names(api_result)
+    item = {
+        'scientific_name': names['scientific_name'],
+        'common_names': names['common_names'],
+        'family': names['family_name'],
+        'genus': names['genus_name'],
+        'score': api_result.get("score", 0),
+    }
+    if enrichment:
+        item['enrichment'] = {
+            'summary': enrichment['wiki_summary'],
+            'fun_fact': enrichment['education']['fun_fact'],
+            'care_tip': enrichment['education']['care_tip'],
+            'occurrences': enrichment['gbif_coords'],
+        }
+    return item
+
+def enriched_card(api_result, pending):
+    names = species_names(api_result)
+    card = {'scientific_name': names['scientific_name']}
+    card.update(get_enrichment(names['scientific_name'], names['common_names'], pending))
+    return card
+
+def identify_observation(observation_id, file_storages, max_results, enrich, location=None, owner=None):
+    """
+    Identify one API or bulk observation. Matches are recorded in the history store under owner
+    with a fresh history_id, since client observation ids are only unique within one request or run.
+    """
+    if len(file_storages) > MAX_IMAGES_PER_OBSERVATION:
+        return {'id': observation_id, 'status': 'error',
+                'error': f'At most {MAX_IMAGES_PER_OBSERVATION} images are allowed per observation.'}
+    try:
+        result = identify_with_plantnet(file_storages, location)
+        api_results = result["results"]
+        shown = api_results[:max_results]
+        cards = [None] * len(shown)
+        if enrich:
+            pending = [start_enrichment(r) for r in shown]
+            cards = [enriched_card(r, p) for r, p in zip(shown, pending)]
+        history_id = None
+        if api_results:
+            history_id = uuid.uuid4().hex
+            record_identification(history_id, owner, result, [card for card in cards if card])
+        return {
+            'id': observation_id,
+            'status': 'ok',
+            'history_id': history_id,
+            'total_matches': len(api_results),
+            'results': [api_species_result(r, card) for r, card in zip(shown, cards)],
+            'remaining_identification_requests': result.get("remainingIdentificationRequests"),
+            'project': result.get("project"),
+            'quality_warnings': result.get("qualityWarnings", []),
+        }
+    except IdentificationError as e:
+        return {'id': observation_id, 'status': 'error', 'error': str(e), 'upstream_status': e.status_code}
+    except Exception as e:
+        print(f"[identify_observation] Exception for {observation_id}: {e}")
+        return {'id': observation_id, 'status': 'error', 'error': f'Unexpected error: {str(e)}'}
+
+@app.route('/api/v1/identify', methods=['POST'])
+def api_identify():
+    """
+    Identify one or more observations. Each multipart file field is one observation
+    (e.g. images=..., or obs1=...&obs2=... for a batch) holding up to 5 images.
+    Optional form/query fields: enrich=1 for summaries, facts and occurrences, max_results (default 5),
+    lat and lon to route to a regional PlantNet project.
+    """
+    observations = {}
+    for field, file_storage in request.files.items(multi=True):
+        if file_storage.filename:
+            observations.setdefault(field, []).append(file_storage)
+    if not observations:
+        return jsonify({'error': 'No images uploaded.'}), 400
+    if len(observations) > API_MAX_OBSERVATIONS:
+        return jsonify({'error': f'At most {API_MAX_OBSERVATIONS} observations are allowed per request.'}), 400
+    enrich = request.values.get('enrich', '').lower() in ('1', 'true', 'yes')
+    try:
+        max_results = max(1, int(request.values.get('max_results', 5)))
+    except ValueError:
+        return jsonify({'error': 'max_results must be an integer.'}), 400
+    location = request_location()
+    owner = history_owner()
+    with ThreadPoolExecutor(max_workers=min(API_BATCH_CONCURRENCY, len(observations))) as pool:
+        futures = [pool.submit(identify_observation, obs_id, files, max_results, enrich, location, owner)
+                   for obs_id, files in observations.items()]
+        results = [future.result() for future in futures]
+    return jsonify({'observations': results})
+
+# === Admission Control ===
+# Expensive routes take a slot before they run. Each route has its own concurrency limit and a
+# short bounded wait queue; when both are full (or the wait runs past max_wait) the request is shed
+# straight away with a 503 and Retry-After instead of piling up behind the upstream limiters.
+# Limits are per process, so with gunicorn the effective totals scale with WEB_WORKERS.
+ADMISSION_CAPACITY = int(os.environ.get('ADMISSION_CAPACITY', 16))
+# Slots that only high-priority routes (identifications) may use
+ADMISSION_RESERVE = int(os.environ.get('ADMISSION_RESERVE', 4))
+PRIORITY_HIGH = 0
+PRIORITY_LOW = 1
+ADMISSION_DURATION_ALPHA = 0.2
+ADMISSION_MAX_RETRY_AFTER = 60
+
+class Overloaded(Exception):
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class AdmissionPolicy:
+    def __init__(self, name, priority, limit, queue_size, max_wait, expected_duration):
+        self.name = name
+        self.priority = priority
+        self.limit = limit
+        self.queue_size = queue_size
+        self.max_wait = max_wait
+        # EWMA of how long an admitted request holds its slot, used for Retry-After
+        self.avg_duration = expected_duration
+        self.in_flight = 0
+        self.waiting = 0
+
+class AdmissionController:
+    """
+    Shared slot pool for expensive routes. A request runs when its route is under its limit and
+    the pool has a free slot (low-priority routes cannot use the last `reserve` slots). Waiters
+    are served in priority order, then arrival order.
+    """
+    def __init__(self, capacity, reserve, policies):
+        self.capacity = capacity
+        self.reserve = min(reserve, capacity - 1)
+        self.policies = {policy.name: policy for policy in policies}
+        self.in_flight = 0
+        self.waiters = []
+        self.tickets = 0
+        self.cond = threading.Condition()
+
+    def _can_run(self, policy):
+        capacity = self.capacity if policy.priority == PRIORITY_HIGH else self.capacity - self.reserve
+        return policy.in_flight < policy.limit and self.in_flight < capacity
+
+    def _next_in_line(self, ticket):
+        # The first waiter (by priority, then arrival) that could run now
+        for waiter in sorted(self.waiters):
+            if self._can_run(waiter[2]):
+                return waiter[1] == ticket
+        return False
+
+    def retry_after(self, policy):
+        backlog = (policy.in_flight + policy.waiting + 1) / max(policy.limit, 1)
+        return max(1, min(ADMISSION_MAX_RETRY_AFTER, int(backlog * policy.avg_duration + 0.999)))
+
+    def acquire(self, name):
+        """Take a slot for route `name`; returns (started, waited) or raises Overloaded."""
+        policy = self.policies[name]
+        with self.cond:
+            self.tickets += 1
+            waiter = (policy.priority, self.tickets, policy)
+            self.waiters.append(waiter)
+            waited = False
+            try:
+                if not self._next_in_line(waiter[1]):
+                    if policy.waiting >= policy.queue_size:
+                        raise Overloaded("queue full", self.retry_after(policy))
+                    waited = True
+                    policy.waiting += 1
+                    deadline = time.monotonic() + policy.max_wait
+                    try:
+                        while not self._next_in_line(waiter[1]):
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                raise Overloaded("timed out waiting for a slot", self.retry_after(policy))
+                            self.cond.wait(remaining)
+                    finally:
+                        policy.waiting -= 1
+                policy.in_flight += 1
+                self.in_flight += 1
+                return time.monotonic(), waited
+            finally:
+                self.waiters.remove(waiter)
+                if waited:
+                    # Whoever is next in line may be able to run now that this waiter is gone
+                    self.cond.notify_all()
+
+    def release(self, name, started):
+        policy = self.policies[name]
+        duration = time.monotonic() - started
+        with self.cond:
+            policy.in_flight -= 1
+            self.in_flight -= 1
+            policy.avg_duration += ADMISSION_DURATION_ALPHA * (duration - policy.avg_duration)
+            self.cond.notify_all()
+
+    def snapshot(self):
+        with self.cond:
+            return {name: {'in_flight': p.in_flight, 'waiting': p.waiting, 'limit': p.limit}
+                    for name, p in self.policies.items()}
+
+ADMISSION = AdmissionController(ADMISSION_CAPACITY, ADMISSION_RESERVE, [
+    AdmissionPolicy('identify', PRIORITY_HIGH,
+                    limit=int(os.environ.get('ADMISSION_IDENTIFY_LIMIT', 12)),
+                    queue_size=int(os.environ.get('ADMISSION_IDENTIFY_QUEUE', 24)),
+                    max_wait=float(os.environ.get('ADMISSION_IDENTIFY_MAX_WAIT', 15)),
+                    expected_duration=5.0),
+    AdmissionPolicy('compare', PRIORITY_LOW,
+                    limit=int(os.environ.get('ADMISSION_COMPARE_LIMIT', 4)),
+                    queue_size=int(os.environ.get('ADMISSION_COMPARE_QUEUE', 4)),
+                    max_wait=float(os.environ.get('ADMISSION_COMPARE_MAX_WAIT', 3)),
+                    expected_duration=3.0),
+    AdmissionPolicy('check_local', PRIORITY_LOW,
+                    limit=int(os.environ.get('ADMISSION_CHECK_LOCAL_LIMIT', 2)),
+                    queue_size=int(os.environ.get('ADMISSION_CHECK_LOCAL_QUEUE', 4)),
+                    max_wait=float(os.environ.get('ADMISSION_CHECK_LOCAL_MAX_WAIT', 3)),
+                    expected_duration=3.0),
+])
+
+OVERLOADED_MESSAGE = "🌿 The identifier is very busy right now. Please try again in a few seconds."
+
+def admission_route():
+    """Admission policy for the current request, or None for routes that are not gated."""
+    endpoint = request.endpoint
+    if endpoint == 'index':
+        # Comment posts are urlencoded; only uploads run an identification
+        return 'identify' if request.method == 'POST' and request.mimetype == 'multipart/form-data' else None
+    return {
+        'api_identify': 'identify',
+        # Enqueuing is cheap, but shedding here keeps the queue from growing while the process is saturated
+        'submit_job': 'identify',
+        'compare_species': 'compare',
+        'compare_differences': 'compare',
+        'check_local_species': 'check_local',
+    }.get(endpoint)
+
+def overloaded_response(route, retry_after):
+    headers = {'Retry-After': str(retry_after)}
+    if request.endpoint == 'index':
+        return render_page(results=[], shown_results=0, warning=OVERLOADED_MESSAGE, show_details=True, total_matches=0,
+                           best_match=0, avg_confidence=0, timestamp=None, comments=session.get('comments', {})), 503, headers
+    if route == 'compare':
+        return f"<div style='color:#ffe066;'>{OVERLOADED_MESSAGE}</div>", 503, headers
+    return jsonify({'error': OVERLOADED_MESSAGE, 'retry_after': retry_after}), 503, headers
+
+@app.before_request
+def admit_request():
+    route = admission_route()
+    if route is None:
+        return None
+    queued = time.perf_counter()
+    try:
+        started, waited = ADMISSION.acquire(route)
+    except Overloaded as e:
+        ADMISSIONS.inc(route=route, outcome='rejected')
+        print(f"[admission] Shed {request.method} {request.path} ({route}: {e}), retry after {e.retry_after}s")
+        return overloaded_response(route, e.retry_after)
+    ADMISSIONS.inc(route=route, outcome='queued' if waited else 'admitted')
+    if waited:
+        add_server_timing('admission-queue', time.perf_counter() - queued)
+    g.admission = (route, started)
+    return None
+
+@app.teardown_request
+def release_admission(exc):
+    # Streamed responses keep the request context (and the slot) until the stream ends
+    admission = g.pop('admission', None)
+    if admission is not None:
+        ADMISSION.release(*admission)
+
+# === Request Profiling ===
+# Opt-in: sample a fraction of requests (PROFILE_SAMPLE_RATE) or send X-Profile-Token (or ?profile_token=)
+# matching PROFILE_TOKEN
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_KEEP = 200
+PROFILE_PAGE_SIZE = 50
+PROFILE_SKIP_PREFIXES = ('/static/', '/metrics', '/profiles')
+# Query parameters carrying credentials, left out of the request line written to profiles
+PROFILE_REDACTED_ARGS = ('profile_token', 'admin_token')
+# tracemalloc and cProfile are process-wide, so only one request is captured at a time
+_profile_lock = threading.Lock()
+
+def has_profile_token():
+    token = request.headers.get('X-Profile-Token') or request.args.get('profile_token')
+    return bool(PROFILE_TOKEN) and token == PROFILE_TOKEN
+
+def should_profile():
+    if request.path.startswith(PROFILE_SKIP_PREFIXES):
+        return False
+    if 'X-Profile-Token' in request.headers or 'profile_token' in request.args:
+        return has_profile_token()
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+@app.before_request
+def start_profiling():
+    if not should_profile() or not _profile_lock.acquire(blocking=False):
+        return
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    profiler = cProfile.Profile()
+    g.profile = {'profiler': profiler, 'started_tracing': started_tracing, 'started': time.perf_counter()}
+    profiler.enable()
+
+def stop_profiling():
+    state = g.pop('profile', None)
+    if state is None:
+        return None
+    try:
+        state['profiler'].disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if state['started_tracing']:
+            tracemalloc.stop()
+        state.update(snapshot=snapshot, current=current, peak=peak, duration=time.perf_counter() - state['started'])
+        return state
+    finally:
+        _profile_lock.release()
+
+def profiled_path():
+    args = [(k, v) for k, v in request.args.items(multi=True) if k not in PROFILE_REDACTED_ARGS]
+    return f"{request.path}?{urlencode(args)}" if args else request.path
+
+def write_profile(state, response):
+    profile_id = f"{datetime.now().strftime('%Y%m%dT%H%M%S')}-{uuid.uuid4().hex[:8]}"
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    prof_path = os.path.join(PROFILE_DIR, f"{profile_id}.prof")
+    state['profiler'].dump_stats(prof_path)
+    summary = io.StringIO()
+    summary.write(f"{request.method} {profiled_path()} -> {response.status_code} "
+                  f"in {state['duration'] * 1000:.1f} ms, peak traced memory {state['peak'] / 1024:.1f} KiB\n\n")
+    summary.write("=== Top functions by cumulative time ===\n")
+    stats = pstats.Stats(state['profiler'], stream=summary)
+    stats.sort_stats('cumulative').print_stats(30)
+    summary.write("=== Top allocation sites (live at end of request) ===\n")
+    snapshot = state['snapshot'].filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+    for stat in snapshot.statistics('lineno')[:25]:
+        summary.write(f"{stat.size / 1024:10.1f} KiB {stat.count:8d} blocks  {stat.traceback}\n")
+    with open(os.path.join(PROFILE_DIR, f"{profile_id}.txt"), 'w', encoding='utf-8') as fh:
+        fh.write(summary.getvalue())
+    entry = {
+        'id': profile_id,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'method': request.method,
+        'path': request.path,
+        'status': response.status_code,
+        'duration_ms': round(state['duration'] * 1000, 1),
+        'peak_memory_bytes': state['peak'],
+        'request_bytes': request.content_length or 0,
+    }
+    with open(os.path.join(PROFILE_DIR, 'index.jsonl'), 'a', encoding='utf-8') as fh:
+        fh.write(json.dumps(entry) + '\n')
+    prune_profiles()
+    return profile_id
+
+def read_profile_index():
+    path = os.path.join(PROFILE_DIR, 'index.jsonl')
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as fh:
+        return [json.loads(line) for line in fh if line.strip()]
+
+def prune_profiles():
+    entries = read_profile_index()
+    if len(entries) <= PROFILE_KEEP:
+        return
+    for entry in entries[:-PROFILE_KEEP]:
+        for ext in ('.prof', '.txt'):
+            path = os.path.join(PROFILE_DIR, entry['id'] + ext)
+            if os.path.exists(path):
+                os.remove(path)
+    with open(os.path.join(PROFILE_DIR, 'index.jsonl'), 'w', encoding='utf-8') as fh:
+        fh.writelines(json.dumps(entry) + '\n' for entry in entries[-PROFILE_KEEP:])
+
+@app.after_request
+def finish_profiling(response):
+    state = stop_profiling()
+    if state is not None:
+        try:
+            response.headers['X-Profile-Id'] = write_profile(state, response)
+        except Exception as e:
+            print(f"[finish_profiling] Could not write profile: {e}")
+    return response
+
+@app.teardown_request
+def abandon_profiling(exc):
+    # Unhandled exceptions skip after_request; make sure the profiler is stopped and the lock released
+    if 'profile' in g:
+        stop_profiling()
+
+@app.route('/profiles', methods=['GET'])
+def list_profiles():
+    if not has_profile_token():
+        return jsonify({'error': 'Not found.'}), 404
+    try:
+        limit = max(1, min(int(request.args.get('limit', PROFILE_PAGE_SIZE)), PROFILE_KEEP))
+    except ValueError:
+        limit = PROFILE_PAGE_SIZE
+    return jsonify({'profiles': read_profile_index()[::-1][:limit]})
+
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def show_profile(profile_id):
+    if not has_profile_token() or not re.fullmatch(r'[0-9T]+-[0-9a-f]{8}(\.prof)?', profile_id):
+        return jsonify({'error': 'Not found.'}), 404
+    if profile_id.endswith('.prof'):
+        return send_from_directory(os.path.abspath(PROFILE_DIR), profile_id, mimetype='application/octet-stream', as_attachment=True)
+    return send_from_directory(os.path.abspath(PROFILE_DIR), f"{profile_id}.txt", mimetype='text/plain')
+
+# === Background Identification Jobs ===
+JOBS_DB = os.environ.get('JOBS_DB', 'jobs.sqlite3')
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+MAX_QUEUED_JOBS = int(os.environ.get('MAX_QUEUED_JOBS', 50))
+JOB_MAX_ATTEMPTS = 3
+JOB_RETENTION_SECONDS = 24 * 3600
+# Jobs still 'running' after this long belong to a worker that died and are requeued
+# (or failed, once they have used up JOB_MAX_ATTEMPTS)
+JOB_STALE_SECONDS = 300
+JOB_CRASHED_MESSAGE = 'The identification stopped unexpectedly. Please try again with different photos.'
+_job_workers_started = False
+_job_workers_lock = threading.Lock()
+_job_wakeup = threading.Event()
+
+def jobs_db():
+    conn = sqlite3.connect(JOBS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_jobs_db():
+    with closing(jobs_db()) as conn, conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY,
+                status TEXT NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                show_details INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL,
+                available_at REAL NOT NULL,
+                result TEXT,
+                error TEXT,
+                owner TEXT,
+                idempotency_key TEXT,
+                lat REAL,
+                lon REAL
+            )""")
+        columns = {row['name'] for row in conn.execute("PRAGMA table_info(jobs)")}
+        for column, column_type in (('owner', 'TEXT'), ('idempotency_key', 'TEXT'), ('lat', 'REAL'), ('lon', 'REAL')):
+            if column not in columns:
+                conn.execute(f"ALTER TABLE jobs ADD COLUMN {column} {column_type}")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_status_available ON jobs (status, available_at)")
+        conn.execute("CREATE INDEX IF NOT EXISTS jobs_idempotency_key ON jobs (idempotency_key)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS job_images (
+                job_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                filename TEXT NOT NULL,
+                content_type TEXT,
+                data BLOB NOT NULL,
+                PRIMARY KEY (job_id, position)
+            )""")
+
+def enqueue_job(file_storages, show_details, owner=None, digest=None, location=None):
+    """
+    Persist the uploads as a queued job and return its id, or None when the queue is full.
+    A submission with the same digest (see submission_digest) as a recent job that has not
+    failed gets that job's id back instead of a new job.
+    """
+    now = time.time()
+    job_id = uuid.uuid4().hex
+    images = [(f.filename, f.content_type, f.read()) for f in file_storages]
+    with closing(jobs_db()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if digest is not None:
+            existing = conn.execute(
+                "SELECT id FROM jobs WHERE idempotency_key = ? AND status != 'failed' AND created_at > ? ORDER BY created_at DESC LIMIT 1",
+                (digest, now - IDEMPOTENCY_WINDOW)).fetchone()
+            record_cache('idempotency', existing is not None)
+            if existing is not None:
+                return existing['id']
+        conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated_at < ?", (now - JOB_RETENTION_SECONDS,))
+        pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued', 'running')").fetchone()[0]
+        if pending >= MAX_QUEUED_JOBS:
+            return None
+        lat, lon = location or (None, None)
+        conn.execute("INSERT INTO jobs (id, status, show_details, created_at, updated_at, available_at, owner, idempotency_key, lat, lon) VALUES (?, 'queued', ?, ?, ?, ?, ?, ?, ?, ?)",
+                     (job_id, int(show_details), now, now, now, owner, digest, lat, lon))
+        conn.executemany("INSERT INTO job_images (job_id, position, filename, content_type, data) VALUES (?, ?, ?, ?, ?)",
+                         [(job_id, i, name, content_type, data) for i, (name, content_type, data) in enumerate(images)])
+    _job_wakeup.set()
+    return job_id
+
+def claim_job():
+    now = time.time()
+    with closing(jobs_db()) as conn, conn:
+        conn.execute("BEGIN IMMEDIATE")
+        # A job that keeps killing its worker (OOM, a crash in a decoder) must not be requeued forever
+        stale = conn.execute("SELECT id, attempts FROM jobs WHERE status = 'running' AND updated_at < ?",
+                             (now - JOB_STALE_SECONDS,)).fetchall()
+        for job in stale:
+            if job['attempts'] >= JOB_MAX_ATTEMPTS:
+                conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated_at = ? WHERE id = ?",
+                             (JOB_CRASHED_MESSAGE, now, job['id']))
+                conn.execute("DELETE FROM job_images WHERE job_id = ?", (job['id'],))
+            else:
+                conn.execute("UPDATE jobs SET status = 'queued', updated_at = ? WHERE id = ?", (now, job['id']))
+        row = conn.execute("SELECT * FROM jobs WHERE status = 'queued' AND available_at <= ? ORDER BY created_at LIMIT 1", (now,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE jobs SET status = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?", (now, row['id']))
+        images = conn.execute("SELECT filename, content_type, data FROM job_images WHERE job_id = ? ORDER BY position", (row['id'],)).fetchall()
+    return dict(row, attempts=row['attempts'] + 1), images
+
+def finish_job(job_id, status, result=None, error=None, retry_in=None):
+    now = time.time()
+    with closing(jobs_db()) as conn, conn:
+        if retry_in is not None:
+            conn.execute("UPDATE jobs SET status = 'queued', error = ?, updated_at = ?, available_at = ? WHERE id = ?",
+                         (error, now, now + retry_in, job_id))
+            return
+        conn.execute("UPDATE jobs SET status = ?, result = ?, error = ?, updated_at = ? WHERE id = ?",
+                     (status, json.dumps(result) if result is not None else None, error, now, job_id))
+        conn.execute("DELETE FROM job_images WHERE job_id = ?", (job_id,))
+
+def is_retryable(error):
+    # Timeouts and connection errors carry no status; 429 and 5xx are transient
+    return error.status_code is None or error.status_code == 429 or error.status_code >= 500
+
+def run_job(job, images):
+    file_storages = [FileStorage(stream=io.BytesIO(data), filename=filename, content_type=content_type)
+                     for filename, content_type, data in images]
+    try:
+        location = (job['lat'], job['lon']) if job['lat'] is not None else None
+        latest_results = run_identification(file_storages, bool(job['show_details']), job['owner'], job['id'], location)
+        if latest_results:
+            finish_job(job['id'], 'done', result=latest_results)
+        else:
+            finish_job(job['id'], 'failed', error="🤔 No species matches found. Try uploading clearer images or different plant parts.")
+    except ImageProcessingError as e:
+        finish_job(job['id'], 'failed', error=str(e))
+    except IdentificationError as e:
+        if is_retryable(e) and job['attempts'] < JOB_MAX_ATTEMPTS:
+            finish_job(job['id'], 'queued', error=str(e), retry_in=2 ** job['attempts'])
+        else:
+            finish_job(job['id'], 'failed', error=str(e))
+    except Exception as e:
+        print(f"[run_job] Job {job['id']} failed: {e}")
+        finish_job(job['id'], 'failed', error=f'Unexpected error: {str(e)}')
+
+def job_worker():
+    while True:
+        try:
+            claimed = claim_job()
+        except Exception as e:
+            print(f"[job_worker] Could not claim a job: {e}")
+            claimed = None
+        if claimed is None:
+            _job_wakeup.wait(timeout=1.0)
+            _job_wakeup.clear()
+            continue
+        run_job(*claimed)
+
+def ensure_job_workers():
+    global _job_workers_started
+    if _job_workers_started:
+        return
+    with _job_workers_lock:
+        if _job_workers_started:
+            return
+        init_jobs_db()
+        for i in range(JOB_WORKERS):
+            threading.Thread(target=job_worker, name=f"job-worker-{i}", daemon=True).start()
+        _job_workers_started = True
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    ensure_job_workers()
+    files = [f for f in request.files.getlist('image1') if f.filename]
+    if not files:
+        return jsonify({'error': 'Primary image is required.'}), 400
+    if len(files) > MAX_IMAGES_PER_OBSERVATION:
+        return jsonify({'error': f'You can upload a maximum of {MAX_IMAGES_PER_OBSERVATION} images per identification.'}), 400
+    show_details = 'show_details' in request.form
+    owner = history_owner()
+    job_id = enqueue_job(files, show_details, owner, submission_digest(owner, files, show_details), request_location())
+    if job_id is None:
+        return jsonify({'error': 'The identification queue is full. Please try again in a minute.'}), 503, {'Retry-After': '30'}
+    return jsonify({'job_id': job_id, 'status': 'queued',
+                    'status_url': url_for('job_status', job_id=job_id),
+                    'result_url': url_for('job_result', job_id=job_id)}), 202
+
+def can_see_job(row):
+    # Scoped like /history: the browser that submitted the job, or an admin
+    return has_history_admin_token() or (row['owner'] is not None and row['owner'] == session.get('history_owner'))
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    ensure_job_workers()
+    with closing(jobs_db()) as conn:
+        row = conn.execute("SELECT id, owner, status, attempts, created_at, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or not can_see_job(row):
+            return jsonify({'error': 'Unknown job.'}), 404
+        status = dict(row)
+        del status['owner']
+        if row['status'] == 'queued':
+            status['queue_position'] = conn.execute(
+                "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created_at <= ?", (row['created_at'],)).fetchone()[0]
+    return jsonify(status)
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def job_result(job_id):
+    with closing(jobs_db()) as conn:
+        row = conn.execute("SELECT owner, status, result, error FROM jobs WHERE id = ?", (job_id,)).fetchone()
+    if row is not None and not can_see_job(row):
+        row = None
+    if row is None or row['status'] in ('queued', 'running'):
+        flash('This identification is not finished yet.' if row else 'Unknown identification job.')
+    elif row['status'] == 'failed':
+        flash(row['error'])
+    else:
+        session['latest_results'] = json.loads(row['result'])
+    return redirect(url_for('index'))
+
+# === Identification History ===
+HISTORY_DB = os.environ.get('HISTORY_DB', 'history.sqlite3')
+HISTORY_ADMIN_TOKEN = os.environ.get('HISTORY_ADMIN_TOKEN')
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 100
+_history_ready = False
+_history_lock = threading.Lock()
+
+def history_db():
+    conn = sqlite3.connect(HISTORY_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_history_db():
+    """
+    observations rows are append-only; their rowid doubles as the time-ordered pagination cursor.
+    observation_species indexes every ranked species, history_fts full-text indexes their
+    scientific and common names (contentless, keyed by the observation rowid).
+    """
+    global _history_ready
+    if _history_ready:
+        return
+    with _history_lock:
+        if _history_ready:
+            return
+        with closing(history_db()) as conn, conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS observations (
+                    rowid INTEGER PRIMARY KEY,
+                    id TEXT NOT NULL UNIQUE,
+                    owner TEXT,
+                    created_at REAL NOT NULL,
+                    image_hashes TEXT NOT NULL,
+                    top_species TEXT,
+                    top_score REAL,
+                    results TEXT NOT NULL,
+                    enrichment TEXT NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS observations_created ON observations (created_at);
+                CREATE INDEX IF NOT EXISTS observations_owner ON observations (owner, rowid);
+                CREATE TABLE IF NOT EXISTS observation_species (
+                    observation_rowid INTEGER NOT NULL,
+                    rank INTEGER NOT NULL,
+                    scientific_name TEXT NOT NULL COLLATE NOCASE,
+                    score REAL
+                );
+                CREATE INDEX IF NOT EXISTS observation_species_name ON observation_species (scientific_name, observation_rowid);
+                CREATE VIRTUAL TABLE IF NOT EXISTS history_fts USING fts5(names, content='');
+            """)
+        _history_ready = True
+
+def history_owner():
+    """
+    Anonymous per-browser id used to scope a user's history.
+    """
+    if 'history_owner' not in session:
+        session['history_owner'] = uuid.uuid4().hex
+    return session['history_owner']
+
+def record_history(observation_id, owner, identification, cards):
+    """
+    Store a completed identification: image hashes, every ranked PlantNet result and the
+    enrichment shown for the top results. Occurrence points are left out; they are re-fetched on demand.
+    Recording the same observation id twice is a no-op.
+    """
+    ranked = [api_species_result(r) for r in identification.get("results", [])]
+    enrichment = [{
+        'scientific_name': card['scientific_name'],
+        'summary': card['wiki_summary'],
+        'fun_fact': card['education']['fun_fact'],
+        'care_tip': card['education']['care_tip'],
+        'heatmap': card['heatmap'],
+        'occurrence_count': len(card['gbif_coords']),
+    } for card in cards]
+    names = ' '.join(' '.join([r['scientific_name']] + list(r['common_names'])) for r in ranked)
+    top = ranked[0] if ranked else {}
+    try:
+        init_history_db()
+        with closing(history_db()) as conn, conn:
+            conn.execute("BEGIN IMMEDIATE")
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO observations (id, owner, created_at, image_hashes, top_species, top_score, results, enrichment) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (observation_id, owner, time.time(), json.dumps(identification.get("imageHashes", [])), top.get('scientific_name'),
+                 top.get('score'), json.dumps(ranked, ensure_ascii=False), json.dumps(enrichment, ensure_ascii=False)))
+            if cur.rowcount:
+                conn.executemany("INSERT INTO observation_species (observation_rowid, rank, scientific_name, score) VALUES (?, ?, ?, ?)",
+                                 [(cur.lastrowid, i + 1, r['scientific_name'], r['score']) for i, r in enumerate(ranked)])
+                conn.execute("INSERT INTO history_fts (rowid, names) VALUES (?, ?)", (cur.lastrowid, names))
+    except sqlite3.Error as e:
+        print(f"[record_history] Could not record {observation_id}: {e}")
+
+def record_identification(observation_id, owner, identification, cards):
+    """
+    History entry and analytics event for an identification with at least one match. Shared by
+    the web form, background jobs, the JSON API and the bulk CLI.
+    """
+    record_history(observation_id, owner, identification, cards)
+    top = identification["results"][0]
+    record_analytics('identification', species_names(top)['scientific_name'], top.get("score", 0))
+
+def fts_query(text):
+    # Quote each word so user input can never be parsed as FTS5 syntax; '*' allows prefix matches
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', text))
+
+def history_summary(row):
+    return {
+        'id': row['id'],
+        'created_at': datetime.fromtimestamp(row['created_at'], timezone.utc).isoformat(timespec='seconds'),
+        'top_species': row['top_species'],
+        'top_score': row['top_score'],
+        'species': [r['scientific_name'] for r in json.loads(row['results'])[:5]],
+    }
+
+def search_history(owner=None, text=None, species=None, since=None, until=None, cursor=None, limit=HISTORY_PAGE_SIZE):
+    """
+    Newest-first page of observations plus the cursor for the next page (None on the last page).
+    Uses keyset pagination on rowid, so every page costs the same however deep the user pages.
+    """
+    sql = "SELECT o.* FROM observations o"
+    where, params = [], []
+    if text and fts_query(text):
+        sql += " JOIN history_fts f ON f.rowid = o.rowid"
+        where.append("history_fts MATCH ?")
+        params.append(fts_query(text))
+    if species:
+        where.append("o.rowid IN (SELECT observation_rowid FROM observation_species WHERE scientific_name = ?)")
+        params.append(species)
+    if owner is not None:
+        where.append("o.owner = ?")
+        params.append(owner)
+    if since is not None:
+        where.append("o.created_at >= ?")
+        params.append(since)
+    if until is not None:
+        where.append("o.created_at < ?")
+        params.append(until)
+    if cursor is not None:
+        where.append("o.rowid < ?")
+        params.append(cursor)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY o.rowid DESC LIMIT ?"
+    params.append(limit + 1)
+    init_history_db()
+    with closing(history_db()) as conn:
+        rows = conn.execute(sql, params).fetchall()
+    next_cursor = rows[limit - 1]['rowid'] if len(rows) > limit else None
+    return [history_summary(row) for row in rows[:limit]], next_cursor
+
+def has_history_admin_token():
+    token = request.headers.get('X-Admin-Token') or request.args.get('admin_token')
+    return bool(HISTORY_ADMIN_TOKEN) and token == HISTORY_ADMIN_TOKEN
+
+def parse_time_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        parsed = datetime.fromisoformat(value)
+        return (parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)).timestamp()
+
+@app.route('/history', methods=['GET'])
+def history():
+    """
+    Paginated identification history. Users see their own observations; requests carrying
+    X-Admin-Token: $HISTORY_ADMIN_TOKEN see everyone's and may filter by ?owner=.
+    Query args: q (full-text over scientific and common names), species, since, until
+    (epoch seconds or ISO 8601), cursor (from next_cursor) and limit.
+    """
+    owner = request.args.get('owner') if has_history_admin_token() else session.get('history_owner')
+    if owner is None and not has_history_admin_token():
+        return jsonify({'observations': [], 'next_cursor': None})
+    try:
+        limit = max(1, min(int(request.args.get('limit', HISTORY_PAGE_SIZE)), HISTORY_MAX_PAGE_SIZE))
+        cursor = int(request.args['cursor']) if request.args.get('cursor') else None
+        since, until = parse_time_arg('since'), parse_time_arg('until')
+    except ValueError:
+        return jsonify({'error': 'Invalid limit, cursor, since or until.'}), 400
+    observations, next_cursor = search_history(owner, request.args.get('q'), request.args.get('species'),
+                                               since, until, cursor, limit)
+    return jsonify({'observations': observations, 'next_cursor': next_cursor})
+
+@app.route('/history/<observation_id>', methods=['GET'])
+def history_detail(observation_id):
+    init_history_db()
+    with closing(history_db()) as conn:
+        row = conn.execute("SELECT * FROM observations WHERE id = ?", (observation_id,)).fetchone()
+    if row is None or not (has_history_admin_token() or (row['owner'] and row['owner'] == session.get('history_owner'))):
+        return jsonify({'error': 'Not found.'}), 404
+    detail = history_summary(row)
+    detail.update(image_hashes=json.loads(row['image_hashes']), results=json.loads(row['results']),
+                  enrichment=json.loads(row['enrichment']))
+    return jsonify(detail)
+
+# === Usage Analytics ===
+# Pre-aggregated counters, updated incrementally so dashboard queries read one row per time bucket
+# (or per species) instead of scanning history. Request threads only enqueue events; a background
+# writer sums them in memory and applies them as additive upserts about once a second, which also
+# makes concurrent writers in several gunicorn workers safe.
+ANALYTICS_DB = os.environ.get('ANALYTICS_DB', 'analytics.sqlite3')
+ANALYTICS_FLUSH_SECONDS = 1.0
+ANALYTICS_QUEUE_SIZE = 10000
+HOUR = 3600
+DAY = 24 * HOUR
+_analytics_queue = queue.Queue(maxsize=ANALYTICS_QUEUE_SIZE)
+_analytics_writer_pid = None
+_analytics_lock = threading.Lock()
+
+def analytics_db():
+    conn = sqlite3.connect(ANALYTICS_DB, timeout=30)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def init_analytics_db():
+    with closing(analytics_db()) as conn, conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS identifications_hourly (
+                bucket INTEGER PRIMARY KEY,
+                identifications INTEGER NOT NULL,
+                top_score_sum REAL NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS species_daily (
+                day INTEGER NOT NULL,
+                scientific_name TEXT NOT NULL,
+                identifications INTEGER NOT NULL,
+                top_score_sum REAL NOT NULL,
+                PRIMARY KEY (day, scientific_name)
+            );
+            CREATE TABLE IF NOT EXISTS species_totals (
+                scientific_name TEXT PRIMARY KEY,
+                identifications INTEGER NOT NULL,
+                top_score_sum REAL NOT NULL,
+                last_seen REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS species_totals_count ON species_totals (identifications);
+            CREATE TABLE IF NOT EXISTS upstream_hourly (
+                bucket INTEGER NOT NULL,
+                upstream TEXT NOT NULL,
+                requests INTEGER NOT NULL,
+                errors INTEGER NOT NULL,
+                PRIMARY KEY (bucket, upstream)
+            );
+        """)
+
+def record_analytics(kind, *values):
+    """
+    Queue an analytics event without blocking: ('identification', species, top_score) or
+    ('upstream', name, is_error). Events are dropped (and counted) if the writer falls behind.
+    """
+    global _analytics_writer_pid
+    if _analytics_writer_pid != os.getpid():
+        with _analytics_lock:
+            if _analytics_writer_pid != os.getpid():
+                init_analytics_db()
+                threading.Thread(target=analytics_writer, name="analytics-writer", daemon=True).start()
+                _analytics_writer_pid = os.getpid()
+    try:
+        _analytics_queue.put_nowait((kind, time.time()) + values)
+    except queue.Full:
+        ANALYTICS_DROPPED.inc()
+
+def flush_analytics(events):
+    hourly, species_daily, species_totals, upstream = {}, {}, {}, {}
+    for kind, at, name, value in events:
+        hour = int(at // HOUR) * HOUR
+        if kind == 'identification':
+            count, total = hourly.get(hour, (0, 0.0))
+            hourly[hour] = (count + 1, total + value)
+            day_key = (int(at // DAY) * DAY, name)
+            count, total = species_daily.get(day_key, (0, 0.0))
+            species_daily[day_key] = (count + 1, total + value)
+            count, total, _ = species_totals.get(name, (0, 0.0, at))
+            species_totals[name] = (count + 1, total + value, at)
+        elif kind == 'upstream':
+            requests_, errors = upstream.get((hour, name), (0, 0))
+            upstream[(hour, name)] = (requests_ + 1, errors + int(bool(value)))
+    with closing(analytics_db()) as conn, conn:
+        conn.executemany("""INSERT INTO identifications_hourly VALUES (?, ?, ?) ON CONFLICT (bucket) DO UPDATE SET
+                            identifications = identifications + excluded.identifications, top_score_sum = top_score_sum + excluded.top_score_sum""",
+                         [(hour, count, total) for hour, (count, total) in hourly.items()])
+        conn.executemany("""INSERT INTO species_daily VALUES (?, ?, ?, ?) ON CONFLICT (day, scientific_name) DO UPDATE SET
+                            identifications = identifications + excluded.identifications, top_score_sum = top_score_sum + excluded.top_score_sum""",
+                         [(day, name, count, total) for (day, name), (count, total) in species_daily.items()])
+        conn.executemany("""INSERT INTO species_totals VALUES (?, ?, ?, ?) ON CONFLICT (scientific_name) DO UPDATE SET
+                            identifications = identifications + excluded.identifications, top_score_sum = top_score_sum + excluded.top_score_sum,
+                            last_seen = MAX(last_seen, excluded.last_seen)""",
+                         [(name, count, total, last) for name, (count, total, last) in species_totals.items()])
+        conn.executemany("""INSERT INTO upstream_hourly VALUES (?, ?, ?, ?) ON CONFLICT (bucket, upstream) DO UPDATE SET
+                            requests = requests + excluded.requests, errors = errors + excluded.errors""",
+                         [(hour, name, count, errors) for (hour, name), (count, errors) in upstream.items()])
+
+def drain_analytics_queue(timeout):
+    events = []
+    try:
+        events.append(_analytics_queue.get(timeout=timeout))
+        while True:
+            events.append(_analytics_queue.get_nowait())
+    except queue.Empty:
+        pass
+    return events
+
+def analytics_writer():
+    while True:
+        events = drain_analytics_queue(timeout=60)
+        if not events:
+            continue
+        try:
+            flush_analytics(events)
+        except sqlite3.Error as e:
+            print(f"[analytics_writer] Dropped {len(events)} events: {e}")
+        time.sleep(ANALYTICS_FLUSH_SECONDS)
+
+@atexit.register
+def flush_pending_analytics():
+    if _analytics_writer_pid == os.getpid():
+        events = drain_analytics_queue(timeout=0)
+        if events:
+            try:
+                flush_analytics(events)
+            except sqlite3.Error as e:
+                print(f"[flush_pending_analytics] {e}")
+
+def analytics_window():
+    hours = max(1, min(int(request.args.get('hours', 24)), 24 * 90))
+    now = time.time()
+    return hours, int(now // HOUR) * HOUR - (hours - 1) * HOUR
+
+@app.route('/analytics', methods=['GET'])
+def analytics():
+    """
+    Dashboard data for the last ?hours= (default 24): identifications and average top score per hour,
+    top species in the window and overall, and upstream error rates. Admin only (X-Admin-Token).
+    """
+    if not has_history_admin_token():
+        return jsonify({'error': 'Not found.'}), 404
+    try:
+        hours, start = analytics_window()
+    except ValueError:
+        return jsonify({'error': 'Invalid hours.'}), 400
+    init_analytics_db()
+    with closing(analytics_db()) as conn:
+        by_hour = {row['bucket']: row for row in conn.execute(
+            "SELECT * FROM identifications_hourly WHERE bucket >= ?", (start,))}
+        top_window = conn.execute("""SELECT scientific_name, SUM(identifications) AS identifications, SUM(top_score_sum) AS top_score_sum
+                                     FROM species_daily WHERE day >= ? GROUP BY scientific_name
+                                     ORDER BY identifications DESC LIMIT 10""", (int(start // DAY) * DAY,)).fetchall()
+        top_all_time = conn.execute("SELECT * FROM species_totals ORDER BY identifications DESC LIMIT 10").fetchall()
+        upstreams = conn.execute("""SELECT upstream, SUM(requests) AS requests, SUM(errors) AS errors
+                                    FROM upstream_hourly WHERE bucket >= ? GROUP BY upstream""", (start,)).fetchall()
+    series = []
+    for bucket in range(start, start + hours * HOUR, HOUR):
+        row = by_hour.get(bucket)
+        count = row['identifications'] if row else 0
+        series.append({
+            'hour': datetime.fromtimestamp(bucket, timezone.utc).isoformat(timespec='minutes'),
+            'identifications': count,
+            'avg_top_score': round(row['top_score_sum'] / count, 4) if count else None,
+        })
+    def species_rows(rows):
+        return [{'scientific_name': r['scientific_name'], 'identifications': r['identifications'],
+                 'avg_top_score': round(r['top_score_sum'] / r['identifications'], 4)} for r in rows]
+    total = sum(point['identifications'] for point in series)
+    return jsonify({
+        'hours': hours,
+        'identifications': total,
+        'avg_top_score': round(sum(row['top_score_sum'] for row in by_hour.values()) / total, 4) if total else None,
+        'per_hour': series,
+        # Daily rollups, so the window is widened to whole UTC days
+        'top_species': species_rows(top_window),
+        'top_species_all_time': species_rows(top_all_time),
+        'upstream_error_rates': {r['upstream']: {'requests': r['requests'], 'errors': r['errors'],
+                                                 'error_rate': round(r['errors'] / r['requests'], 4)} for r in upstreams},
+    })
+
+@app.route('/analytics/export', methods=['GET'])
+def analytics_export():
+    """
+    All aggregate tables since ?since= (epoch seconds, default everything) as compact column/row JSON.
+    Admin only (X-Admin-Token).
+    """
+    if not has_history_admin_token():
+        return jsonify({'error': 'Not found.'}), 404
+    try:
+        since = int(float(request.args.get('since', 0)))
+    except ValueError:
+        return jsonify({'error': 'Invalid since.'}), 400
+    init_analytics_db()
+    tables = {
+        'identifications_hourly': ("SELECT bucket, identifications, top_score_sum FROM identifications_hourly WHERE bucket >= ? ORDER BY bucket", (since,)),
+        'species_daily': ("SELECT day, scientific_name, identifications, top_score_sum FROM species_daily WHERE day >= ? ORDER BY day, scientific_name", (int(since // DAY) * DAY,)),
+        'species_totals': ("SELECT scientific_name, identifications, top_score_sum, last_seen FROM species_totals ORDER BY identifications DESC", ()),
+        'upstream_hourly': ("SELECT bucket, upstream, requests, errors FROM upstream_hourly WHERE bucket >= ? ORDER BY bucket, upstream", (since,)),
+    }
+    export = {'generated_at': int(time.time())}
+    with closing(analytics_db()) as conn:
+        for name, (sql, params) in tables.items():
+            cursor = conn.execute(sql, params)
+            export[name] = {'columns': [c[0] for c in cursor.description], 'rows': [list(row) for row in cursor]}
+    return Response(json.dumps(export, separators=(',', ':')), mimetype='application/json')
+
+# === App Factory / Production Serving ===
+def init_worker():
+    """
+    Per-process initialisation; gunicorn calls this in each worker after fork (see gunicorn.conf.py).
+    Gives the worker its own HTTP connection pool, cache connections and job workers.
+    """
+    global _http_session, _job_workers_started
+    _http_session = None
+    _job_workers_started = False
+    SHARED_CACHE.reset_after_fork()
+    SIMILARITY_INDEX.reset_after_fork()
+    http_session()
+
+def create_app():
+    init_worker()
+    return app
+
 if __name__ == '__main__':
     app.run(debug=True, port=5002)
   
\ No newline at end of file
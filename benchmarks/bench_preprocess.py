@@ -0,0 +1,280 @@
+"""
+Microbenchmark for upload preprocessing (process_image and its stages).
+
+Runs the app's own decode_upload / downscale_upload / encode_upload stages and the full
+process_image over the bundled plant_pics/ photos plus synthetic inputs (a 12 MP phone JPEG,
+a PNG with alpha, a palette PNG, a panorama and a browser-downscaled JPEG). Reports the median
+time per stage, output bytes and peak memory per image. Works offline and generates the
+synthetic inputs from a fixed seed, so results are comparable across commits and Pillow
+versions. Results are written as JSON under benchmarks/results/.
+
+    python benchmarks/bench_preprocess.py
+    python benchmarks/bench_preprocess.py --repeat 10 --only phone,panorama
+    python benchmarks/bench_preprocess.py --baseline benchmarks/results/preprocess-abc1234-20250101T120000.json --fail-over 10
+"""
+import argparse
+import hashlib
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PICS_DIR = os.path.join(ROOT, 'plant_pics')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+
+# Keep generated thumbnails and uploads out of the working tree; memory probes inherit the directory
+if 'BENCH_PREPROCESS_SCRATCH' not in os.environ:
+    os.environ['BENCH_PREPROCESS_SCRATCH'] = tempfile.mkdtemp(prefix='bench_preprocess_')
+SCRATCH_DIR = os.environ['BENCH_PREPROCESS_SCRATCH']
+os.environ['THUMBNAIL_FOLDER'] = os.path.join(SCRATCH_DIR, 'thumbnails')
+sys.path.insert(0, ROOT)
+
+import PIL  # noqa: E402
+from PIL import Image, ImageChops, features  # noqa: E402
+from werkzeug.datastructures import FileStorage  # noqa: E402
+
+from app import decode_upload, downscale_upload, encode_upload, process_image  # noqa: E402
+
+
+def textured_rgb(size, rng, blobs=(48, 36)):
+    """
+    Photo-like RGB test image: smooth colour regions with fine grain, from a seeded RNG.
+    """
+    base = Image.frombytes('RGB', blobs, rng.randbytes(blobs[0] * blobs[1] * 3)).resize(size, Image.Resampling.BICUBIC)
+    grain_size = (size[0] // 4, size[1] // 4)
+    grain = Image.frombytes('L', grain_size, rng.randbytes(grain_size[0] * grain_size[1])).resize(size, Image.Resampling.NEAREST)
+    return ImageChops.blend(base, Image.merge('RGB', (grain, grain, grain)), 0.15)
+
+
+def encode(img, fmt, **params):
+    buf = io.BytesIO()
+    img.save(buf, format=fmt, **params)
+    return buf.getvalue()
+
+
+def synthetic_inputs(seed):
+    rng = random.Random(seed)
+    phone = textured_rgb((4032, 3024), rng)
+    rgba = textured_rgb((3000, 3000), rng)
+    # Opaque centre fading to fully transparent edges
+    alpha = Image.radial_gradient('L').resize(rgba.size, Image.Resampling.BILINEAR).point(lambda v: max(0, 255 - v * 2))
+    rgba.putalpha(alpha)
+    palette = textured_rgb((2000, 1500), rng).quantize(colors=256, method=Image.Quantize.MEDIANCUT)
+    panorama = textured_rgb((12000, 2000), rng, blobs=(144, 24))
+    browser = textured_rgb((1024, 768), rng)
+    return [
+        ('synthetic/phone_12mp.jpg', encode(phone, 'JPEG', quality=92)),
+        ('synthetic/alpha_3000.png', encode(rgba, 'PNG', compress_level=6)),
+        ('synthetic/palette_2000.png', encode(palette, 'PNG', compress_level=6)),
+        ('synthetic/panorama_24mp.jpg', encode(panorama, 'JPEG', quality=90)),
+        ('synthetic/browser_1024.jpg', encode(browser, 'JPEG', quality=85)),
+    ]
+
+
+def load_corpus(seed, only=None):
+    corpus = []
+    for name in sorted(os.listdir(PICS_DIR)):
+        with open(os.path.join(PICS_DIR, name), 'rb') as fh:
+            corpus.append((f"plant_pics/{name}", fh.read()))
+    corpus.extend(synthetic_inputs(seed))
+    if only:
+        corpus = [(name, data) for name, data in corpus if any(part in name for part in only)]
+    return corpus
+
+
+def time_stages(data):
+    """
+    One pass through the preprocessing stages; times in seconds.
+    """
+    started = time.perf_counter()
+    img, passthrough = decode_upload(data)
+    decoded = time.perf_counter()
+    if passthrough is not None:
+        return {'decode': decoded - started, 'resize': 0.0, 'encode': 0.0}, passthrough, img.size, True
+    img = downscale_upload(img)
+    resized = time.perf_counter()
+    output = encode_upload(img)
+    encoded = time.perf_counter()
+    return {'decode': decoded - started, 'resize': resized - decoded, 'encode': encoded - resized}, output, img.size, False
+
+
+def time_process_image(data, path):
+    """
+    The full process_image call, including the preview, thumbnail and writing the upload file.
+    """
+    started = time.perf_counter()
+    handle = process_image(FileStorage(stream=io.BytesIO(data), filename='bench.jpg'), path, [])
+    elapsed = time.perf_counter() - started
+    if handle is None:
+        raise RuntimeError("process_image failed")
+    handle.close()
+    return elapsed
+
+
+def proc_status(field):
+    with open('/proc/self/status') as fh:
+        for line in fh:
+            if line.startswith(field + ':'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def measure_peak_memory(data, path):
+    """
+    Peak RSS growth while process_image runs, in bytes. Runs in a freshly spawned process, since
+    heap pages kept from earlier images (or inherited through fork) would hide this one's buffers.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as fh:
+            fh.write('5')
+    except OSError:
+        return None
+    before = proc_status('VmRSS')
+    time_process_image(data, path)
+    peak = proc_status('VmHWM')
+    return peak - before if peak is not None and before is not None else None
+
+
+def peak_memory(data, path):
+    if not os.path.exists('/proc/self/clear_refs'):
+        return None
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(measure_peak_memory, (data, path))
+
+
+def bench_image(name, data, repeat, memory):
+    info = Image.open(io.BytesIO(data))
+    path = os.path.join(SCRATCH_DIR, 'upload.jpg')
+    # Warm-up pass, also gives the output details
+    _, output, out_size, passthrough = time_stages(data)
+    samples = {'decode': [], 'resize': [], 'encode': [], 'total': []}
+    for _ in range(repeat):
+        stages, _, _, _ = time_stages(data)
+        for stage, value in stages.items():
+            samples[stage].append(value)
+        samples['total'].append(time_process_image(data, path))
+    peak = peak_memory(data, path) if memory else None
+    return {
+        'image': name,
+        'input_sha256': hashlib.sha256(data).hexdigest()[:16],
+        'format': info.format,
+        'mode': info.mode,
+        'size': list(info.size),
+        'input_bytes': len(data),
+        'passthrough': passthrough,
+        'output_size': list(out_size),
+        'output_bytes': len(output),
+        'ms': {stage: round(statistics.median(values) * 1000, 2) for stage, values in samples.items()},
+        'total_ms_min': round(min(samples['total']) * 1000, 2),
+        'peak_rss_mb': round(peak / (1024 * 1024), 1) if peak is not None else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_table(images, baseline=None):
+    base = {r['image']: r for r in (baseline or {}).get('images', [])}
+    print(f"{'image':<32} {'size':>11} {'in KB':>7} {'out KB':>7} {'decode':>8} {'resize':>8} {'encode':>8} {'total':>8} {'rss MB':>7} {'vs base':>8}")
+    for r in images:
+        ms = r['ms']
+        size = f"{r['size'][0]}x{r['size'][1]}"
+        before = base.get(r['image'])
+        change = ''
+        if before and before['input_sha256'] == r['input_sha256'] and before['ms']['total']:
+            change = f"{100.0 * (ms['total'] - before['ms']['total']) / before['ms']['total']:+.1f}%"
+        rss = f"{r['peak_rss_mb']:.1f}" if r['peak_rss_mb'] is not None else '-'
+        print(f"{r['image'][-32:]:<32} {size:>11} {r['input_bytes'] / 1024:>7.0f} {r['output_bytes'] / 1024:>7.0f} "
+              f"{ms['decode']:>8.2f} {ms['resize']:>8.2f} {ms['encode']:>8.2f} {ms['total']:>8.2f} {rss:>7} {change:>8}")
+
+
+def compare_totals(images, baseline):
+    """
+    Summed median total time over the images both runs share (with identical inputs); (now, before).
+    """
+    base = {r['image']: r for r in baseline.get('images', [])}
+    shared = [(r, base[r['image']]) for r in images
+              if r['image'] in base and base[r['image']]['input_sha256'] == r['input_sha256']]
+    return sum(r['ms']['total'] for r, _ in shared), sum(b['ms']['total'] for _, b in shared)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark upload preprocessing over plant_pics/ and synthetic images.")
+    parser.add_argument('--repeat', type=int, default=5, help="Timed runs per image; medians are reported (default 5)")
+    parser.add_argument('--seed', type=int, default=42, help="Seed for the synthetic inputs (default 42)")
+    parser.add_argument('--only', help="Comma-separated substrings; benchmark only matching image names")
+    parser.add_argument('--no-memory', action='store_true', help="Skip the per-image peak memory measurement")
+    parser.add_argument('--baseline', help="Earlier results JSON to compare against")
+    parser.add_argument('--fail-over', type=float,
+                        help="Exit with status 1 if total preprocessing time is more than this many percent above --baseline")
+    parser.add_argument('--output', help="Results file (default benchmarks/results/preprocess-<commit>-<time>.json)")
+    args = parser.parse_args(argv)
+    if args.repeat < 1:
+        parser.error("--repeat must be at least 1")
+    if args.fail_over is not None and not args.baseline:
+        parser.error("--fail-over needs --baseline")
+
+    only = [part for part in args.only.split(',') if part] if args.only else None
+    corpus = load_corpus(args.seed, only)
+    if not corpus:
+        parser.error("No images selected.")
+    images = []
+    try:
+        for name, data in corpus:
+            print(f"[bench_preprocess] {name}...", flush=True)
+            images.append(bench_image(name, data, args.repeat, not args.no_memory))
+    finally:
+        shutil.rmtree(SCRATCH_DIR, ignore_errors=True)
+
+    report = {
+        'benchmark': 'preprocess',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'libjpeg_turbo': features.version('libjpeg_turbo'),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('baseline', 'output', 'fail_over')},
+        'images': images,
+        'total_ms': round(sum(r['ms']['total'] for r in images), 2),
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+    print_table(images, baseline)
+    print(f"[bench_preprocess] Total (sum of medians): {report['total_ms']:.1f} ms over {len(images)} images")
+    output = args.output or os.path.join(RESULTS_DIR, f"preprocess-{report['commit']}-{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"[bench_preprocess] Results written to {output}")
+
+    if baseline is not None:
+        now, before = compare_totals(images, baseline)
+        if before:
+            change = 100.0 * (now - before) / before
+            print(f"[bench_preprocess] vs baseline: {now:.1f} ms vs {before:.1f} ms ({change:+.1f}%)")
+            if args.fail_over is not None and change > args.fail_over:
+                print(f"[bench_preprocess] Regression above {args.fail_over:g}%", file=sys.stderr)
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,399 @@
+"""
+End-to-end load test for the identification path.
+
+Starts standin_server.py and the app as subprocesses, drives POST /, /compare and
+/check_local_species with multi-image uploads from plant_pics/ at each concurrency
+level, and reports requests/sec, p50/p95/p99 latency, shed (503) responses, app CPU
+time and peak RSS.
+Results are written as JSON under benchmarks/results/ for comparison across commits.
+
+    python benchmarks/load_test.py --concurrency 1,4,16 --duration 20
+    python benchmarks/load_test.py --scenarios identify --standin-arg=--latency --standin-arg=plantnet=lognormal:1.5,0.4
+    python benchmarks/load_test.py --workers 1,4,16 --scenarios identify --concurrency 16,64
+    python benchmarks/load_test.py --baseline benchmarks/results/loadtest-abc1234-20250101T120000.json
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import requests
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PICS_DIR = os.path.join(ROOT, 'plant_pics')
+RESULTS_DIR = os.path.join(ROOT, 'benchmarks', 'results')
+SCENARIOS = ('identify', 'compare', 'check_local')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(url, timeout=2)
+            return
+        except requests.RequestException:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout}s")
+
+
+def start_standin(port, extra_args):
+    cmd = [sys.executable, os.path.join(ROOT, 'standin_server.py'), '--port', str(port)] + extra_args
+    proc = subprocess.Popen(cmd, cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until_up(f"http://127.0.0.1:{port}/_standin/config")
+    return proc
+
+
+def start_app(port, standin_port, workers=None, state_dir=None):
+    """
+    Start the app on the Flask development server, or under gunicorn with the given number of workers.
+    """
+    base = f"http://127.0.0.1:{standin_port}"
+    env = dict(os.environ, PLANTNET_BASE_URL=base, OPENAI_BASE_URL=base, GBIF_BASE_URL=base,
+               PLANTNET_API_KEY='standin', OPENAI_API_KEY='standin')
+    if state_dir:
+        env.update(SHARED_CACHE_PATH=os.path.join(state_dir, 'cache.sqlite3'),
+                   SIMILARITY_INDEX_PATH=os.path.join(state_dir, 'similarity.sqlite3'),
+                   HISTORY_DB=os.path.join(state_dir, 'history.sqlite3'),
+                   ANALYTICS_DB=os.path.join(state_dir, 'analytics.sqlite3'),
+                   JOBS_DB=os.path.join(state_dir, 'jobs.sqlite3'),
+                   THUMBNAIL_FOLDER=os.path.join(state_dir, 'thumbnails'),
+                   HEATMAP_FOLDER=os.path.join(state_dir, 'heatmaps'))
+    if workers:
+        env.update(BIND=f"127.0.0.1:{port}", WEB_WORKERS=str(workers))
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--access-logfile', '/dev/null', 'wsgi:app']
+    else:
+        code = f"import app; app.app.run(host='127.0.0.1', port={port}, threaded=True, debug=False)"
+        cmd = [sys.executable, '-c', code]
+    proc = subprocess.Popen(cmd, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_until_up(f"http://127.0.0.1:{port}/", timeout=60)
+    return proc
+
+
+def process_tree(pid):
+    """
+    pid plus all its descendants (Linux /proc), so multi-process servers are measured as a whole.
+    """
+    pids = [pid]
+    try:
+        children = {}
+        for entry in os.listdir('/proc'):
+            if entry.isdigit():
+                try:
+                    with open(f'/proc/{entry}/stat') as fh:
+                        ppid = int(fh.read().rsplit(')', 1)[1].split()[1])
+                    children.setdefault(ppid, []).append(int(entry))
+                except (OSError, ValueError, IndexError):
+                    continue
+        queue = [pid]
+        while queue:
+            for child in children.get(queue.pop(), []):
+                pids.append(child)
+                queue.append(child)
+    except OSError:
+        pass
+    return pids
+
+
+def cpu_seconds(pid):
+    total = 0.0
+    ticks = os.sysconf('SC_CLK_TCK') if hasattr(os, 'sysconf') else 100
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/stat') as fh:
+                fields = fh.read().rsplit(')', 1)[1].split()
+            total += (int(fields[11]) + int(fields[12])) / ticks
+        except (OSError, IndexError, ValueError):
+            continue
+    return total
+
+
+def rss_bytes(pid):
+    total = 0
+    for p in process_tree(pid):
+        try:
+            with open(f'/proc/{p}/status') as fh:
+                for line in fh:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total
+
+
+class ResourceSampler(threading.Thread):
+    def __init__(self, pid, interval=0.1):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_rss = max(self.peak_rss, rss_bytes(self.pid))
+            self.stopped.wait(self.interval)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class Shed(Exception):
+    """
+    The app turned the request away with 503 (admission control); retry_after is its Retry-After in seconds.
+    """
+    def __init__(self, retry_after):
+        super().__init__(f"shed, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def check_shed(resp):
+    if resp.status_code == 503:
+        try:
+            retry_after = float(resp.headers.get('Retry-After', 1))
+        except ValueError:
+            retry_after = 1.0
+        raise Shed(retry_after)
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+class VirtualUser:
+    def __init__(self, base_url, pictures, rng, max_images):
+        self.base_url = base_url
+        self.pictures = pictures
+        self.rng = rng
+        self.max_images = max_images
+        self.http = requests.Session()
+        self.result_count = 0
+
+    def identify(self, min_images=1):
+        count = self.rng.randint(min_images, max(min_images, self.max_images))
+        chosen = self.rng.sample(self.pictures, count)
+        files = [('image1', (name, data, 'image/jpeg')) for name, data in chosen]
+        resp = self.http.post(self.base_url + '/', files=files, data={'show_details': 'on'}, timeout=300)
+        check_shed(resp)
+        # Failures redirect back to the empty page; a results page has result cards
+        ok = resp.status_code == 200 and 'result-card' in resp.text
+        if ok:
+            # The session keeps only the latest upload's results, which /compare indexes into
+            self.result_count = resp.text.count('<div class="result-card local-check"')
+        return ok
+
+    def compare(self):
+        if self.result_count < 2:
+            self.identify(min_images=2)
+        resp = self.http.post(self.base_url + '/compare', data={'idx1': 0, 'idx2': 1}, timeout=300)
+        check_shed(resp)
+        return resp.status_code == 200 and '<table' in resp.text
+
+    def check_local(self):
+        species = [os.path.splitext(name)[0] for name, _ in self.rng.sample(self.pictures, 3)]
+        resp = self.http.post(self.base_url + '/check_local_species',
+                              json={'lat': 28.6, 'lon': 77.2, 'species': species}, timeout=300)
+        check_shed(resp)
+        return resp.status_code == 200 and 'results' in resp.json()
+
+
+def load_pictures():
+    pictures = []
+    for name in sorted(os.listdir(PICS_DIR)):
+        with open(os.path.join(PICS_DIR, name), 'rb') as fh:
+            pictures.append((name, fh.read()))
+    return pictures
+
+
+def run_level(base_url, app_pid, scenario, concurrency, duration, max_requests, pictures, seed, max_images, workers=None):
+    users = [VirtualUser(base_url, pictures, random.Random(seed * 1000 + i), max_images) for i in range(concurrency)]
+    if scenario == 'compare':
+        # Warm each user's session outside the measured window
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            list(pool.map(lambda u: u.identify(), users))
+    latencies = []
+    errors = [0]
+    shed = [0]
+    lock = threading.Lock()
+    issued = [0]
+    deadline = time.monotonic() + duration
+
+    def drive(user):
+        action = getattr(user, scenario)
+        while time.monotonic() < deadline:
+            with lock:
+                if max_requests and issued[0] >= max_requests:
+                    return
+                issued[0] += 1
+            started = time.perf_counter()
+            try:
+                ok = action()
+            except Shed as e:
+                # Shed requests are not latency samples; back off as the app asked before trying again
+                with lock:
+                    shed[0] += 1
+                time.sleep(max(0.0, min(e.retry_after, deadline - time.monotonic())))
+                continue
+            except (requests.RequestException, ValueError):
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if not ok:
+                    errors[0] += 1
+
+    sampler = ResourceSampler(app_pid)
+    sampler.start()
+    cpu_before = cpu_seconds(app_pid)
+    wall_started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(drive, users))
+    wall = time.perf_counter() - wall_started
+    cpu_used = cpu_seconds(app_pid) - cpu_before
+    sampler.stop()
+    latencies.sort()
+    return {
+        'scenario': scenario,
+        'workers': workers,
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': errors[0],
+        'shed': shed[0],
+        'wall_seconds': round(wall, 3),
+        'requests_per_sec': round(len(latencies) / wall, 3) if wall else None,
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+            'p95': round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+            'p99': round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+            'max': round(latencies[-1] * 1000, 1) if latencies else None,
+        },
+        'app_cpu_seconds': round(cpu_used, 3),
+        'app_cpu_percent': round(100.0 * cpu_used / wall, 1) if wall else None,
+        'app_peak_rss_mb': round(sampler.peak_rss / (1024 * 1024), 1),
+    }
+
+
+def run_scenarios(args, scenarios, levels, base_url, app_pid, pictures, workers):
+    results = []
+    for scenario in scenarios:
+        for concurrency in levels:
+            label = f"{workers} workers, " if workers else ''
+            print(f"[load_test] {scenario} at {label}concurrency {concurrency}...", flush=True)
+            results.append(run_level(base_url, app_pid, scenario, concurrency, args.duration, args.requests,
+                                     pictures, args.seed, args.max_images, workers))
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_table(levels, baseline=None):
+    base = {(r['scenario'], r.get('workers'), r['concurrency']): r for r in (baseline or {}).get('levels', [])}
+    print(f"{'scenario':<12} {'wrk':>4} {'conc':>4} {'reqs':>6} {'err':>4} {'shed':>5} {'req/s':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'cpu%':>6} {'rss MB':>7}")
+    for r in levels:
+        lat = r['latency_ms']
+        print(f"{r['scenario']:<12} {r.get('workers') or 'dev':>4} {r['concurrency']:>4} {r['requests']:>6} {r['errors']:>4} {r.get('shed', 0):>5} {r['requests_per_sec'] or 0:>8.2f} "
+              f"{lat['p50'] or 0:>9.1f} {lat['p95'] or 0:>9.1f} {lat['p99'] or 0:>9.1f} {r['app_cpu_percent'] or 0:>6.1f} {r['app_peak_rss_mb']:>7.1f}")
+        before = base.get((r['scenario'], r.get('workers'), r['concurrency']))
+        if before and before['requests_per_sec'] and before['latency_ms']['p95']:
+            rps = 100.0 * (r['requests_per_sec'] - before['requests_per_sec']) / before['requests_per_sec']
+            p95 = 100.0 * (lat['p95'] - before['latency_ms']['p95']) / before['latency_ms']['p95']
+            print(f"{'':<12} {'':>4} {'':>4} vs baseline: req/s {rps:+.1f}%, p95 {p95:+.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load-test the identification path against local upstream stand-ins.")
+    parser.add_argument('--concurrency', default='1,4,16', help="Comma-separated concurrency levels (default 1,4,16)")
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help=f"Comma-separated subset of {', '.join(SCENARIOS)}")
+    parser.add_argument('--duration', type=float, default=20.0, help="Seconds per scenario and level (default 20)")
+    parser.add_argument('--requests', type=int, default=0, help="Stop a level after this many requests (default: duration only)")
+    parser.add_argument('--max-images', type=int, default=5, help="Upload 1..N images per identification (default 5)")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--standin-arg', action='append', default=[], help="Extra argument passed to standin_server.py (repeatable)")
+    parser.add_argument('--workers', help="Comma-separated gunicorn worker counts, e.g. 1,4,16 (default: Flask dev server)")
+    parser.add_argument('--app-url', help="Benchmark an already running app instead of starting one (requires --app-pid)")
+    parser.add_argument('--app-pid', type=int, help="PID of the already running app server, sampled for CPU and RSS")
+    parser.add_argument('--baseline', help="Earlier results JSON to compare against")
+    parser.add_argument('--output', help="Results file (default benchmarks/results/loadtest-<commit>-<time>.json)")
+    args = parser.parse_args(argv)
+
+    levels = [int(c) for c in args.concurrency.split(',') if c]
+    scenarios = [s for s in args.scenarios.split(',') if s]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+    if args.app_url and not args.app_pid:
+        parser.error("--app-url needs --app-pid so CPU and RSS are sampled from the app, not this process")
+    pictures = load_pictures()
+    worker_counts = [int(w) for w in args.workers.split(',') if w] if args.workers else [None]
+    results = []
+    procs = []
+    try:
+        if args.app_url:
+            base_url = args.app_url.rstrip('/')
+            results.extend(run_scenarios(args, scenarios, levels, base_url, args.app_pid, pictures, None))
+        else:
+            standin_port = free_port()
+            procs.append(start_standin(standin_port, ['--seed', str(args.seed)] + args.standin_arg))
+            for workers in worker_counts:
+                # Fresh caches and stores per server so every configuration starts cold
+                with tempfile.TemporaryDirectory() as tmp:
+                    app_port = free_port()
+                    app_proc = start_app(app_port, standin_port, workers, tmp)
+                    try:
+                        results.extend(run_scenarios(args, scenarios, levels, f"http://127.0.0.1:{app_port}",
+                                                     app_proc.pid, pictures, workers))
+                    finally:
+                        app_proc.terminate()
+                        app_proc.wait(timeout=30)
+    finally:
+        for proc in reversed(procs):
+            proc.terminate()
+            proc.wait(timeout=10)
+
+    report = {
+        'benchmark': 'load_test',
+        'commit': git_commit(),
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('baseline', 'output')},
+        'levels': results,
+    }
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as fh:
+            baseline = json.load(fh)
+    print_table(results, baseline)
+    output = args.output or os.path.join(RESULTS_DIR, f"loadtest-{report['commit']}-{datetime.now().strftime('%Y%m%dT%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w', encoding='utf-8') as fh:
+        json.dump(report, fh, indent=2)
+    print(f"[load_test] Results written to {output}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Build the species knowledge pack served by the app.
+
+Fetches the GPT summary, fun fact, care tip and GBIF occurrence points for each
+species in the list (through the app's own enrichment functions, so limits and
+caching apply) and writes them to a compact, versioned, read-only file that the
+app memory-maps at startup (KNOWLEDGE_PACK_PATH, default knowledge_pack.bin).
+
+    python build_knowledge_pack.py
+    python build_knowledge_pack.py --species-file my_species.txt -o knowledge_pack.bin
+    python build_knowledge_pack.py "Azadirachta indica" "Mangifera indica" --pack-version 2025.1
+"""
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+# Always build from the upstream APIs, never from a previously built pack
+os.environ['KNOWLEDGE_PACK_PATH'] = ''
+
+from app import (CARE_TIP_FALLBACK, FUN_FACT_FALLBACK, KNOWLEDGE_PACK_ENTRY, KNOWLEDGE_PACK_FORMAT,
+                 KNOWLEDGE_PACK_HEADER, KNOWLEDGE_PACK_MAGIC, SUMMARY_FALLBACK, KnowledgePack,
+                 get_gbif_occurrences, get_gpt_summary, get_species_education, knowledge_pack_key)
+
+DEFAULT_SPECIES_FILE = 'knowledge_pack_species.txt'
+
+
+def read_species_file(path):
+    species = []
+    with open(path, encoding='utf-8') as fh:
+        for line in fh:
+            name = line.split('#', 1)[0].strip()
+            if name:
+                species.append(name)
+    return species
+
+
+def fetch_species(scientific_name, max_points):
+    """
+    Pack record for one species, or None when none of the enrichment could be fetched.
+    Fallback texts are left out so the app still asks the upstream for them later.
+    """
+    summary = get_gpt_summary(scientific_name)
+    education = get_species_education(scientific_name)
+    occurrences = get_gbif_occurrences(scientific_name, max_points)
+    record = {'scientific_name': scientific_name}
+    if summary != SUMMARY_FALLBACK:
+        record['summary'] = summary
+    if education['fun_fact'] != FUN_FACT_FALLBACK and education['care_tip'] != CARE_TIP_FALLBACK:
+        record['education'] = education
+    if occurrences:
+        record['occurrences'] = occurrences
+    return record if len(record) > 1 else None
+
+
+def write_pack(path, records, metadata):
+    """
+    Layout: header, fixed-width index sorted by name key, JSON records, JSON metadata.
+    Written to a temporary file and renamed, so running workers keep their old mapping.
+    """
+    entries = sorted(((knowledge_pack_key(r['scientific_name']), r) for r in records), key=lambda entry: entry[0])
+    keys = [key for key, _ in entries]
+    if len(set(keys)) != len(keys):
+        raise ValueError("duplicate species in the pack")
+    blobs = [json.dumps(r, ensure_ascii=False, separators=(',', ':')).encode('utf-8') for _, r in entries]
+    offset = KNOWLEDGE_PACK_HEADER.size + KNOWLEDGE_PACK_ENTRY.size * len(entries)
+    index = bytearray()
+    for key, blob in zip(keys, blobs):
+        index += KNOWLEDGE_PACK_ENTRY.pack(key, offset, len(blob))
+        offset += len(blob)
+    meta_blob = json.dumps(metadata, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'wb') as out:
+        out.write(KNOWLEDGE_PACK_HEADER.pack(KNOWLEDGE_PACK_MAGIC, KNOWLEDGE_PACK_FORMAT, len(entries), offset, len(meta_blob)))
+        out.write(index)
+        for blob in blobs:
+            out.write(blob)
+        out.write(meta_blob)
+        out.flush()
+        os.fsync(out.fileno())
+    os.replace(tmp_path, path)
+
+
+def run(args):
+    species = list(args.species)
+    if args.species_file:
+        species.extend(read_species_file(args.species_file))
+    species = list(dict.fromkeys(s.strip() for s in species if s.strip()))
+    if not species:
+        print("[pack] No species given.", file=sys.stderr)
+        return 2
+    print(f"[pack] Fetching {len(species)} species...", flush=True)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        fetched = list(pool.map(lambda name: fetch_species(name, args.max_points), species))
+    records = [r for r in fetched if r is not None]
+    for name, record in zip(species, fetched):
+        missing = [part for part in ('summary', 'education', 'occurrences') if record is None or part not in record]
+        if missing:
+            print(f"[pack] {name}: missing {', '.join(missing)}", flush=True)
+    built_at = datetime.now(timezone.utc)
+    metadata = {
+        'version': args.pack_version or built_at.strftime('%Y%m%dT%H%M%SZ'),
+        'built_at': built_at.isoformat(timespec='seconds'),
+        'max_points': args.max_points,
+        'species': sorted(r['scientific_name'] for r in records),
+    }
+    write_pack(args.output, records, metadata)
+    pack = KnowledgePack(args.output)
+    print(f"[pack] Wrote {args.output}: {pack.count} species, version {pack.metadata.get('version')}, "
+          f"{os.path.getsize(args.output)} bytes", flush=True)
+    return 0 if len(records) == len(species) else 1
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build the memory-mapped species knowledge pack.")
+    parser.add_argument('species', nargs='*', help="Scientific names to include (in addition to --species-file)")
+    parser.add_argument('--species-file', help=f"File with one scientific name per line (default {DEFAULT_SPECIES_FILE} when no names are given)")
+    parser.add_argument('-o', '--output', default=os.environ.get('KNOWLEDGE_PACK_OUTPUT', 'knowledge_pack.bin'),
+                        help="Pack file to write (default knowledge_pack.bin)")
+    parser.add_argument('--pack-version', help="Version label stored in the pack (default: build timestamp)")
+    parser.add_argument('--max-points', type=int, default=50, help="GBIF occurrence points per species (default 50)")
+    parser.add_argument('--concurrency', type=int, default=4, help="Species fetched concurrently (default 4)")
+    args = parser.parse_args(argv)
+    if not args.species and not args.species_file:
+        args.species_file = DEFAULT_SPECIES_FILE
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,189 @@
+"""
+Bulk identification of survey photo archives.
+
+Walks a directory, groups images into observations, identifies each observation
+with PlantNet (using the same preprocessing as the web app) and appends one JSON
+line per observation to the output file. Re-running with the same output file
+resumes where the previous run stopped.
+
+    python bulk_identify.py survey_2024/ -o survey_2024.jsonl
+    python bulk_identify.py survey_2024/ -o out.jsonl --group-by pattern --pattern '^(.+?)_\\d+$'
+"""
+import argparse
+import json
+import mimetypes
+import os
+import re
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from werkzeug.datastructures import FileStorage
+
+from app import MAX_IMAGES_PER_OBSERVATION, identify_observation
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.bmp', '.gif', '.tif', '.tiff'}
+# History owner for bulk runs; admins list them with GET /history?owner=bulk
+HISTORY_OWNER = 'bulk'
+
+
+def find_observations(root, group_by='folder', pattern=None):
+    """
+    Group image files under root into observations of at most MAX_IMAGES_PER_OBSERVATION images.
+    Returns an ordered list of (observation_id, [relative image paths]).
+    """
+    regex = re.compile(pattern) if pattern else None
+    groups = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        rel_dir = os.path.relpath(dirpath, root)
+        rel_dir = '' if rel_dir == '.' else rel_dir
+        for name in sorted(filenames):
+            stem, ext = os.path.splitext(name)
+            if ext.lower() not in IMAGE_EXTENSIONS:
+                continue
+            if group_by == 'pattern':
+                match = regex.search(stem) if regex else None
+                key = match.group('obs') if match and 'obs' in regex.groupindex else (match.group(1) if match and regex.groups else stem)
+                key = os.path.join(rel_dir, key)
+            else:
+                key = rel_dir or stem
+            groups.setdefault(key, []).append(os.path.join(rel_dir, name))
+    observations = []
+    for key, paths in groups.items():
+        for start in range(0, len(paths), MAX_IMAGES_PER_OBSERVATION):
+            suffix = f"#{start // MAX_IMAGES_PER_OBSERVATION + 1}" if len(paths) > MAX_IMAGES_PER_OBSERVATION else ''
+            observations.append((key + suffix, paths[start:start + MAX_IMAGES_PER_OBSERVATION]))
+    return observations
+
+
+def load_checkpoint(output_path, retry_errors=False):
+    """
+    Observation ids already recorded in the output file. Errored observations are
+    retried only when retry_errors is set; the last record for an id wins.
+    """
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, encoding='utf-8') as fh:
+        for line in fh:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # A run killed mid-write can leave a truncated last line
+                continue
+            if record.get('status') == 'ok' or not retry_errors:
+                done.add(record['id'])
+            else:
+                done.discard(record['id'])
+    return done
+
+
+def identify_paths(root, observation_id, rel_paths, max_results, enrich):
+    handles = [open(os.path.join(root, p), 'rb') for p in rel_paths]
+    try:
+        file_storages = [
+            FileStorage(stream=fh, filename=os.path.basename(p), content_type=mimetypes.guess_type(p)[0] or 'image/jpeg')
+            for fh, p in zip(handles, rel_paths)
+        ]
+        record = identify_observation(observation_id, file_storages, max_results, enrich, owner=HISTORY_OWNER)
+    finally:
+        for fh in handles:
+            fh.close()
+    record['images'] = rel_paths
+    record['identified_at'] = datetime.now().isoformat(timespec='seconds')
+    return record
+
+
+def run(args):
+    observations = find_observations(args.directory, args.group_by, args.pattern)
+    done = load_checkpoint(args.output, args.retry_errors)
+    pending = [(obs_id, paths) for obs_id, paths in observations if obs_id not in done]
+    skipped = len(observations) - len(pending)
+    if args.limit:
+        pending = pending[:args.limit]
+    print(f"[bulk] {len(observations)} observations found, {skipped} already done, {len(pending)} to identify")
+
+    write_lock = threading.Lock()
+    stop = threading.Event()
+    slots = threading.BoundedSemaphore(args.concurrency)
+    stats = {'completed': 0, 'errors': 0, 'quota': None}
+    started = time.monotonic()
+    last_report = [started]
+
+    def report(final=False):
+        elapsed = max(time.monotonic() - started, 1e-9)
+        rate = stats['completed'] / elapsed
+        quota = stats['quota'] if stats['quota'] is not None else 'unknown'
+        prefix = "[bulk] done:" if final else "[bulk]"
+        print(f"{prefix} {stats['completed']}/{len(pending)} observations, {stats['errors']} errors, "
+              f"{rate:.2f} obs/s, remaining PlantNet quota {quota}", flush=True)
+
+    def work(obs_id, paths):
+        try:
+            if stop.is_set():
+                return
+            record = identify_paths(args.directory, obs_id, paths, args.max_results, args.enrich)
+            if record.get('upstream_status') == 429:
+                # Out of quota: leave it unrecorded so the next run picks it up
+                if not stop.is_set():
+                    print("[bulk] PlantNet rate limit or quota exhausted, stopping. Re-run to resume.", flush=True)
+                stop.set()
+                return
+            with write_lock:
+                with open(args.output, 'a', encoding='utf-8') as out:
+                    out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                    out.flush()
+                    os.fsync(out.fileno())
+                stats['completed'] += 1
+                if record['status'] != 'ok':
+                    stats['errors'] += 1
+                if record.get('remaining_identification_requests') is not None:
+                    stats['quota'] = record['remaining_identification_requests']
+                now = time.monotonic()
+                if now - last_report[0] >= args.report_every:
+                    last_report[0] = now
+                    report()
+        finally:
+            slots.release()
+
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            for obs_id, paths in pending:
+                slots.acquire()
+                if stop.is_set():
+                    slots.release()
+                    break
+                pool.submit(work, obs_id, paths)
+    except KeyboardInterrupt:
+        stop.set()
+        print("[bulk] Interrupted, waiting for in-flight observations. Re-run to resume.", flush=True)
+    report(final=True)
+    return 1 if stop.is_set() else 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Identify a directory of plant photos with PlantNet and write JSONL results.")
+    parser.add_argument('directory', help="Root directory of the photo archive")
+    parser.add_argument('-o', '--output', required=True, help="JSONL output file (also used as the resume checkpoint)")
+    parser.add_argument('--group-by', choices=['folder', 'pattern'], default='folder',
+                        help="Group images into observations by containing folder (default) or by filename pattern")
+    parser.add_argument('--pattern', help="Regex applied to the filename stem; group 'obs' or group 1 is the observation key")
+    parser.add_argument('--concurrency', type=int, default=4, help="Concurrent PlantNet requests (default 4)")
+    parser.add_argument('--max-results', type=int, default=5, help="Ranked species to keep per observation (default 5)")
+    parser.add_argument('--enrich', action='store_true', help="Also fetch summaries, fun facts, care tips and occurrences")
+    parser.add_argument('--retry-errors', action='store_true', help="Retry observations recorded with an error in a previous run")
+    parser.add_argument('--limit', type=int, help="Identify at most this many pending observations")
+    parser.add_argument('--report-every', type=float, default=10.0, help="Seconds between progress reports (default 10)")
+    args = parser.parse_args(argv)
+    if args.group_by == 'pattern' and not args.pattern:
+        parser.error("--group-by pattern requires --pattern")
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return run(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,25 @@
+"""
+Production serving: `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Each worker is a separate process with its own HTTP pools; enrichment and
+identification results are shared between workers through the SQLite cache
+(SHARED_CACHE_PATH) and heatmap files under static/heatmaps/.
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5002')
+workers = int(os.environ.get('WEB_WORKERS', multiprocessing.cpu_count()))
+# Requests spend most of their time waiting on PlantNet/OpenAI, so each worker also runs a few threads
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_class = 'gthread'
+# PlantNet (45 s) plus enrichment can exceed gunicorn's default 30 s timeout
+timeout = int(os.environ.get('WEB_TIMEOUT', 180))
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+
+
+def post_fork(server, worker):
+    import app
+    app.init_worker()
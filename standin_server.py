@@ -0,0 +1,342 @@
+"""
+Local stand-in for the PlantNet, OpenAI and GBIF APIs.
+
+Replays recorded responses from standin_recordings/ (falling back to synthesized
+ones) with configurable latency, error and 429 injection, so the app can be run
+and benchmarked with no network. Point the app at it with:
+
+    PLANTNET_BASE_URL=http://127.0.0.1:5050 OPENAI_BASE_URL=http://127.0.0.1:5050 \\
+    GBIF_BASE_URL=http://127.0.0.1:5050 PLANTNET_API_KEY=dummy OPENAI_API_KEY=dummy python app.py
+
+    python standin_server.py --latency plantnet=lognormal:1.5,0.4 --latency openai=uniform:0.3,1.2 \\
+        --error-rate gbif=0.05 --throttle-rate openai=0.02 --seed 7
+
+With --record the server instead proxies to the real APIs and saves every
+response as a recording for later replay.
+"""
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+
+import requests
+from flask import Flask, Response, request
+
+RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'standin_recordings')
+UPSTREAMS = {
+    'plantnet': 'https://my-api.plantnet.org',
+    'openai': 'https://api.openai.com',
+    'gbif': 'https://api.gbif.org',
+}
+
+app = Flask(__name__)
+config = {
+    'latency': {},
+    'latency_specs': {},
+    'error_rate': {},
+    'throttle_rate': {},
+    'token_interval': 0.02,
+    'plantnet_quota': 500,
+    'record': False,
+    'recordings_dir': RECORDINGS_DIR,
+}
+_rng = random.Random()
+_rng_lock = threading.Lock()
+_quota_lock = threading.Lock()
+
+
+def parse_latency(spec):
+    """
+    Parse 'fixed:S', 'uniform:LO,HI' or 'lognormal:MEDIAN,SIGMA' (seconds) into a sampler.
+    """
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(',') if v]
+    if kind == 'fixed' and len(values) == 1:
+        return lambda rng: values[0]
+    if kind == 'uniform' and len(values) == 2:
+        return lambda rng: rng.uniform(values[0], values[1])
+    if kind == 'lognormal' and len(values) == 2:
+        mu = math.log(values[0])
+        return lambda rng: rng.lognormvariate(mu, values[1])
+    raise argparse.ArgumentTypeError(f"Invalid latency spec: {spec}")
+
+
+def parse_assignment(value):
+    api, sep, spec = value.partition('=')
+    if not sep or api not in UPSTREAMS:
+        raise argparse.ArgumentTypeError(f"Expected API=VALUE with API one of {', '.join(UPSTREAMS)}: {value}")
+    return api, spec
+
+
+def sample(api):
+    """
+    Decide the injected behaviour for one call: (latency seconds, status override or None).
+    """
+    with _rng_lock:
+        sampler = config['latency'].get(api)
+        latency = sampler(_rng) if sampler else 0.0
+        roll = _rng.random()
+    if roll < config['throttle_rate'].get(api, 0.0):
+        return latency, 429
+    if roll < config['throttle_rate'].get(api, 0.0) + config['error_rate'].get(api, 0.0):
+        return latency, 500
+    return latency, None
+
+
+def stable_hash(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()[:24]
+
+
+def recording_path(api, key):
+    return os.path.join(config['recordings_dir'], api, f"{key}.json")
+
+
+def load_recording(api, key):
+    path = recording_path(api, key)
+    if os.path.exists(path):
+        with open(path, encoding='utf-8') as fh:
+            return json.load(fh)
+    return None
+
+
+def save_recording(api, key, status, content_type, body, **extra):
+    os.makedirs(os.path.join(config['recordings_dir'], api), exist_ok=True)
+    with open(recording_path(api, key), 'w', encoding='utf-8') as fh:
+        json.dump(dict(status=status, content_type=content_type, body=body, **extra), fh, ensure_ascii=False, indent=1)
+
+
+_recordings_cache = {}
+
+
+def all_recordings(api):
+    if api not in _recordings_cache:
+        folder = os.path.join(config['recordings_dir'], api)
+        names = sorted(n for n in os.listdir(folder) if n.endswith('.json')) if os.path.isdir(folder) else []
+        recordings = []
+        for name in names:
+            with open(os.path.join(folder, name), encoding='utf-8') as fh:
+                recordings.append(json.load(fh))
+        _recordings_cache[api] = recordings
+    return _recordings_cache[api]
+
+
+def proxy(api):
+    """
+    Forward the current request to the real upstream (record mode).
+    """
+    headers = {k: v for k, v in request.headers.items() if k.lower() in ('authorization', 'content-type')}
+    resp = requests.request(request.method, UPSTREAMS[api] + request.full_path.rstrip('?'),
+                            headers=headers, data=request.get_data(), timeout=120)
+    return resp.status_code, resp.headers.get('Content-Type', 'application/json'), resp.text
+
+
+def error_response(status):
+    message = 'Too Many Requests' if status == 429 else 'Internal Server Error'
+    return Response(json.dumps({'error': message}), status=status, mimetype='application/json')
+
+
+# === PlantNet ===
+@app.route('/v2/identify/<project>', methods=['POST'])
+def plantnet_identify(project):
+    if config['record']:
+        # Cache the raw body before the multipart form is parsed so it can be forwarded
+        request.get_data(cache=True)
+    images = request.files.getlist('images')
+    if not images:
+        return error_response(400)
+    payloads = [(f.filename or '', f.read()) for f in images]
+    key = stable_hash(project, *[part for name, data in payloads for part in (name, data)])
+    if config['record']:
+        status, content_type, body = proxy('plantnet')
+        filenames = [os.path.splitext(os.path.basename(name))[0].lower() for name, _ in payloads]
+        save_recording('plantnet', key, status, content_type, body, filenames=filenames)
+        return Response(body, status=status, mimetype=content_type)
+    latency, injected = sample('plantnet')
+    time.sleep(latency)
+    if injected:
+        return error_response(injected)
+    with _quota_lock:
+        if config['plantnet_quota'] <= 0:
+            return error_response(429)
+        config['plantnet_quota'] -= 1
+        remaining = config['plantnet_quota']
+    recording = load_recording('plantnet', key) or match_plantnet_recording(payloads, key)
+    if recording is None:
+        return Response(json.dumps({'statusCode': 404, 'error': 'Not Found', 'message': 'Species not found'}),
+                        status=404, mimetype='application/json')
+    body = json.loads(recording['body'])
+    if isinstance(body, dict):
+        body['remainingIdentificationRequests'] = remaining
+    return Response(json.dumps(body), status=recording.get('status', 200), mimetype='application/json')
+
+
+def match_plantnet_recording(payloads, key):
+    """
+    Bundled recordings list the upload filenames they belong to; otherwise pick one deterministically.
+    """
+    recordings = all_recordings('plantnet')
+    if not recordings:
+        return None
+    for name, _ in payloads:
+        stem = os.path.splitext(os.path.basename(name))[0].lower()
+        for recording in recordings:
+            if stem in recording.get('filenames', []):
+                return recording
+    return recordings[int(key, 16) % len(recordings)]
+
+
+# === OpenAI ===
+@app.route('/v1/chat/completions', methods=['POST'])
+def openai_chat_completions():
+    payload = request.get_json(force=True, silent=True) or {}
+    stream = bool(payload.get('stream'))
+    key = stable_hash(payload.get('model', ''), json.dumps(payload.get('messages', []), sort_keys=True), stream)
+    if config['record']:
+        status, content_type, body = proxy('openai')
+        save_recording('openai', key, status, content_type, body)
+        return Response(body, status=status, mimetype=content_type)
+    latency, injected = sample('openai')
+    if injected:
+        time.sleep(latency)
+        return error_response(injected)
+    recording = load_recording('openai', key)
+    if recording is not None and not stream:
+        time.sleep(latency)
+        return Response(recording['body'], status=recording.get('status', 200), mimetype=recording.get('content_type', 'application/json'))
+    if recording is not None:
+        lines = [line for line in recording['body'].split('\n') if line]
+    else:
+        content = synthesize_completion(payload)
+        if not stream:
+            time.sleep(latency)
+            return Response(json.dumps(completion_body(payload, content)), mimetype='application/json')
+        words = re.findall(r'\S+\s*', content)
+        lines = [f"data: {json.dumps({'choices': [{'index': 0, 'delta': {'content': word}}]})}" for word in words]
+        lines.append('data: [DONE]')
+
+    def events():
+        time.sleep(latency)
+        for line in lines:
+            yield line + '\n\n'
+            time.sleep(config['token_interval'])
+    return Response(events(), mimetype='text/event-stream')
+
+
+def completion_body(payload, content):
+    return {
+        'id': 'chatcmpl-standin',
+        'object': 'chat.completion',
+        'model': payload.get('model', 'gpt-3.5-turbo'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': 0, 'completion_tokens': len(content.split()), 'total_tokens': len(content.split())},
+    }
+
+
+def synthesize_completion(payload):
+    """
+    Produce a plausible answer in the format each of the app's prompts asks for.
+    """
+    prompt = ' '.join(m.get('content', '') for m in payload.get('messages', []) if m.get('role') == 'user')
+    if (payload.get('response_format') or {}).get('type') == 'json_object':
+        # The app's micro-batched format: a JSON array of {id, prompt} tasks answered as {id: answer}
+        try:
+            tasks = json.loads(prompt)
+            return json.dumps({str(task['id']): synthesize_completion({'messages': [{'role': 'user', 'content': task['prompt']}]})
+                               for task in tasks})
+        except (ValueError, TypeError, KeyError):
+            return '{}'
+    species = re.search(r"'([^']+)'", prompt)
+    name = species.group(1) if species else 'this plant'
+    if "Answer only 'yes' or 'no'" in prompt:
+        return 'yes' if int(stable_hash(prompt), 16) % 2 else 'no'
+    if 'Fun Fact:' in prompt and 'Care Tip:' in prompt:
+        return (f"Fun Fact: {name} has been cultivated and studied for centuries.\n"
+                f"Care Tip: Give {name} well-drained soil, full sun and water deeply but infrequently.")
+    if 'key differences' in prompt:
+        return ("The two species differ in leaf shape, overall size and preferred habitat; "
+                "one is typically a large tree while the other is smaller and more often cultivated.")
+    return (f"{name} is a plant species found across tropical and subtropical regions. "
+            "It is valued for its ecological role and traditional uses, and is commonly planted in gardens and along roads.")
+
+
+# === GBIF ===
+@app.route('/v1/occurrence/search', methods=['GET'])
+def gbif_occurrence_search():
+    name = request.args.get('scientificName', '')
+    limit = int(request.args.get('limit', 20))
+    key = stable_hash(name.lower(), limit)
+    if config['record']:
+        status, content_type, body = proxy('gbif')
+        save_recording('gbif', key, status, content_type, body, scientific_name=name)
+        return Response(body, status=status, mimetype=content_type)
+    latency, injected = sample('gbif')
+    time.sleep(latency)
+    if injected:
+        return error_response(injected)
+    recording = load_recording('gbif', key) or next(
+        (r for r in all_recordings('gbif') if r.get('scientific_name', '').lower() == name.lower()), None)
+    if recording is not None:
+        return Response(recording['body'], status=recording.get('status', 200), mimetype='application/json')
+    # Deterministic scatter of points around a name-dependent centre
+    rng = random.Random(name.lower())
+    lat0, lon0 = rng.uniform(-35, 50), rng.uniform(-120, 140)
+    results = [{'decimalLatitude': round(lat0 + rng.gauss(0, 6), 4), 'decimalLongitude': round(lon0 + rng.gauss(0, 8), 4)}
+               for _ in range(limit)]
+    return Response(json.dumps({'offset': 0, 'limit': limit, 'endOfRecords': False, 'count': limit, 'results': results}),
+                    mimetype='application/json')
+
+
+@app.route('/_standin/config', methods=['GET'])
+def standin_config():
+    return {
+        'latency': config['latency_specs'],
+        'error_rate': config['error_rate'],
+        'throttle_rate': config['throttle_rate'],
+        'plantnet_quota_remaining': config['plantnet_quota'],
+        'record': config['record'],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Record/replay stand-in server for PlantNet, OpenAI and GBIF.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5050)
+    parser.add_argument('--latency', action='append', type=parse_assignment, default=[], metavar='API=SPEC',
+                        help="Latency distribution per API: fixed:S, uniform:LO,HI or lognormal:MEDIAN,SIGMA (seconds)")
+    parser.add_argument('--error-rate', action='append', type=parse_assignment, default=[], metavar='API=P',
+                        help="Fraction of calls answered with HTTP 500")
+    parser.add_argument('--throttle-rate', action='append', type=parse_assignment, default=[], metavar='API=P',
+                        help="Fraction of calls answered with HTTP 429")
+    parser.add_argument('--token-interval', type=float, default=0.02, help="Seconds between streamed OpenAI tokens")
+    parser.add_argument('--plantnet-quota', type=int, default=500, help="Simulated remaining PlantNet identifications")
+    parser.add_argument('--seed', type=int, help="Seed for reproducible latency and fault injection")
+    parser.add_argument('--recordings', default=RECORDINGS_DIR, help="Recordings directory")
+    parser.add_argument('--record', action='store_true', help="Proxy to the real APIs and save responses as recordings")
+    args = parser.parse_args(argv)
+    try:
+        config['latency'] = {api: parse_latency(spec) for api, spec in args.latency}
+    except argparse.ArgumentTypeError as e:
+        parser.error(str(e))
+    config['latency_specs'] = dict(args.latency)
+    config['error_rate'] = {api: float(p) for api, p in args.error_rate}
+    config['throttle_rate'] = {api: float(p) for api, p in args.throttle_rate}
+    config['token_interval'] = args.token_interval
+    config['plantnet_quota'] = args.plantnet_quota
+    config['recordings_dir'] = args.recordings
+    config['record'] = args.record
+    if args.seed is not None:
+        _rng.seed(args.seed)
+    app.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
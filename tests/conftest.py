@@ -0,0 +1,17 @@
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# app.py opens its stores and reads secrets.toml at import time, so point everything
+# at a scratch directory and import from the repository root.
+_STATE_DIR = tempfile.mkdtemp(prefix='plant-tests-')
+for _name, _file in (('SHARED_CACHE_PATH', 'cache.sqlite3'), ('SIMILARITY_INDEX_PATH', 'similarity.sqlite3'),
+                     ('HISTORY_DB', 'history.sqlite3'), ('ANALYTICS_DB', 'analytics.sqlite3'),
+                     ('JOBS_DB', 'jobs.sqlite3'), ('THUMBNAIL_FOLDER', 'thumbnails'),
+                     ('HEATMAP_FOLDER', 'heatmaps'), ('PROFILE_DIR', 'profiles')):
+    os.environ[_name] = os.path.join(_STATE_DIR, _file)
+os.environ['KNOWLEDGE_PACK_PATH'] = ''
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
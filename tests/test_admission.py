@@ -0,0 +1,91 @@
+import threading
+import time
+
+import pytest
+
+import app as appmod
+from app import ADMISSION_MAX_RETRY_AFTER, PRIORITY_HIGH, PRIORITY_LOW, AdmissionController, AdmissionPolicy, Overloaded
+
+
+def make_controller(capacity=3, reserve=1, low_limit=3, low_queue=0, low_wait=0.0):
+    return AdmissionController(capacity, reserve, [
+        AdmissionPolicy('high', PRIORITY_HIGH, limit=capacity, queue_size=0, max_wait=0.0, expected_duration=5.0),
+        AdmissionPolicy('low', PRIORITY_LOW, limit=low_limit, queue_size=low_queue, max_wait=low_wait, expected_duration=2.0),
+    ])
+
+
+def test_low_priority_cannot_use_reserved_slots():
+    controller = make_controller()
+    controller.acquire('low')
+    controller.acquire('low')
+    with pytest.raises(Overloaded, match='queue full'):
+        controller.acquire('low')
+    # The reserved slot is still free for identifications
+    controller.acquire('high')
+    with pytest.raises(Overloaded):
+        controller.acquire('high')
+
+
+def test_per_route_limit():
+    controller = make_controller(capacity=4, reserve=0, low_limit=1)
+    controller.acquire('low')
+    with pytest.raises(Overloaded):
+        controller.acquire('low')
+
+
+def test_waiter_times_out():
+    controller = make_controller(low_limit=1, low_queue=1, low_wait=0.05)
+    controller.acquire('low')
+    with pytest.raises(Overloaded, match='timed out'):
+        controller.acquire('low')
+    assert controller.policies['low'].waiting == 0
+
+
+def test_waiter_runs_once_a_slot_is_released():
+    controller = make_controller(low_limit=1, low_queue=1, low_wait=5.0)
+    started, _ = controller.acquire('low')
+    outcome = {}
+
+    def wait_for_slot():
+        outcome['waited'] = controller.acquire('low')[1]
+
+    waiter = threading.Thread(target=wait_for_slot)
+    waiter.start()
+    while controller.policies['low'].waiting == 0:
+        time.sleep(0.01)
+    controller.release('low', started)
+    waiter.join(timeout=5)
+    assert outcome == {'waited': True}
+    assert controller.policies['low'].in_flight == 1
+
+
+def test_retry_after_scales_with_backlog_and_is_clamped():
+    controller = make_controller()
+    policy = controller.policies['low']
+    policy.in_flight = 3
+    policy.waiting = 2
+    # (3 + 2 + 1) / 3 slots * 2s
+    assert controller.retry_after(policy) == 4
+    policy.avg_duration = 0.01
+    assert controller.retry_after(policy) == 1
+    policy.avg_duration = 1000.0
+    assert controller.retry_after(policy) == ADMISSION_MAX_RETRY_AFTER
+
+
+def test_release_updates_average_duration():
+    controller = make_controller()
+    controller.acquire('low')
+    controller.release('low', time.monotonic() - 12.0)
+    policy = controller.policies['low']
+    assert policy.avg_duration == pytest.approx(2.0 + 0.2 * (12.0 - 2.0), abs=0.01)
+    assert policy.in_flight == 0 and controller.in_flight == 0
+
+
+def test_shed_request_gets_503_with_retry_after(monkeypatch):
+    controller = AdmissionController(1, 0, [
+        AdmissionPolicy('compare', PRIORITY_LOW, limit=0, queue_size=0, max_wait=0.0, expected_duration=3.0),
+    ])
+    monkeypatch.setattr(appmod, 'ADMISSION', controller)
+    resp = appmod.app.test_client().post('/compare', data={'idx1': 0, 'idx2': 1})
+    assert resp.status_code == 503
+    assert resp.headers['Retry-After'] == str(controller.retry_after(controller.policies['compare']))
@@ -0,0 +1,95 @@
+import io
+import time
+from contextlib import closing
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import app as appmod
+
+
+@pytest.fixture(autouse=True)
+def jobs_db(tmp_path, monkeypatch):
+    monkeypatch.setattr(appmod, 'JOBS_DB', str(tmp_path / 'jobs.sqlite3'))
+    appmod.init_jobs_db()
+
+
+def enqueue(data=b'jpeg bytes'):
+    upload = FileStorage(stream=io.BytesIO(data), filename='leaf.jpg', content_type='image/jpeg')
+    return appmod.enqueue_job([upload], show_details=True, owner='owner-1')
+
+
+def job_row(job_id):
+    with closing(appmod.jobs_db()) as conn:
+        return conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+
+
+def image_count(job_id):
+    with closing(appmod.jobs_db()) as conn:
+        return conn.execute("SELECT COUNT(*) FROM job_images WHERE job_id = ?", (job_id,)).fetchone()[0]
+
+
+def make_stale(job_id):
+    with closing(appmod.jobs_db()) as conn, conn:
+        conn.execute("UPDATE jobs SET updated_at = ? WHERE id = ?", (time.time() - appmod.JOB_STALE_SECONDS - 1, job_id))
+
+
+def test_claim_marks_running_and_returns_images():
+    job_id = enqueue()
+    job, images = appmod.claim_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 1
+    assert [tuple(image) for image in images] == [('leaf.jpg', 'image/jpeg', b'jpeg bytes')]
+    assert job_row(job_id)['status'] == 'running'
+    assert appmod.claim_job() is None
+
+
+def test_retry_waits_for_backoff():
+    job_id = enqueue()
+    appmod.claim_job()
+    appmod.finish_job(job_id, 'queued', error='busy', retry_in=60)
+    assert appmod.claim_job() is None
+    with closing(appmod.jobs_db()) as conn, conn:
+        conn.execute("UPDATE jobs SET available_at = ? WHERE id = ?", (time.time() - 1, job_id))
+    job, _ = appmod.claim_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+
+
+def test_retryable_error_requeues_until_max_attempts(monkeypatch):
+    def unavailable(*args, **kwargs):
+        raise appmod.IdentificationError('upstream down', status_code=503)
+
+    monkeypatch.setattr(appmod, 'run_identification', unavailable)
+    job_id = enqueue()
+    job, images = appmod.claim_job()
+    appmod.run_job(job, images)
+    assert job_row(job_id)['status'] == 'queued'
+    appmod.run_job(dict(job, attempts=appmod.JOB_MAX_ATTEMPTS), images)
+    row = job_row(job_id)
+    assert row['status'] == 'failed'
+    assert row['error'] == 'upstream down'
+    assert image_count(job_id) == 0
+
+
+def test_stale_running_job_is_requeued():
+    job_id = enqueue()
+    appmod.claim_job()
+    make_stale(job_id)
+    job, images = appmod.claim_job()
+    assert job['id'] == job_id
+    assert job['attempts'] == 2
+    assert len(images) == 1
+
+
+def test_stale_job_out_of_attempts_is_failed():
+    job_id = enqueue()
+    appmod.claim_job()
+    with closing(appmod.jobs_db()) as conn, conn:
+        conn.execute("UPDATE jobs SET attempts = ? WHERE id = ?", (appmod.JOB_MAX_ATTEMPTS, job_id))
+    make_stale(job_id)
+    assert appmod.claim_job() is None
+    row = job_row(job_id)
+    assert row['status'] == 'failed'
+    assert row['error'] == appmod.JOB_CRASHED_MESSAGE
+    assert image_count(job_id) == 0
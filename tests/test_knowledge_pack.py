@@ -0,0 +1,37 @@
+import pytest
+
+from app import KnowledgePack
+from build_knowledge_pack import write_pack
+
+RECORDS = [
+    {'scientific_name': 'Azadirachta indica', 'summary': 'Neem 🌿', 'occurrences': [[28.6, 77.2]]},
+    {'scientific_name': 'Mangifera indica', 'education': {'fun_fact': 'Mangoes', 'care_tip': 'Water'}},
+    {'scientific_name': 'Ficus religiosa', 'summary': 'Peepal'},
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / 'pack.bin')
+    write_pack(path, RECORDS, {'version': 'test', 'species': [r['scientific_name'] for r in RECORDS]})
+    pack = KnowledgePack(path)
+    assert pack.count == len(RECORDS)
+    assert pack.metadata['version'] == 'test'
+    for record in RECORDS:
+        assert pack.get(record['scientific_name']) == record
+    # Lookups ignore case and surrounding whitespace
+    assert pack.get('  mangifera INDICA ') == RECORDS[1]
+    assert pack.get('Quercus robur') is None
+
+
+def test_duplicate_species_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        write_pack(str(tmp_path / 'pack.bin'), RECORDS + [{'scientific_name': 'azadirachta indica'}], {})
+
+
+def test_missing_or_foreign_file_is_empty(tmp_path):
+    assert KnowledgePack(str(tmp_path / 'missing.bin')).get('Azadirachta indica') is None
+    foreign = tmp_path / 'foreign.bin'
+    foreign.write_bytes(b'not a pack at all, just some bytes')
+    pack = KnowledgePack(str(foreign))
+    assert pack.count == 0
+    assert pack.get('Azadirachta indica') is None
@@ -0,0 +1,90 @@
+import time
+
+import pytest
+
+from app import RateLimitExceeded, UpstreamLimiter
+
+
+def make_limiter(**overrides):
+    options = dict(rate=1.0, burst=2, max_concurrency=8, target_latency=1.0, max_wait=0.0)
+    options.update(overrides)
+    return UpstreamLimiter('test', **options)
+
+
+def test_burst_then_rate_limited():
+    limiter = make_limiter(rate=0.001)
+    limiter.acquire()
+    limiter.acquire()
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire()
+
+
+def test_refill_is_proportional_to_elapsed_time():
+    limiter = make_limiter(rate=2.0, burst=10)
+    limiter.tokens = 0.0
+    limiter.last_refill = 100.0
+    limiter._refill(101.5)
+    assert limiter.tokens == pytest.approx(3.0)
+
+
+def test_refill_caps_at_burst():
+    limiter = make_limiter(rate=2.0, burst=5)
+    limiter.tokens = 0.0
+    limiter.last_refill = 0.0
+    limiter._refill(1000.0)
+    assert limiter.tokens == 5
+
+
+def test_concurrency_limit_blocks_until_release():
+    limiter = make_limiter(rate=100.0, burst=10, max_concurrency=1)
+    started = limiter.acquire()
+    with pytest.raises(RateLimitExceeded):
+        limiter.acquire()
+    limiter.release(started, 200)
+    limiter.acquire()
+
+
+def test_429_halves_limit_and_pauses():
+    limiter = make_limiter(max_concurrency=8)
+    limiter.in_flight = 1
+    limiter.release(time.monotonic(), 429)
+    assert limiter.limit == 4
+    assert limiter.tokens == 0
+    assert limiter.paused_until > time.monotonic()
+
+
+def test_slow_or_failed_calls_shrink_limit():
+    limiter = make_limiter(max_concurrency=10, target_latency=1.0)
+    limiter.in_flight = 2
+    limiter.release(time.monotonic() - 2.0, 200)
+    assert limiter.limit == pytest.approx(8.0)
+    limiter.release(time.monotonic(), None)
+    assert limiter.limit == pytest.approx(6.4)
+
+
+def test_fast_calls_grow_limit_additively_up_to_max():
+    limiter = make_limiter(max_concurrency=5)
+    limiter.limit = 4.0
+    limiter.in_flight = 3
+    limiter.release(time.monotonic(), 200)
+    assert limiter.limit == pytest.approx(4.25)
+    limiter.release(time.monotonic(), 200)
+    assert limiter.limit == pytest.approx(4.25 + 1 / 4.25)
+    limiter.limit = 4.99
+    limiter.release(time.monotonic(), 200)
+    assert limiter.limit == 5
+
+
+def test_limit_never_drops_below_min_concurrency():
+    limiter = make_limiter(max_concurrency=2, min_concurrency=1)
+    limiter.in_flight = 3
+    for _ in range(3):
+        limiter.release(time.monotonic(), 429)
+    assert limiter.limit == 1
+
+
+def test_exhausted_daily_quota_rejects():
+    limiter = make_limiter()
+    limiter.update_quota('0')
+    with pytest.raises(RateLimitExceeded, match='quota'):
+        limiter.acquire()